@@ -13,6 +13,16 @@ from tests.test_ssl_crt import *
 from tests.test_scan import *
 from tests.test_admin import *
 from tests.test_utils import *
+from tests.test_book_hash import *
+from tests.test_metadata_cache import *
+from tests.test_scan_pool import *
+from tests.test_archive import *
+from tests.test_catalog import *
+from tests.test_lru import *
+from tests.test_fulltext import *
+from tests.test_suggest import *
+from tests.test_executors import *
+from tests.test_prefork import *
 import unittest
 
 if __name__ == "__main__":
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os
+import tempfile
+import unittest
+import zipfile
+
+from webserver import archive
+from webserver.book_hash import data_sha256, stream_sha256
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.zpath = os.path.join(self.tmpdir.name, "bundle.zip")
+        with zipfile.ZipFile(self.zpath, "w", compression=zipfile.ZIP_DEFLATED) as z:
+            z.writestr("books/first.epub", b"first book")
+            z.writestr("books/second.pdf", b"second book")
+            z.writestr("readme.md", b"not a book")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_list_members(self):
+        self.assertTrue(archive.is_archive(self.zpath))
+        members = archive.list_members(self.zpath, ["epub", "pdf"])
+        self.assertEqual(sorted(members), [("books/first.epub", 10), ("books/second.pdf", 11)])
+
+    def test_split_path(self):
+        path = archive.member_path(self.zpath, "books/first.epub")
+        self.assertTrue(archive.is_member(path))
+        self.assertEqual(archive.split_path(path), (self.zpath, "books/first.epub"))
+        self.assertEqual(archive.split_path(self.zpath), (self.zpath, None))
+
+    def test_hash_member(self):
+        path = archive.member_path(self.zpath, "books/first.epub")
+        with archive.open_source(path) as stream:
+            self.assertEqual(stream_sha256(stream), data_sha256(b"first book"))
+        with archive.open_seekable(path) as stream:
+            stream.seek(6)
+            self.assertEqual(stream.read(), b"book")
+
+    def test_extract_member(self):
+        path = archive.member_path(self.zpath, "books/second.pdf")
+        tmpdir = os.path.join(self.tmpdir.name, "tmp")
+        with archive.extract_member(path, tmpdir) as fpath:
+            self.assertEqual(os.path.basename(fpath), "second.pdf")
+            with open(fpath, "rb") as f:
+                self.assertEqual(f.read(), b"second book")
+        self.assertFalse(os.path.exists(fpath))
+        self.assertEqual(os.listdir(tmpdir), [])
+
+    def test_comic_archive(self):
+        cbz = os.path.join(self.tmpdir.name, "comic.cbz")
+        with zipfile.ZipFile(cbz, "w") as z:
+            z.writestr("p10.jpg", b"10")
+            z.writestr("p2.jpg", b"2")
+        self.assertFalse(archive.is_archive(cbz))
+        members = archive.list_members(cbz, ["jpg"], fmt="zip")
+        self.assertEqual(sorted(members), [("p10.jpg", 2), ("p2.jpg", 1)])
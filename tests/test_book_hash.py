@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from webserver import models
+from webserver.book_hash import BookHashIndex, data_sha256, file_sha256
+
+
+class FakeCache:
+    def __init__(self, files):
+        self.files = files
+
+    def all_book_ids(self):
+        return set(self.files.keys())
+
+    def formats(self, book_id):
+        return tuple(fmt.upper() for fmt in self.files.get(book_id, {}))
+
+    def format_abspath(self, book_id, fmt):
+        return self.files.get(book_id, {}).get(fmt.lower(), None)
+
+
+class FakeLibrary:
+    def __init__(self, files):
+        self.new_api = FakeCache(files)
+
+
+class TestBookHashIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = {}
+        for book_id, data in [(1, b"first book"), (2, b"second book")]:
+            fpath = os.path.join(self.tmpdir.name, "%d.epub" % book_id)
+            with open(fpath, "wb") as f:
+                f.write(data)
+            self.files[book_id] = {"epub": fpath}
+
+        engine = create_engine("sqlite://")
+        models.Base.metadata.create_all(engine)
+        self.ScopedSession = scoped_session(sessionmaker(bind=engine))
+        self.index = BookHashIndex(FakeLibrary(self.files), self.ScopedSession)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_build_and_lookup(self):
+        self.index.build()
+        self.assertTrue(self.index.ready)
+        self.assertEqual(self.index.lookup(data_sha256(b"first book")), 1)
+        self.assertEqual(self.index.lookup(data_sha256(b"second book")), 2)
+        self.assertEqual(self.index.lookup(data_sha256(b"unknown book")), None)
+        self.assertEqual(file_sha256(self.files[1]["epub"]), data_sha256(b"first book"))
+
+    def test_delete_book(self):
+        self.index.build()
+        self.index.delete_book(1)
+        self.assertEqual(self.index.lookup(data_sha256(b"first book")), None)
+        self.assertEqual(self.ScopedSession().query(models.BookHash).count(), 1)
+
+    def test_load_persisted_index(self):
+        self.index.build()
+        index = BookHashIndex(FakeLibrary({}), self.ScopedSession)
+        index.load()
+        self.assertEqual(index.lookup(data_sha256(b"second book")), 2)
+
+    def test_caller_session_is_untouched(self):
+        # 索引提交时不能顺带提交调用方session中未完成的修改
+        session = self.ScopedSession()
+        session.add(models.BookHash(9, "pdf", data_sha256(b"pending"), 7))
+        self.index.add_format(1, "epub")
+        session.rollback()
+        self.assertEqual(self.index.lookup(data_sha256(b"first book")), 1)
+        self.assertEqual(session.query(models.BookHash).filter(models.BookHash.book_id == 9).count(), 0)
+        self.assertEqual(session.query(models.BookHash).filter(models.BookHash.book_id == 1).count(), 1)
+
+    def test_stale_books_are_removed(self):
+        self.index.build()
+        del self.files[2]
+        self.index.build()
+        self.assertEqual(self.index.lookup(data_sha256(b"second book")), None)
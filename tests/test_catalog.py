@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import threading
+import time
+import unittest
+from unittest import mock
+
+from webserver import catalog
+from webserver.catalog import Bitmap, Catalog
+
+
+class FakeCache:
+    def __init__(self, books):
+        self.books = books
+        self.sort_calls = 0
+
+    def search(self, query, restriction=""):
+        self.search_calls = getattr(self, "search_calls", 0) + 1
+        self.queries = getattr(self, "queries", []) + [query]
+        time.sleep(0.05)
+        query = query.strip()
+        if query == "bad":
+            raise ValueError("bad query")
+        return {book_id for book_id, book in self.books.items() if query in book["title"]}
+
+    def all_book_ids(self):
+        return set(self.books.keys())
+
+    def all_field_for(self, field, book_ids):
+        return {book_id: self.books[book_id].get(field, None) for book_id in book_ids}
+
+    def multisort(self, fields):
+        self.sort_calls += 1
+        field, ascending = fields[0]
+        return sorted(self.books, key=lambda book_id: self.books[book_id][field], reverse=not ascending)
+
+
+class FakeData:
+    def sanitize_sort_field_name(self, field):
+        return {"date": "timestamp"}.get(field, field)
+
+
+class FakeFieldMetadata:
+    def sortable_field_keys(self):
+        return ["title", "timestamp", "rating"]
+
+
+class FakeTag:
+    def __init__(self, name, sort=None):
+        self.name = name
+        self.sort = sort or name
+        self.count = 1
+
+
+class FakeLibrary:
+    def __init__(self, books):
+        self.new_api = FakeCache(books)
+        self.data = FakeData()
+        self.field_metadata = FakeFieldMetadata()
+        self.modified = 1
+
+    def last_modified(self):
+        return self.modified
+
+    def get_categories(self, ids=None):
+        self.category_calls = getattr(self, "category_calls", 0) + 1
+        tags = [FakeTag("alice"), FakeTag("Bob"), FakeTag("anne", "Anne"), FakeTag("3rd")]
+        if ids is not None:
+            # 按书籍id模拟计数：只有alice有可见的书籍
+            for tag in tags:
+                tag.count = len(ids) if tag.name == "alice" else 0
+        return {"authors": tags}
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        books = {n: {"title": "book-%03d" % (100 - n), "timestamp": n} for n in range(1, 101)}
+        for n, book in books.items():
+            book["formats"] = ("EPUB", "PDF") if n % 2 else ("EPUB",)
+            book["rating"] = 10 if n <= 10 else None
+            book["languages"] = ("zho",)
+        self.db = FakeLibrary(books)
+        self.catalog = Catalog(self.db)
+
+    def test_sort_ids(self):
+        self.assertEqual(self.catalog.sort_ids([3, 1, 2], "title"), [3, 2, 1])
+        self.assertEqual(self.catalog.sort_ids([3, 1, 2], "date", False), [3, 2, 1])
+        self.assertEqual(self.catalog.sort_ids(range(1, 101), "title")[:3], [100, 99, 98])
+        with self.assertRaises(KeyError):
+            self.catalog.sort_ids([1], "unknown")
+
+    def test_sort_index_is_cached(self):
+        self.catalog.sort_ids([1, 2], "title")
+        self.catalog.sort_ids([5, 6], "title")
+        self.assertEqual(self.db.new_api.sort_calls, 1)
+
+        # 书库更新后重建索引
+        self.db.modified = 2
+        self.catalog.sort_ids([1, 2], "title")
+        self.assertEqual(self.db.new_api.sort_calls, 2)
+
+    def test_build_outside_lock(self):
+        # 构建排序索引时不持有锁，其他线程可以读取已有的缓存
+        self.catalog.visibility("book-09")
+        locked = []
+        multisort = self.db.new_api.multisort
+
+        def try_lock():
+            acquired = self.catalog.lock.acquire(timeout=1)
+            locked.append(not acquired)
+            if acquired:
+                self.catalog.lock.release()
+
+        def check_lock(fields):
+            t = threading.Thread(target=try_lock)
+            t.start()
+            t.join()
+            return multisort(fields)
+
+        with mock.patch.object(self.db.new_api, "multisort", side_effect=check_lock):
+            self.catalog.sort_ids([1, 2], "title")
+        self.assertEqual(locked, [False])
+
+    def test_build_during_update(self):
+        # 构建期间书库有变化，结果只返回给本次调用，不保存
+        multisort = self.db.new_api.multisort
+
+        def update(fields):
+            self.db.modified = 2
+            self.catalog.check_version()
+            return multisort(fields)
+
+        with mock.patch.object(self.db.new_api, "multisort", side_effect=update):
+            self.assertEqual(self.catalog.sort_ids([3, 1, 2], "title"), [3, 2, 1])
+        self.assertEqual(self.catalog.orders, {})
+        self.catalog.sort_ids([1, 2], "title")
+        self.assertEqual(self.db.new_api.sort_calls, 2)
+
+    def test_sort_page(self):
+        self.assertEqual(self.catalog.sort_page(None, "id", False, 0, 3), (100, [100, 99, 98]))
+        self.assertEqual(self.catalog.sort_page([5, 1, 9, 3], "title", True, 1, 2), (4, [5, 3]))
+        self.assertEqual(self.catalog.sort_page(range(1, 101), "date", True, 10, 2), (100, [11, 12]))
+        self.assertEqual(self.catalog.sort_page([7, 3, 9], "date", False), (3, [9, 7, 3]))
+        self.assertEqual(self.catalog.sort_page([], "title", True, 0, 10), (0, []))
+
+        # 评分相同时，降序按id从大到小
+        total, ids = self.catalog.sort_page([1, 2, 50, 60], "rating", False)
+        self.assertEqual(ids[:2], [2, 1])
+
+    def test_letter_index(self):
+        index = self.catalog.letter_index("authors")
+        self.assertEqual([x.name for x in index["A"]], ["alice", "anne"])
+        self.assertEqual(sorted(index.keys()), ["3", "A", "B"])
+        self.assertEqual(self.catalog.letter_index("tags"), {})
+        self.assertEqual(self.db.category_calls, 1)
+
+    def test_restricted_categories(self):
+        # 受限用户只能看到有可见书籍的条目
+        categories = self.catalog.categories("book-09")
+        self.assertEqual([(x.name, x.count) for x in categories["authors"]], [("alice", 10)])
+        self.assertEqual(list(self.catalog.letter_index("authors", "book-09").keys()), ["A"])
+        self.assertEqual(len(self.catalog.categories()["authors"]), 4)
+
+        counts = self.catalog.category_counts("formats", "book-09")
+        self.assertEqual(counts, {"EPUB": 10, "PDF": 5})
+        self.assertEqual(self.catalog.category_counts("rating", "book-09"), {10: 10})
+
+    def test_facets(self):
+        ids = self.catalog.facet_filter(range(1, 101), [("formats", "PDF")])
+        self.assertEqual(len(ids), 50)
+        ids = self.catalog.facet_filter(ids, [("rating", "10")])
+        self.assertEqual(sorted(ids), [1, 3, 5, 7, 9])
+
+        counts = self.catalog.facet_counts(range(1, 101), "formats")
+        self.assertEqual(counts, [("EPUB", 100), ("PDF", 50)])
+        self.assertEqual(self.catalog.facet_counts(range(1, 101), "rating"), [("10", 10)])
+        self.assertEqual(self.catalog.facet_counts(range(1, 101), "tags"), [])
+
+    def test_facet_counts_subset(self):
+        for use_numpy in [True, False]:
+            with mock.patch("webserver.catalog.numpy", catalog.numpy if use_numpy else None):
+                c = Catalog(self.db)
+                # 数量相同时按取值排序；不存在的id忽略
+                self.assertEqual(c.facet_counts({1, 3, 200}, "formats"), [("EPUB", 2), ("PDF", 2)])
+                self.assertEqual(c.facet_counts([2, 4, 6, 8], "formats"), [("EPUB", 4)])
+                self.assertEqual(c.facet_counts(range(1, 101), "formats", 1), [("EPUB", 100)])
+                self.assertEqual(c.facet_counts([], "languages"), [])
+
+    def test_search_cache(self):
+        ids = self.catalog.search(" book-09 ")
+        self.assertEqual(sorted(ids), list(range(1, 11)))
+        self.assertEqual(self.catalog.search("book-09"), ids)
+        self.assertEqual(self.db.new_api.search_calls, 1)
+
+        # 书库更新后重新搜索
+        self.db.modified = 2
+        self.catalog.search("book-09")
+        self.assertEqual(self.db.new_api.search_calls, 2)
+
+        with self.assertRaises(ValueError):
+            self.catalog.search("bad")
+
+    def test_search_query_unchanged(self):
+        # 查询原样传给calibre，引号中的连续空白不能合并
+        self.catalog.search('title:"a  b"')
+        self.catalog.search('title:"a b"')
+        self.assertEqual(self.db.new_api.queries, ['title:"a  b"', 'title:"a b"'])
+
+    def test_search_single_flight(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.catalog.search("book-1"))) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(self.db.new_api.search_calls, 1)
+
+    def test_visibility(self):
+        bitmap = self.catalog.visibility("book-09")
+        self.assertEqual(len(bitmap), 10)
+        self.assertTrue(1 in bitmap)
+        self.assertFalse(11 in bitmap)
+
+        ids = self.catalog.search("book-0", "book-09")
+        self.assertEqual(sorted(ids), list(range(1, 11)))
+        self.assertEqual(self.catalog.search("book-0", "book-09"), ids)
+        calls = self.db.new_api.search_calls
+        self.catalog.search("book-1", "book-09")
+        self.assertEqual(self.db.new_api.search_calls, calls + 1)
+        self.assertEqual(self.catalog.search("book-1", "book-09"), ())
+
+
+class TestBitmap(unittest.TestCase):
+    def test_bitmap(self):
+        a = Bitmap([1, 9, 64])
+        b = Bitmap([9, 64, 65])
+        self.assertEqual((a & b).ids(), (9, 64))
+        self.assertEqual(len(a), 3)
+        self.assertEqual(a.filter([64, 2, 1, 300]), [64, 1])
+        self.assertEqual(len(Bitmap()), 0)
+        self.assertFalse(5 in Bitmap())
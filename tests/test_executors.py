@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import threading
+import unittest
+from unittest import mock
+
+from webserver import executors
+
+
+class TestExecutors(unittest.TestCase):
+    def test_pool_size(self):
+        with mock.patch.dict(executors.CONF, {"reader_threads": 3, "userdb_threads": "x"}):
+            self.assertEqual(executors.pool_size(executors.READER), 3)
+            self.assertEqual(executors.pool_size(executors.USERDB), 4)
+            self.assertEqual(executors.pool_size(executors.WRITER), 1)
+
+    def test_single_writer(self):
+        pool = executors.get_executor(executors.WRITER)
+        self.assertIs(executors.get_executor(executors.WRITER), pool)
+
+        names = set(pool.submit(lambda: threading.current_thread().name).result() for i in range(5))
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names.pop().startswith(executors.WRITER))
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os
+import sqlite3
+import tempfile
+import unittest
+import zipfile
+
+from webserver import fulltext
+from webserver.catalog import Bitmap
+from webserver.fulltext import FulltextIndex
+
+
+class FakeCache:
+    def __init__(self):
+        self.files = {}  # book_id => {fmt: path}
+
+    def all_book_ids(self):
+        return set(self.files.keys())
+
+    def formats(self, book_id):
+        return [fmt.upper() for fmt in self.files.get(book_id, {})]
+
+    def format_abspath(self, book_id, fmt):
+        return self.files.get(book_id, {}).get(fmt.lower(), None)
+
+
+class FakeLibrary:
+    def __init__(self):
+        self.new_api = FakeCache()
+
+    def last_modified(self):
+        return 1
+
+
+class TestTokenize(unittest.TestCase):
+    def test_tokenize(self):
+        SEP = fulltext.SEP
+        self.assertEqual(fulltext.tokenize("Hello 你好世界!"), SEP.join(["Hello ", "你好", "好世", "世界", "!"]))
+        self.assertEqual(fulltext.tokenize("一"), "一")
+        for text in ["Hello 你好世界!", "一，二三", "abc", "山里有座庙，庙里"]:
+            self.assertEqual(fulltext.untokenize(fulltext.tokenize(text)), text)
+
+    def test_untokenize_marks(self):
+        B, E = fulltext.MARK_BEGIN, fulltext.MARK_END
+        text = fulltext.SEP.join(["有个", "个老", B + "老和", "和尚" + E, "。"])
+        self.assertEqual(fulltext.untokenize(text), "有个" + B + "老和尚" + E + "。")
+        self.assertEqual(fulltext.format_snippet(text), "有个<b>老和尚</b>。")
+
+    def test_match_query(self):
+        SEP = fulltext.SEP
+        self.assertEqual(fulltext.match_query("你好世界  hello"), '"你好%s好世%s世界" "hello"' % (SEP, SEP))
+        self.assertEqual(fulltext.match_query("雪"), '"雪"*')
+        self.assertEqual(fulltext.match_query('a"b'), '"a""b"')
+        self.assertEqual(fulltext.match_query("  "), "")
+
+    def test_extract_epub(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fpath = os.path.join(tmpdir, "book.epub")
+            with zipfile.ZipFile(fpath, "w") as z:
+                z.writestr(
+                    "META-INF/container.xml",
+                    '<container><rootfiles><rootfile full-path="OEBPS/content.opf"/></rootfiles></container>',
+                )
+                z.writestr(
+                    "OEBPS/content.opf",
+                    '<package xmlns="http://www.idpf.org/2007/opf"><manifest>'
+                    '<item id="a" href="a.html"/><item id="b" href="b.html"/>'
+                    '</manifest><spine><itemref idref="b"/><itemref idref="a"/></spine></package>',
+                )
+                z.writestr("OEBPS/a.html", "<html><head><title>x</title></head><body><p>second &amp; last</p></body></html>")
+                z.writestr("OEBPS/b.html", "<html><body><style>p{}</style><p>first</p></body></html>")
+            self.assertEqual(fulltext.extract_text(fpath, "epub"), " first \n second & last ")
+
+
+class TestFulltextIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = FakeLibrary()
+        self.index = FulltextIndex(self.db, os.path.join(self.tmpdir.name, "fulltext.db"))
+        self.add_txt(1, "从前有座山，山里有座庙，庙里有个老和尚。", "gb18030")
+        self.add_txt(2, "The quick brown fox jumps over the lazy dog. 山")
+        self.index.sync()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def add_txt(self, book_id, text, encoding="utf-8"):
+        fpath = os.path.join(self.tmpdir.name, "%d.txt" % book_id)
+        with open(fpath, "w", encoding=encoding) as f:
+            f.write(text)
+        self.db.new_api.files[book_id] = {"txt": fpath}
+
+    def test_search(self):
+        results = self.index.search("老和尚")
+        self.assertEqual([book_id for book_id, __ in results], [1])
+        self.assertIn("<b>老和尚</b>", results[0][1])
+        self.assertEqual([book_id for book_id, __ in self.index.search("FOX dog")], [2])
+        self.assertEqual(sorted(book_id for book_id, __ in self.index.search("山")), [1, 2])
+        self.assertEqual(self.index.search("狐狸"), [])
+
+    def test_reader_process(self):
+        # 读进程只读打开索引，写进程完成首次同步后才可以查询
+        path = os.path.join(self.tmpdir.name, "missing.db")
+        reader = FulltextIndex(self.db, path)
+        reader.attach()
+        self.assertFalse(reader.ready)
+        self.assertFalse(os.path.exists(path))
+
+        reader = FulltextIndex(self.db, self.index.path)
+        reader.attach()
+        self.assertFalse(reader.ready)
+        self.assertFalse(self.index.ready)
+        self.index.mark_synced()
+        self.assertTrue(self.index.ready)
+        self.assertTrue(reader.ready)
+        self.assertEqual([book_id for book_id, __ in reader.search("老和尚")], [1])
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.delete_book(1)
+
+    def test_search_visible(self):
+        # 在查询中过滤不可见的书籍，结果数量不因过滤而减少
+        self.assertEqual([book_id for book_id, __ in self.index.search("山", 1, visible=Bitmap([2]))], [2])
+        self.assertEqual(self.index.search("老和尚", visible=Bitmap([2])), [])
+        self.assertEqual(len(self.index.search("山", visible=None)), 2)
+
+    def test_incremental(self):
+        calls = []
+        old_extract = fulltext.extract_text
+        fulltext.extract_text = lambda fpath, fmt: calls.append(fpath) or old_extract(fpath, fmt)
+        try:
+            self.index.sync()
+            self.assertEqual(calls, [])
+
+            self.add_txt(2, "狐狸")
+            self.index.sync()
+            self.assertEqual(len(calls), 1)
+            self.assertEqual([book_id for book_id, __ in self.index.search("狐狸")], [2])
+            self.assertEqual(self.index.search("fox"), [])
+        finally:
+            fulltext.extract_text = old_extract
+
+    def test_sync_changes(self):
+        calls = []
+        old_extract = fulltext.extract_text
+        fulltext.extract_text = lambda fpath, fmt: calls.append(fpath) or old_extract(fpath, fmt)
+        try:
+            # 只为新增的书籍建立索引，已有书籍的文件变化等待notify()
+            self.add_txt(2, "狐狸")
+            self.add_txt(3, "兔子")
+            del self.db.new_api.files[1]
+            self.index.sync_changes()
+            self.assertEqual(len(calls), 1)
+            self.assertEqual([book_id for book_id, __ in self.index.search("兔子")], [3])
+            self.assertEqual(self.index.search("老和尚"), [])
+            self.assertEqual(self.index.search("狐狸"), [])
+
+            self.index.update_book(2)
+            self.assertEqual([book_id for book_id, __ in self.index.search("狐狸")], [2])
+        finally:
+            fulltext.extract_text = old_extract
+
+    def test_delete(self):
+        del self.db.new_api.files[1]
+        self.index.sync()
+        self.assertEqual(self.index.search("老和尚"), [])
+        self.assertEqual(sorted(self.index.indexed().keys()), [2])
+
+        self.index.update_book(2)
+        self.db.new_api.files[2] = {}
+        self.index.update_book(2)
+        self.assertEqual(self.index.indexed(), {})
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import unittest
+
+from webserver.lru import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evict_by_items(self):
+        cache = LRUCache(max_items=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_evict_by_bytes(self):
+        cache = LRUCache(max_bytes=10, sizeof=len)
+        cache.put("a", b"12345")
+        cache.put("b", b"12345")
+        self.assertEqual(cache.nbytes, 10)
+        cache.put("c", b"123")
+        self.assertFalse("a" in cache)
+        self.assertEqual(cache.nbytes, 8)
+
+        # 超过上限的条目不缓存
+        self.assertFalse(cache.put("d", b"12345678901"))
+        self.assertEqual(len(cache), 2)
+
+    def test_replace_and_pop(self):
+        cache = LRUCache(max_bytes=10, sizeof=len)
+        cache.put("a", b"12345")
+        cache.put("a", b"12")
+        self.assertEqual(cache.nbytes, 2)
+        self.assertEqual(cache.pop("a"), b"12")
+        self.assertEqual(cache.nbytes, 0)
+        self.assertEqual(cache.pop("a"), None)
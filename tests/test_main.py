@@ -53,6 +53,7 @@ def setup_server():
     # set env
     main.options.with_library = testdir + "/library/"
     main.CONF["scan_upload_path"] = testdir + "/cases/"
+    main.CONF["scan_meta_path"] = "/tmp/scanmeta/"
     main.CONF["ALLOW_GUEST_PUSH"] = False
     main.CONF["ALLOW_GUEST_DOWNLOAD"] = False
     main.CONF["upload_path"] = "/tmp/"
@@ -66,6 +67,7 @@ def setup_server():
     main.CONF["db_engine_args"] = {"echo": True}
     if _app is None:
         _app = main.make_app()
+        models.user_syncdb(_app._engine)
 
 
 def setup_mock_user():
@@ -104,6 +106,9 @@ class FakeHandler(BaseHandler):
     def finish(self):
         return None
 
+    async def run_blocking(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
     def set_header(self, k, v):
         self.rsp_headers[k] = v
 
@@ -199,6 +204,54 @@ class TestAppWithoutLogin(TestApp):
         d = self.json("/api/recent")
         self.assert_book_list(d, 10)
 
+    def test_recent_fields(self):
+        full = self.json("/api/recent")
+        d = self.json("/api/recent?fields=title,img,unknown")
+        self.assertEqual(d["total"], full["total"])
+        self.assertEqual([b["id"] for b in d["books"]], [b["id"] for b in full["books"]])
+        for lean, book in zip(d["books"], full["books"]):
+            self.assertEqual(sorted(lean.keys()), ["id", "img", "title"])
+            self.assertEqual(lean["img"], book["img"])
+
+    def test_batch(self):
+        d = self.json("/api/batch?req=/api/book/nav&req=/api/recent&req=/api/batch&ids=1,2,99999")
+        self.assertEqual(d["err"], "ok")
+        self.assertEqual(len(d["responses"]), 3)
+        self.assertEqual(d["responses"][0], self.json("/api/book/nav"))
+        self.assert_book_list(d["responses"][1], 10)
+        self.assertEqual(d["responses"][2]["err"], "params.invalid")
+        self.assertEqual([b["id"] for b in d["books"]], [1, 2])
+        for book in d["books"]:
+            self.assert_book_fields(book)
+            self.assertTrue("files" in book)
+
+        # 不在白名单中的接口（下载、退出登录等）不执行
+        with mock.patch("webserver.handlers.book.BookDownload.get") as m:
+            d = self.json("/api/batch?req=/api/book/1.epub&req=/api/user/sign_out")
+        self.assertEqual([r["err"] for r in d["responses"]], ["params.invalid", "params.invalid"])
+        self.assertEqual(m.call_count, 0)
+
+        d = self.json("/api/batch", method="POST", body=json.dumps({"requests": ["/api/user/info"], "ids": [1]}))
+        self.assertEqual(d["responses"][0]["user"]["is_login"], False)
+        self.assertEqual(len(d["books"]), 1)
+
+        # 所有子请求只查询一次当前用户
+        with mock.patch.object(BaseHandler, "get_current_user", return_value=None) as m:
+            d = self.json("/api/batch?req=/api/user/info&req=/api/user/messages&req=/api/recent")
+        self.assertEqual(d["err"], "ok")
+        self.assertEqual(m.call_count, 1)
+
+        # 输出结果后抛出Finish的接口，取最后输出的JSON
+        def finish(handler):
+            handler.write({"err": "ok", "suggestions": []})
+            handler.write("")
+            raise web.Finish()
+
+        get = webserver.handlers.book.Suggest.get
+        with mock.patch.object(get, "__wrapped__", side_effect=finish):
+            d = self.json("/api/batch?req=/api/suggest")
+        self.assertEqual(d["responses"][0], {"err": "ok", "suggestions": [], "msg": ""})
+
     def test_download(self):
         rsp = self.fetch("/api/book/1.epub", follow_redirects=False)
         self.assertEqual(rsp.code, 302)
@@ -630,6 +683,16 @@ class TestOpds(TestWithUserLogin):
         self.assertEqual(rsp.code, 200)
         self.parse_xml(rsp.body)
 
+    def test_opds_not_modified(self):
+        rsp = self.fetch("/opds/", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(rsp.code, 200)
+        self.parse_xml(rsp.body)
+
+        rsp = self.fetch("/opds/", headers={"If-None-Match": rsp.headers["Etag"], "Accept-Encoding": "gzip"})
+        self.assertEqual(rsp.code, 304)
+        rsp = self.fetch("/opds/", headers={"If-Modified-Since": rsp.headers["Last-Modified"]})
+        self.assertEqual(rsp.code, 304)
+
     def test_opds_nav(self):
         rsp = self.fetch("/opds/nav/4e617574686f7273?offset=1")
         self.assertEqual(rsp.code, 200)
@@ -659,6 +722,42 @@ class TestOpds(TestWithUserLogin):
                 self.assertEqual(rsp.code, 200)
                 self.parse_xml(rsp.body)
 
+    def test_opds_facets(self):
+        url = "/opds/nav/%s" % b'Onewest'.hex()
+        rsp = self.fetch(url)
+        self.assertEqual(rsp.code, 200)
+        self.assertTrue(b"opds:facetGroup" in rsp.body)
+
+        rsp = self.fetch(url + "?facet=formats:EPUB")
+        self.assertEqual(rsp.code, 200)
+        self.assertTrue(b'opds:activeFacet="true"' in rsp.body)
+
+        rsp = self.fetch(url + "?facet=unknown:1")
+        self.assertEqual(rsp.code, 400)
+
+    def test_opds_page_stream_not_comic(self):
+        rsp = self.fetch("/opds/pse/1/epub/0")
+        self.assertEqual(rsp.code, 404)
+
+    def test_opds_page_stream_inactive_user(self):
+        with mock_permission() as user:
+            user.active = False
+            rsp = self.fetch("/opds/pse/1/cbz/0")
+            user.active = True
+        self.assertEqual(rsp.code, 403)
+
+    def test_opds2(self):
+        d = self.json("/opds2/")
+        self.assertTrue(len(d["navigation"]) > 0)
+        self.assertTrue(d["navigation"][0]["href"].startswith("/opds2/"))
+
+        self.assertEqual(d["links"][0], {"rel": "self", "href": "/opds2/", "type": "application/opds+json"})
+
+        d = self.json("/opds2/nav/%s" % b'Otitle'.hex())
+        self.gt(len(d["publications"]), 1)
+        self.assertEqual(d["links"][0]["href"], "/opds2/nav/%s" % b'Otitle'.hex())
+        self.assertEqual(d["metadata"]["currentPage"], 1)
+
     def test_opds_category(self):
         a = b'tags'.hex()
         b = b'I71:tags'.hex()
@@ -725,7 +824,7 @@ class TestJsonResponse(TestApp):
     def test_err(self):
         f = FakeHandler()
         with mock.patch("traceback.format_exc", return_value=""):
-            webserver.handlers.base.js(lambda x: self.raise_(RuntimeError()))(f)
+            self.io_loop.run_sync(lambda: webserver.handlers.base.js(lambda x: self.raise_(RuntimeError()))(f))
         self.assertTrue(isinstance(f.rsp["msg"], str))
         self.assertEqual(f.rsp["err"], "exception")
         self.assertHeaders(f.rsp_headers)
@@ -733,7 +832,7 @@ class TestJsonResponse(TestApp):
     def test_finish(self):
         f = FakeHandler()
         with mock.patch("traceback.format_exc", return_value=""):
-            webserver.handlers.base.js(lambda x: self.raise_(web.Finish()))(f)
+            self.io_loop.run_sync(lambda: webserver.handlers.base.js(lambda x: self.raise_(web.Finish()))(f))
         self.assertEqual(f.rsp, "")
         self.assertHeaders(f.rsp_headers)
 
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from webserver import models
+from webserver.book_hash import data_sha256
+from webserver.handlers.scan import Scanner
+from webserver.metadata_cache import MetadataCache
+from webserver.models import ScanFile
+
+
+def new_metadata(title):
+    from calibre.ebooks.metadata.book.base import Metadata
+
+    mi = Metadata(title, [u"作者"])
+    mi.publisher = u"出版社"
+    mi.tags = [u"小说", u"科幻"]
+    return mi
+
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = MetadataCache(self.tmpdir.name)
+        self.hash_value = data_sha256(b"book content")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_save_and_load(self):
+        mi = new_metadata(u"书名")
+        mi.cover_data = ("jpg", b"fake cover")
+        self.assertTrue(self.cache.save(self.hash_value, mi))
+
+        fpath = self.cache.get_path(self.hash_value)
+        self.assertTrue(os.path.isfile(fpath + ".json"))
+        self.assertTrue(os.path.isfile(fpath + ".cover"))
+
+        mi = self.cache.load(self.hash_value)
+        self.assertEqual(mi.title, u"书名")
+        self.assertEqual(mi.authors, [u"作者"])
+        self.assertEqual(mi.publisher, u"出版社")
+        self.assertEqual(mi.tags, [u"小说", u"科幻"])
+        self.assertEqual(mi.cover_data, ("jpg", b"fake cover"))
+
+    def test_save_without_cover(self):
+        self.assertTrue(self.cache.save(self.hash_value, new_metadata(u"无封面")))
+        self.assertFalse(os.path.isfile(self.cache.get_path(self.hash_value) + ".cover"))
+        mi = self.cache.load(self.hash_value)
+        self.assertEqual(mi.title, u"无封面")
+        self.assertFalse(mi.cover_data and mi.cover_data[1])
+
+    def test_missing_entry(self):
+        self.assertEqual(self.cache.load(data_sha256(b"unknown")), None)
+
+    def test_corrupt_entry(self):
+        fpath = self.cache.get_path(self.hash_value)
+        os.makedirs(os.path.dirname(fpath))
+        with open(fpath + ".json", "wb") as f:
+            f.write(b"{not json")
+        self.assertEqual(self.cache.load(self.hash_value), None)
+
+    def test_missing_cover_file(self):
+        mi = new_metadata(u"书名")
+        mi.cover_data = ("jpg", b"fake cover")
+        self.cache.save(self.hash_value, mi)
+        os.remove(self.cache.get_path(self.hash_value) + ".cover")
+        mi = self.cache.load(self.hash_value)
+        self.assertEqual(mi.title, u"书名")
+        self.assertFalse(mi.cover_data and mi.cover_data[1])
+
+    def test_delete(self):
+        mi = new_metadata(u"书名")
+        mi.cover_data = ("jpg", b"fake cover")
+        self.cache.save(self.hash_value, mi)
+        self.cache.delete(self.hash_value)
+        fpath = self.cache.get_path(self.hash_value)
+        self.assertFalse(os.path.exists(fpath + ".json"))
+        self.assertFalse(os.path.exists(fpath + ".cover"))
+        self.assertEqual(self.cache.load(self.hash_value), None)
+
+        # 重复删除不报错
+        self.cache.delete(self.hash_value)
+
+
+class TestImportDeletesCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        engine = create_engine("sqlite://")
+        models.Base.metadata.create_all(engine)
+        self.ScopedSession = scoped_session(sessionmaker(bind=engine))
+        self.scanner = Scanner(None, self.ScopedSession)
+        self.scanner.meta_cache = MetadataCache(self.tmpdir.name)
+
+    def tearDown(self):
+        self.ScopedSession.remove()
+        self.tmpdir.cleanup()
+
+    def new_row(self, name):
+        hash_value = data_sha256(name.encode("UTF-8"))
+        row = ScanFile("/data/%s.epub" % name, hash_value, 1)
+        row.status = ScanFile.READY
+        self.scanner.session.add(row)
+        self.scanner.session.commit()
+        self.scanner.meta_cache.save_raw(hash_value, {"title": name})
+        return row
+
+    def test_import_batch(self):
+        imported, failed = self.new_row("imported"), self.new_row("failed")
+
+        def import_row(row):
+            if row is failed:
+                raise IOError("bad file")
+            row.status = ScanFile.IMPORTED
+            row.book_id = 10
+            item = models.Item()
+            item.book_id = row.book_id
+            return item
+
+        with mock.patch.object(self.scanner, "import_row", side_effect=import_row):
+            self.scanner.import_batch([imported, failed])
+
+        # 导入成功的记录删除缓存，失败的保留以便下次导入时复用
+        cache = self.scanner.meta_cache
+        self.assertFalse(os.path.exists(cache.get_path(imported.hash) + ".json"))
+        self.assertTrue(os.path.exists(cache.get_path(failed.hash) + ".json"))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import threading
+import time
+import unittest
+from unittest import mock
+
+from webserver import prefork
+from webserver.prefork import LibraryWatcher, Worker
+
+
+class FakeLibrary:
+    def __init__(self):
+        self.modified = 1
+        self.new_api = mock.Mock()
+        self.refresh = mock.Mock()
+
+    def last_modified(self):
+        return self.modified
+
+
+class TestPrefork(unittest.TestCase):
+    def test_worker(self):
+        self.assertTrue(Worker(0, 9000).is_writer)
+        self.assertFalse(Worker(3, 9000).is_writer)
+        self.assertEqual(Worker(3, 9000).writer_url("/api/x?a=1"), "http://127.0.0.1:9000/api/x?a=1")
+
+    def test_library_watcher(self):
+        db = FakeLibrary()
+        watcher = LibraryWatcher(db)
+        watcher.check()
+        db.new_api.reload_from_db.assert_not_called()
+
+        # 写进程修改书库后，在下一个请求开始时重新加载
+        db.modified = 2
+        self.assertEqual(db.last_modified(), 1)
+        watcher.check()
+        db.new_api.reload_from_db.assert_called_once_with()
+        db.refresh.assert_called_once_with()
+        self.assertEqual(db.last_modified(), 2)
+
+        # 两次重新加载之间至少间隔RELOAD_INTERVAL
+        db.modified = 3
+        watcher.check()
+        self.assertEqual(db.new_api.reload_from_db.call_count, 1)
+        watcher.reload_time -= prefork.RELOAD_INTERVAL
+        watcher.check()
+        self.assertEqual(db.new_api.reload_from_db.call_count, 2)
+
+    def test_reload_waits_for_readers(self):
+        # 重新加载等待正在查询书库的任务结束，期间新的查询也要等待
+        db = FakeLibrary()
+        watcher = LibraryWatcher(db)
+        events = []
+        db.new_api.reload_from_db.side_effect = lambda: events.append("reload")
+        reading = threading.Event()
+
+        def query(name, wait):
+            with watcher.reading():
+                reading.set()
+                time.sleep(wait)
+                events.append(name)
+
+        first = threading.Thread(target=query, args=("first", 0.2))
+        first.start()
+        reading.wait()
+        db.modified = 2
+        reloader = threading.Thread(target=watcher.check)
+        reloader.start()
+        time.sleep(0.05)
+        second = threading.Thread(target=query, args=("second", 0))
+        second.start()
+        for t in (first, reloader, second):
+            t.join()
+        self.assertEqual(events, ["first", "reload", "second"])
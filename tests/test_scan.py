@@ -2,11 +2,12 @@
 # -*- coding: UTF-8 -*-
 
 import json
+import threading
 from unittest import mock
 
 from tests.test_main import TestWithUserLogin, setUpModule as init, testdir
 from webserver import handlers
-from webserver.models import ScanFile
+from webserver.models import ScanFile, ScanTask
 
 
 def setUpModule():
@@ -33,6 +34,32 @@ class TestScan(TestWithUserLogin):
         d = self.json("/api/admin/import/status")
         self.assertEqual(d["err"], "ok")
 
+    def test_status_events(self):
+        # 没有运行中的任务时，推送一次当前状态后结束
+        for kind in ["scan", "import"]:
+            rsp = self.fetch("/api/admin/%s/events" % kind, request_timeout=60)
+            self.assertEqual(rsp.code, 200)
+            self.assertTrue(rsp.headers["Content-Type"].startswith("text/event-stream"))
+            body = rsp.body.decode("UTF-8")
+            self.assertTrue(body.startswith("data: "))
+            d = json.loads(body[len("data: "):].strip())
+            self.assertEqual(d["err"], "ok")
+            self.assertEqual(d["running"], False)
+
+    def test_status_events_in_thread(self):
+        # 状态查询在线程池中执行，不阻塞IOLoop，也不关闭IOLoop线程共用的session
+        threads = []
+
+        def scan_status():
+            threads.append(threading.get_ident())
+            return (0, {})
+
+        with mock.patch("webserver.handlers.scan.Scanner.scan_status", side_effect=scan_status):
+            rsp = self.fetch("/api/admin/scan/events", request_timeout=60)
+        self.assertEqual(rsp.code, 200)
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.get_ident())
+
 
 class TestScanContinue(TestWithUserLogin):
     NEW_ROW_ID = 69
@@ -61,7 +88,6 @@ class TestScanContinue(TestWithUserLogin):
         self.assertEqual(row.status, ScanFile.READY)
 
 
-
 class TestImport(TestWithUserLogin):
     READY_ROW_ID = 69
 
@@ -97,3 +123,38 @@ class TestImport(TestWithUserLogin):
         req = {"hashlist": "all"}
         d = self.json("/api/admin/import/run", method="POST", body=json.dumps(req))
         self.assertEqual(d["err"], "ok")
+
+
+class TestImportResume(TestWithUserLogin):
+    READY_ROW_ID = 69
+    IMPORT_ID = 1008610086
+
+    def setUp(self):
+        # 模拟一个被中断的导入任务
+        self.session = self.get_app().settings["ScopedSession"]
+        self.session.rollback()
+
+        row = self.session.query(ScanFile).filter(ScanFile.id == self.READY_ROW_ID).one()
+        row.path = testdir + "/cases/new.epub"
+        row.status = ScanFile.READY
+        row.book_id = 0
+        row.import_id = self.IMPORT_ID
+        row.save()
+
+        self.session.query(ScanTask).delete()
+        task = ScanTask(ScanTask.IMPORT, self.IMPORT_ID, {"user_id": 1})
+        self.session.add(task)
+        self.session.commit()
+        return super().setUp()
+
+    @mock.patch("calibre.db.legacy.LibraryDatabase.import_book")
+    @mock.patch("webserver.handlers.scan.Scanner.allow_backgrounds")
+    def test_resume_import(self, m2, m1):
+        m1.return_value = 1008610086
+        m2.return_value = False
+        req = {"hashlist": "all"}
+        d = self.json("/api/admin/import/run", method="POST", body=json.dumps(req))
+        self.assertEqual(d["err"], "import.running")
+
+        task = self.session.query(ScanTask).filter(ScanTask.run_id == self.IMPORT_ID).one()
+        self.assertEqual(task.status, ScanTask.DONE)
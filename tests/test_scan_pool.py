@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from webserver import models
+from webserver.book_hash import data_sha256
+from webserver.handlers.scan import RESUMED, MetadataPool, Scanner, link_file
+from webserver.models import ScanFile, ScanTask
+
+
+def fake_reader(fpath, fmt):
+    if fpath == "hang":
+        time.sleep(60)
+    if fpath == "bad":
+        raise ValueError("bad file")
+    return {"title": fpath}, None
+
+
+class FakePool(MetadataPool):
+    reader = staticmethod(fake_reader)
+
+
+class TestMetadataPool(unittest.TestCase):
+    def test_run(self):
+        tasks = [(i, "book-%d" % i, "epub") for i in range(10)]
+        pool = FakePool(workers=3, timeout=10)
+        results = dict((key, data) for key, data, cover in pool.run(tasks))
+        self.assertEqual(len(results), 10)
+        self.assertEqual(results[3], {"title": "book-3"})
+
+    def test_bad_file(self):
+        tasks = [(1, "bad", "pdf"), (2, "good", "pdf")]
+        pool = FakePool(workers=2, timeout=10)
+        results = dict((key, data) for key, data, cover in pool.run(tasks))
+        self.assertEqual(results, {1: None, 2: {"title": "good"}})
+
+    def test_timeout(self):
+        tasks = [(1, "hang", "pdf")] + [(i, "book-%d" % i, "epub") for i in range(2, 6)]
+        pool = FakePool(workers=2, timeout=2)
+        t = time.time()
+        results = dict((key, data) for key, data, cover in pool.run(tasks))
+        self.assertLess(time.time() - t, 30)
+        self.assertEqual(results[1], None)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[5], {"title": "book-5"})
+
+    def test_timeout_kills_worker(self):
+        # 卡住的子进程要被结束，不能一直占用CPU和内存
+        pool = FakePool(workers=1, timeout=2)
+        killed = []
+        kill_executor = pool.kill_executor
+        with mock.patch.object(pool, "kill_executor", side_effect=lambda e: killed.extend(kill_executor(e))):
+            results = dict((key, data) for key, data, cover in pool.run([(1, "hang", "pdf"), (2, "good", "pdf")]))
+        self.assertEqual(results, {1: None, 2: {"title": "good"}})
+        self.assertEqual(len(killed), 1)
+        for i in range(50):
+            if not is_running(killed[0]):
+                break
+            time.sleep(0.1)
+        self.assertFalse(is_running(killed[0]))
+
+
+def is_running(pid):
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            return f.read().split(") ")[-1][0] != "Z"
+    except OSError:
+        return False
+
+
+class TestLinkFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, "src.epub")
+        with open(self.src, "wb") as f:
+            f.write(b"book content")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_auto(self):
+        dst = os.path.join(self.tmpdir.name, "dst.epub")
+        self.assertTrue(link_file(self.src, dst, "auto"))
+        with open(dst, "rb") as f:
+            self.assertEqual(f.read(), b"book content")
+
+    def test_hardlink(self):
+        dst = os.path.join(self.tmpdir.name, "dst.epub")
+        self.assertTrue(link_file(self.src, dst, "hardlink"))
+        self.assertTrue(os.path.samefile(self.src, dst))
+
+    def test_copy(self):
+        dst = os.path.join(self.tmpdir.name, "dst.epub")
+        self.assertFalse(link_file(self.src, dst, "copy"))
+        self.assertFalse(os.path.exists(dst))
+
+
+class TestImportBatch(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        models.Base.metadata.create_all(engine)
+        self.ScopedSession = scoped_session(sessionmaker(bind=engine))
+        self.scanner = Scanner(None, self.ScopedSession)
+        self.session = self.scanner.session
+        self.rows = []
+        for i in range(3):
+            row = ScanFile("/data/book-%d.epub" % i, "sha256:%d" % i, 1)
+            row.status = ScanFile.READY
+            self.session.add(row)
+            self.rows.append(row)
+        self.session.commit()
+
+    def tearDown(self):
+        self.ScopedSession.remove()
+
+    def import_row(self, row):
+        if row is self.rows[-1]:
+            # 与其他记录的哈希重复，使整批提交失败
+            row.hash = self.rows[0].hash
+            return None
+        row.status = ScanFile.IMPORTED
+        row.book_id = 100 + row.id
+        item = models.Item()
+        item.book_id = row.book_id
+        return item
+
+    def test_batch_commit_failed(self):
+        with mock.patch.object(self.scanner, "import_row", side_effect=self.import_row):
+            self.scanner.import_batch(self.rows)
+
+        # 整批失败后逐条重试，已导入的记录和关联表都要保存下来
+        self.session.expire_all()
+        first, second, bad = self.rows
+        self.assertEqual((first.status, first.book_id), (ScanFile.IMPORTED, 100 + first.id))
+        self.assertEqual((second.status, second.book_id), (ScanFile.IMPORTED, 100 + second.id))
+        self.assertEqual((bad.status, bad.hash), (ScanFile.READY, "sha256:2"))
+        book_ids = set(v for (v,) in self.session.query(models.Item.book_id))
+        self.assertEqual(book_ids, {first.book_id, second.book_id})
+
+    def test_import_file_failed(self):
+        # 放置格式文件失败时，不能在书库中留下空书籍
+        self.scanner.db = mock.Mock()
+        self.scanner.db.import_book.return_value = 7
+        self.scanner.db.add_format.side_effect = IOError("disk full")
+        with mock.patch.object(self.scanner, "can_link_file", return_value=True), mock.patch(
+            "webserver.handlers.scan.place_format", return_value=False
+        ):
+            with self.assertRaises(IOError):
+                self.scanner.import_file(mock.Mock(title="book"), "epub", "/data/book.epub")
+        self.scanner.db.delete_book.assert_called_once_with(7)
+
+
+class TestScanTask(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        engine = create_engine("sqlite://")
+        models.Base.metadata.create_all(engine)
+        self.ScopedSession = scoped_session(sessionmaker(bind=engine))
+        self.scanner = Scanner(None, self.ScopedSession)
+        self.session = self.scanner.session
+
+    def tearDown(self):
+        self.ScopedSession.remove()
+        self.tmpdir.cleanup()
+
+    def test_hash_unreadable_file(self):
+        good = os.path.join(self.tmpdir.name, "good.epub")
+        with open(good, "wb") as f:
+            f.write(b"book content")
+        task = self.scanner.new_task(ScanTask.SCAN, 1, {"path": self.tmpdir.name})
+        rows = [ScanFile(self.tmpdir.name + "/missing.epub", "fstat:1", 1), ScanFile(good, "fstat:2", 1)]
+        self.session.add_all(rows)
+        self.session.commit()
+
+        # 读取失败的文件不能中断任务
+        self.scanner.hash_rows(task)
+        missing, good = rows
+        self.assertEqual(missing.status, ScanFile.DROP)
+        self.assertTrue(missing.data["reason"])
+        self.assertEqual(good.status, ScanFile.NEW)
+        self.assertEqual(good.hash, data_sha256(b"book content"))
+        self.assertEqual(task.count["hash_done"], 2)
+
+    def test_run_resumes_unfinished_task(self):
+        self.scanner.new_task(ScanTask.SCAN, 1, {"path": "/data/old/"})
+        self.scanner.new_task(ScanTask.IMPORT, 1, {"user_id": 1})
+        with mock.patch.object(self.scanner, "allow_backgrounds", return_value=False), mock.patch.object(
+            self.scanner, "do_resume_scan"
+        ) as m1, mock.patch.object(self.scanner, "do_resume_import") as m2:
+            # 继续执行上次的任务，并告知调用方本次的参数没有执行
+            self.assertEqual(self.scanner.run_scan("/data/new/"), RESUMED)
+            self.assertEqual(self.scanner.run_import(["sha256:1"]), RESUMED)
+        self.assertEqual(m1.call_count, 1)
+        self.assertEqual(m2.call_count, 1)
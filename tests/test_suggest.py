@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import unittest
+from unittest import mock
+
+from webserver.catalog import Bitmap
+from webserver.suggest import SuggestIndex
+
+
+class FakeCache:
+    def __init__(self, books):
+        self.books = books
+
+    def all_book_ids(self):
+        return set(self.books.keys())
+
+    def all_field_for(self, field, book_ids):
+        return {book_id: self.books[book_id].get(field, None) for book_id in book_ids}
+
+
+class FakeLibrary:
+    def __init__(self, books):
+        self.new_api = FakeCache(books)
+        self.modified = 1
+
+    def last_modified(self):
+        return self.modified
+
+
+def fake_pinyin_forms(text):
+    forms = {"三体": ("santi", "st"), "刘慈欣": ("liucixin", "lcx")}
+    return forms.get(text, None)
+
+
+class TestSuggest(unittest.TestCase):
+    def setUp(self):
+        self.books = {
+            1: {"title": "三体", "authors": ("刘慈欣",), "series": "地球往事", "tags": ("科幻",)},
+            2: {"title": "Harry Potter", "authors": ("J.K. Rowling",), "tags": ("fantasy", "magic")},
+            3: {"title": "Harry Potter 2", "authors": ("J.K. Rowling",), "tags": ("fantasy",)},
+        }
+        self.db = FakeLibrary(self.books)
+        self.patcher = mock.patch("webserver.suggest.pinyin_forms", fake_pinyin_forms)
+        self.patcher.start()
+        self.index = SuggestIndex(self.db)
+        self.index.refresh()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def names(self, query):
+        return [(x["type"], x["name"]) for x in self.index.suggest(query)]
+
+    def test_prefix(self):
+        self.assertEqual(self.names("harry"), [("title", "Harry Potter"), ("title", "Harry Potter 2")])
+        self.assertEqual(self.names("potter  2"), [("title", "Harry Potter 2")])
+        self.assertEqual(self.names("fa"), [("tags", "fantasy")])
+        self.assertEqual(self.index.suggest("fa")[0]["count"], 2)
+        self.assertEqual(self.index.suggest("harry potter 2")[0]["book_id"], 3)
+        self.assertEqual(self.names("  "), [])
+        self.assertEqual(self.names("zzz"), [])
+
+    def test_pinyin(self):
+        self.assertEqual(self.names("st"), [("title", "三体")])
+        self.assertEqual(self.names("liuci"), [("authors", "刘慈欣")])
+        self.assertEqual(self.names("三"), [("title", "三体")])
+
+    def test_update_book(self):
+        self.books[1]["title"] = "球状闪电"
+        self.books[4] = {"title": "Harry Potter 3", "tags": ("magic",)}
+        self.index.update_book(1)
+        self.index.update_book(4)
+        self.assertEqual(self.names("三"), [])
+        self.assertEqual(self.names("球"), [("title", "球状闪电")])
+        self.assertEqual(self.index.suggest("magic")[0]["count"], 2)
+
+        del self.books[2]
+        self.index.update_book(2)
+        self.assertEqual(self.index.suggest("magic")[0]["count"], 1)
+        self.assertEqual(self.names("harry potter"), [("title", "Harry Potter 2"), ("title", "Harry Potter 3")])
+        self.assertEqual(self.index.keys, sorted(self.index.keys))
+
+    def test_refresh(self):
+        self.books[2]["tags"] = ("magic",)
+        self.db.modified = 2
+        self.index.refresh()
+        self.assertEqual(self.index.suggest("fa")[0]["count"], 1)
+        self.assertEqual(self.index.suggest("ma")[0]["count"], 1)
+
+    def test_visible(self):
+        # 受限用户只能看到可见书籍的词条，数量也只统计可见的书籍
+        visible = Bitmap([3])
+        items = self.index.suggest("harry", visible=visible)
+        self.assertEqual([(x["name"], x["count"], x["book_id"]) for x in items], [("Harry Potter 2", 1, 3)])
+        self.assertEqual(self.index.suggest("fa", visible=visible)[0]["count"], 1)
+        self.assertEqual(self.index.suggest("st", visible=visible), [])
+        self.assertEqual(self.index.suggest("liuci", visible=Bitmap()), [])
@@ -2,9 +2,20 @@
 # -*- coding: UTF-8 -*-
 
 
+import datetime
+import sys
 import unittest
+from unittest import mock
 
-from webserver.utils import compare_books_by_rating_or_id
+from webserver.utils import (
+    BookFormatter,
+    SimpleBookFormatter,
+    compare_books_by_rating_or_id,
+    field_sources,
+    group_letter,
+    parse_fields,
+    pinyin_forms,
+)
 
 
 class TestUtils(unittest.TestCase):
@@ -23,3 +34,51 @@ class TestUtils(unittest.TestCase):
         for val, a, b in cases:
             self.assertEqual(val, compare_books_by_rating_or_id(a, b), "compare %s > %s" % (a, b))
             self.assertEqual(-1 * val, compare_books_by_rating_or_id(b, a), "compare %s > %s" % (b, a))
+
+    def test_group_letter(self):
+        self.assertEqual(group_letter("abc"), "A")
+        self.assertEqual(group_letter("  (hello)"), "H")
+        self.assertEqual(group_letter("3体"), "3")
+        self.assertEqual(group_letter(""), "A")
+        with mock.patch("webserver.utils.pinyin_initial") as m:
+            m.return_value = "H"
+            self.assertEqual(group_letter("(韩寒)"), "H")
+            m.assert_called_once_with("韩")
+
+    def test_pinyin_forms(self):
+        self.assertIsNone(pinyin_forms("abc"))
+        fake = mock.Mock()
+        fake.lazy_pinyin.return_value = ["ha", "li", " Potter"]
+        with mock.patch.dict(sys.modules, {"pypinyin": fake}):
+            self.assertEqual(pinyin_forms("哈利 Potter"), ("halipotter", "hlp"))
+
+    def test_parse_fields(self):
+        self.assertIsNone(parse_fields(""))
+        self.assertEqual(parse_fields("title, img,unknown,title"), ["id", "title", "img"])
+        self.assertEqual(field_sources(["id", "img", "author", "count_visit"]), {"timestamp", "authors", "item"})
+
+    def test_format_fields(self):
+        book = {"id": 3, "title": "t", "authors": ["a", "b"], "timestamp": datetime.datetime(2020, 1, 2)}
+        f = SimpleBookFormatter(book, "http://cdn")
+        self.assertEqual(f.format(["id", "author", "unknown"]), {"id": 3, "author": "a, b"})
+        data = f.format(["img", "comments"])
+        self.assertTrue(data["img"].startswith("http://cdn/get/cover/3.jpg?t="))
+        self.assertTrue(data["comments"])
+
+    def test_book_formatter_prefetched(self):
+        handler = mock.Mock(cdn_url="", api_url="/api")
+        handler.is_admin.return_value = False
+        book = {"id": 3, "available_formats": ["EPUB", "PDF", "TXT"]}
+        f = BookFormatter(handler, book, sizes={3: {"EPUB": 100, "PDF": None}}, owned={3})
+        files = f.get_files()
+        self.assertEqual([(x["format"], x["size"]) for x in files], [("EPUB", 100), ("PDF", None)])
+        self.assertEqual(f.get_permissions(), {"is_public": True, "is_owner": True})
+        handler.format_sizes.assert_not_called()
+        handler.is_book_owner.assert_not_called()
+
+        # 未预先读取时逐本查询
+        handler.format_sizes.return_value = {3: {"TXT": 5}}
+        handler.is_book_owner.return_value = False
+        f = BookFormatter(handler, book)
+        self.assertEqual([x["format"] for x in f.get_files()], ["TXT"])
+        self.assertFalse(f.is_owner())
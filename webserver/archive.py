@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os
+import shutil
+import tempfile
+import zipfile
+from contextlib import contextmanager
+
+try:
+    import rarfile
+except ImportError:
+    rarfile = None
+
+# 压缩包内文件的路径形如 /data/books/bundle.zip!/dir/book.epub
+MEMBER_SEP = "!/"
+SPOOL_SIZE = 32 * 1024 * 1024  # 解析元数据时，小于该大小的文件只在内存中处理
+
+
+def archive_openers():
+    openers = {"zip": zipfile.ZipFile}
+    if rarfile:
+        openers["rar"] = rarfile.RarFile
+    return openers
+
+
+def is_archive(fpath):
+    return fpath.split(".")[-1].lower() in archive_openers()
+
+
+def member_path(archive_path, name):
+    return archive_path + MEMBER_SEP + name
+
+
+def split_path(path):
+    """返回(压缩包路径, 成员名)，普通文件的成员名为None"""
+    if MEMBER_SEP not in path:
+        return path, None
+    archive_path, name = path.split(MEMBER_SEP, 1)
+    return archive_path, name
+
+
+def is_member(path):
+    return split_path(path)[1] is not None
+
+
+def open_archive(archive_path, fmt=None):
+    """fmt为压缩格式（zip/rar），默认按扩展名判断"""
+    fmt = fmt or archive_path.split(".")[-1].lower()
+    return archive_openers()[fmt](archive_path)
+
+
+def list_members(archive_path, exts, fmt=None):
+    """列出压缩包中指定格式的文件，返回[(成员名, 文件大小)]，不解压"""
+    members = []
+    with open_archive(archive_path, fmt) as z:
+        for info in z.infolist():
+            if info.is_dir():
+                continue
+            if info.filename.split(".")[-1].lower() not in exts:
+                continue
+            members.append((info.filename, info.file_size))
+    return members
+
+
+@contextmanager
+def open_source(path):
+    """以流的方式打开普通文件或压缩包内的文件（不保证可seek）"""
+    archive_path, name = split_path(path)
+    if name is None:
+        with open(path, "rb") as f:
+            yield f
+        return
+    with open_archive(archive_path) as z:
+        with z.open(name) as f:
+            yield f
+
+
+@contextmanager
+def open_seekable(path):
+    """打开可seek的文件流，压缩包内的文件先解压到内存（过大时落盘到临时文件）"""
+    if not is_member(path):
+        with open(path, "rb") as f:
+            yield f
+        return
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+        with open_source(path) as f:
+            shutil.copyfileobj(f, spool)
+        spool.seek(0)
+        yield spool
+
+
+@contextmanager
+def extract_member(path, tmpdir):
+    """将压缩包内的单个文件解压到tmpdir下的临时文件，用完后删除；普通文件直接返回原路径"""
+    if not is_member(path):
+        yield path
+        return
+    os.makedirs(tmpdir, exist_ok=True)
+    dirpath = tempfile.mkdtemp(dir=tmpdir)
+    fpath = os.path.join(dirpath, os.path.basename(split_path(path)[1]))
+    try:
+        with open_source(path) as src, open(fpath, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        yield fpath
+    finally:
+        shutil.rmtree(dirpath, ignore_errors=True)
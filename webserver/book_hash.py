@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import hashlib
+import logging
+import os
+import threading
+import traceback
+from collections import defaultdict
+
+from webserver.models import BookHash
+
+HASH_PREFIX = "sha256:"
+BLOCK_SIZE = 4096
+
+
+def stream_sha256(stream):
+    sha256 = hashlib.sha256()
+    # Read and update hash string value in blocks of 4K
+    for byte_block in iter(lambda: stream.read(BLOCK_SIZE), b""):
+        sha256.update(byte_block)
+    return HASH_PREFIX + sha256.hexdigest()
+
+
+def file_sha256(fpath):
+    with open(fpath, "rb") as f:
+        return stream_sha256(f)
+
+
+def data_sha256(data):
+    return HASH_PREFIX + hashlib.sha256(data).hexdigest()
+
+
+class BookHashIndex:
+    """书库中每个格式文件的内容哈希索引，用于上传和扫描时精确查重
+
+    索引持久化在bookhashes表中，启动时在后台线程补全缺失的记录；
+    内存中维护 hash => book_id 的映射，查询为O(1)。
+    索引使用独立的session读写，提交或回滚时不影响调用方（接口handler）尚未提交的修改。
+    """
+
+    def __init__(self, calibre_db, ScopedSession):
+        self.db = calibre_db
+        self.func_new_session = ScopedSession.session_factory
+        self.lock = threading.RLock()
+        self.hashes = {}  # hash => book_id
+        self.books = defaultdict(dict)  # book_id => {fmt: hash}
+        self.ready = False
+
+    def start(self):
+        t = threading.Thread(name="build_hash_index", target=self.build)
+        t.setDaemon(True)
+        t.start()
+
+    def load(self):
+        session = self.func_new_session()
+        try:
+            rows = session.query(BookHash).all()
+        finally:
+            session.close()
+        with self.lock:
+            self.hashes.clear()
+            self.books.clear()
+            for row in rows:
+                self.hashes[row.hash] = row.book_id
+                self.books[row.book_id][row.fmt] = row.hash
+
+    def build(self):
+        try:
+            self.load()
+            cache = self.db.new_api
+            all_ids = set(cache.all_book_ids())
+            stale_ids = [book_id for book_id in list(self.books.keys()) if book_id not in all_ids]
+            for book_id in stale_ids:
+                self.delete_book(book_id)
+
+            logging.info("========== start to build book hash index (%d books) ============", len(all_ids))
+            for book_id in sorted(all_ids):
+                for fmt in cache.formats(book_id) or []:
+                    if fmt.lower() in self.books.get(book_id, {}):
+                        continue
+                    self.add_format(book_id, fmt)
+            self.ready = True
+            logging.info("========== book hash index is ready (%d files) ============", len(self.hashes))
+        except:
+            logging.error("Failed to build book hash index:")
+            logging.error(traceback.format_exc())
+
+    def lookup(self, hash_value):
+        return self.hashes.get(hash_value, None)
+
+    def add_format(self, book_id, fmt, fpath=None):
+        fmt = fmt.lower()
+        if fpath is None:
+            fpath = self.db.new_api.format_abspath(book_id, fmt)
+        if not fpath or not os.path.isfile(fpath):
+            return None
+
+        hash_value = file_sha256(fpath)
+        session = self.func_new_session()
+        try:
+            session.query(BookHash).filter(BookHash.book_id == book_id, BookHash.fmt == fmt).delete()
+            session.add(BookHash(book_id, fmt, hash_value, os.path.getsize(fpath)))
+            session.commit()
+        except:
+            logging.error(traceback.format_exc())
+            session.rollback()
+            return None
+        finally:
+            session.close()
+
+        with self.lock:
+            old = self.books[book_id].get(fmt, None)
+            if old and self.hashes.get(old, None) == book_id:
+                del self.hashes[old]
+            self.books[book_id][fmt] = hash_value
+            self.hashes[hash_value] = book_id
+        return hash_value
+
+    def add_book(self, book_id):
+        for fmt in self.db.new_api.formats(book_id) or []:
+            self.add_format(book_id, fmt)
+
+    def delete_book(self, book_id):
+        session = self.func_new_session()
+        try:
+            session.query(BookHash).filter(BookHash.book_id == book_id).delete()
+            session.commit()
+        except:
+            logging.error(traceback.format_exc())
+            session.rollback()
+        finally:
+            session.close()
+
+        with self.lock:
+            for hash_value in self.books.pop(book_id, {}).values():
+                if self.hashes.get(hash_value, None) == book_id:
+                    del self.hashes[hash_value]
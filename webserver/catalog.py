@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import logging
+import threading
+from collections import Counter, defaultdict
+
+from webserver.lru import LRUCache
+from webserver.utils import group_letter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# 支持分面浏览的字段
+FACET_FIELDS = ("formats", "languages", "rating", "tags")
+
+# 列式快照中按数值保存的字段，排序时直接argsort，其余字段使用calibre的ICU排序
+NUMERIC_FIELDS = ("timestamp", "pubdate", "last_modified", "rating", "size", "series_index")
+
+
+class Catalog:
+    """书库的只读索引，按书库版本（metadata.db的修改时间）缓存
+
+    排序索引：对全库预先排好序，保存 book_id => 名次 的映射；
+    对任意书籍集合排序时只需按名次排序，无需重新生成排序key。
+    安装了numpy时，id及NUMERIC_FIELDS各字段保存为按book_id升序对齐的数组（列式快照），
+    名次也是数组，筛选、排序和分页都是向量化操作。
+
+    分类快照：get_categories()的结果，以及各分类下 首字母 => 条目 的分组索引；
+    有限制条件（虚拟书库）时按可见书籍单独统计，去掉没有可见书籍的条目。
+
+    分面快照：FACET_FIELDS 各字段按列保存 book_id => 取值，以及 取值 => book_ids 的倒排索引，
+    用于分面筛选和计数，无需每次查询数据库。安装了numpy时另存 (book_id, 取值编号) 的数组，
+    计数是一次bincount；否则用倒排索引的集合求交集计数。
+
+    搜索缓存：以 (去掉首尾空白的查询, 限制条件, 书库版本) 为key缓存搜索结果的id列表，
+    同一查询并发未命中时只执行一次搜索，其余请求等待结果。
+
+    可见性位图：每个限制条件（虚拟书库）的搜索结果保存为位图；有限制条件的搜索，
+    是无限制搜索的结果与位图按位与，不需要每次重新执行限制条件的搜索。
+
+    以上快照都在锁外构建，构建期间书库版本未变化才保存，锁只保护缓存字典的读写，
+    构建大的快照时不会阻塞其他已命中缓存的查询。
+    """
+
+    def __init__(self, calibre_db, search_cache_size=64 * 1024 * 1024):
+        self.db = calibre_db
+        self.lock = threading.RLock()
+        self.version = None
+        self.orders = {}  # (field, ascending) => (ids, rank, book_ids)
+        self.snapshots = {}  # "arrays" => 列式快照, "facets" => 分面快照
+        self.category_snapshots = {}  # restriction => categories
+        self.letters = {}  # (category, restriction) => {letter: [items]}
+        self.visible_counts = {}  # (field, restriction) => {name: count}
+        self.bitmaps = {}  # restriction => Bitmap
+        self.searches = LRUCache(max_bytes=search_cache_size, sizeof=lambda ids: 8 * len(ids) + 64)
+        self.inflight = {}  # key => [Event, ids, error]
+
+    def check_version(self):
+        version = self.db.last_modified()
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.orders = {}
+                self.snapshots = {}
+                self.category_snapshots = {}
+                self.letters = {}
+                self.visible_counts = {}
+                self.bitmaps = {}
+                self.searches.clear()
+        return version
+
+    def cached(self, name, key, build, *args):
+        """返回缓存字典self.<name>中key的值；未命中时在锁外调用build构建，书库版本未变化才保存"""
+        version = self.check_version()
+        with self.lock:
+            table = getattr(self, name)
+            if key in table:
+                return table[key]
+        value = build(*args)
+        with self.lock:
+            # 构建期间书库有变化时结果可能已过期，只返回给本次调用，不保存；
+            # 并发构建时以先保存的为准，保证各线程拿到同一份快照
+            if self.version == version:
+                value = getattr(self, name).setdefault(key, value)
+        return value
+
+    def sort_fields(self, field, ascending):
+        field = self.db.data.sanitize_sort_field_name(field)
+        if field != "id" and field not in self.db.field_metadata.sortable_field_keys():
+            raise KeyError("%s is not a valid sort field" % field)
+        fields = [(field, ascending)]
+        if field == "series":
+            fields.append(("series_index", ascending))
+        return field, fields
+
+    def sort_order(self, field, ascending=True):
+        """返回全库按field排序后的(ids, rank)
+
+        没有numpy时ids为列表，rank为 book_id => 名次 的字典；
+        有numpy时ids为数组，rank为与列式快照中book_id对齐的名次数组。
+        """
+        return self.sort_index(field, ascending)[:2]
+
+    def sort_index(self, field, ascending):
+        """返回(ids, rank, book_ids)，book_ids为列式快照的id数组（没有numpy时为None）"""
+        field, fields = self.sort_fields(field, ascending)
+        return self.cached("orders", (field, ascending), self.build_order, field, fields, ascending)
+
+    def build_order(self, field, fields, ascending):
+        logging.info("build sort index: %s, ascending=%s", field, ascending)
+        if numpy is not None:
+            return self.array_order(field, fields, ascending)
+        ids = self.list_order(field, fields, ascending)
+        rank = {book_id: n for n, book_id in enumerate(ids)}
+        return ids, rank, None
+
+    def list_order(self, field, fields, ascending):
+        cache = self.db.new_api
+        if field == "id":
+            return sorted(cache.all_book_ids(), reverse=not ascending)
+        if field in NUMERIC_FIELDS:
+            # 与array_order一致：取值相同时按id排列
+            values = cache.all_field_for(field, cache.all_book_ids())
+            return sorted(values, key=lambda book_id: (numeric_value(values[book_id]), book_id), reverse=not ascending)
+        return list(cache.multisort(fields))
+
+    def array_snapshot(self):
+        """列式快照：id及NUMERIC_FIELDS各字段的数组，按book_id升序对齐"""
+        return self.cached("snapshots", "arrays", self.build_arrays)
+
+    def build_arrays(self):
+        logging.info("build column snapshot")
+        cache = self.db.new_api
+        book_ids = sorted(cache.all_book_ids())
+        arrays = {"id": numpy.array(book_ids, dtype=numpy.int64)}
+        for field in NUMERIC_FIELDS:
+            values = cache.all_field_for(field, book_ids)
+            arrays[field] = numpy.array([numeric_value(values[i]) for i in book_ids], dtype=numpy.float64)
+        return arrays
+
+    def array_order(self, field, fields, ascending):
+        arrays = self.array_snapshot()
+        book_ids = arrays["id"]
+        if field == "id" or field in NUMERIC_FIELDS:
+            # 稳定排序，取值相同时按id排列（降序时id也降序）
+            order = numpy.argsort(arrays[field], kind="stable")
+            if not ascending:
+                order = order[::-1]
+        else:
+            sorted_ids = numpy.fromiter(self.db.new_api.multisort(fields), dtype=numpy.int64)
+            order = self.positions(book_ids, sorted_ids)
+        rank = numpy.full(len(book_ids), len(book_ids), dtype=numpy.int64)
+        rank[order] = numpy.arange(len(order))
+        return book_ids[order], rank, book_ids
+
+    def positions(self, book_ids, ids):
+        """返回ids在book_ids（升序数组）中的下标，忽略不存在的id"""
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        if not len(book_ids):
+            return numpy.zeros(0, dtype=numpy.int64)
+        pos = numpy.searchsorted(book_ids, ids)
+        pos[pos >= len(book_ids)] = 0
+        return pos[book_ids[pos] == ids]
+
+    def sort_ids(self, ids, field, ascending=True):
+        """对书籍id集合排序，返回有序的id列表"""
+        return self.sort_page(ids, field, ascending)[1]
+
+    def sort_page(self, ids, field, ascending=True, start=0, count=None):
+        """对书籍id集合排序后分页，返回(总数, 当前页的id列表)；ids为None表示全库"""
+        order, rank, book_ids = self.sort_index(field, ascending)
+        end = None if count is None else start + count
+        if ids is None:
+            return len(order), [int(book_id) for book_id in order[start:end]]
+        if book_ids is not None:
+            return self.array_page(ids, order, rank, book_ids, start, end)
+
+        if not isinstance(ids, (set, frozenset)):
+            ids = set(ids)
+        if len(ids) * 8 > len(order):
+            # 集合较大时直接按全库顺序过滤，O(N)
+            ans = [book_id for book_id in order if book_id in ids]
+        else:
+            missing = len(order)
+            ans = sorted(ids, key=lambda book_id: rank.get(book_id, missing))
+        return len(ans), ans[start:end]
+
+    def array_page(self, ids, order, rank, book_ids, start, end):
+        if not isinstance(ids, numpy.ndarray):
+            ids = numpy.fromiter(ids, dtype=numpy.int64)
+        pos = self.positions(book_ids, ids)
+        if len(pos) * 8 > len(order):
+            # 集合较大时按全库顺序过滤，O(N)
+            mask = numpy.zeros(len(book_ids) + 1, dtype=bool)
+            mask[rank[pos]] = True
+            selected = order[mask[: len(order)]]
+            total = len(selected)
+            page = selected[start:end]
+        else:
+            pos.sort()
+            if len(pos):
+                pos = pos[numpy.append(True, pos[1:] != pos[:-1])]  # 去重
+            total = len(pos)
+            ranks = rank[pos]
+            if end is not None and end < total:
+                # 只需要前end个时用argpartition，避免对整个集合排序
+                top = numpy.argpartition(ranks, end - 1)[:end]
+                ranks = ranks[top]
+                pos = pos[top]
+            page = book_ids[pos[numpy.argsort(ranks, kind="stable")]][start:end]
+        return total, page.tolist()
+
+    def categories(self, restriction=""):
+        """书库所有分类及其条目（只读，不要修改返回值）"""
+        return self.cached("category_snapshots", restriction, self.build_categories, restriction)
+
+    def build_categories(self, restriction):
+        if not restriction:
+            return self.db.get_categories()
+        ids = self.visibility(restriction).ids()
+        categories = self.db.get_categories(ids=ids)
+        return dict((k, items if k == "search" else [t for t in items if t.count]) for k, items in categories.items())
+
+    def letter_index(self, category, restriction=""):
+        """返回分类下条目按首字母的分组 {letter: [items]}，中文按拼音首字母"""
+        return self.cached("letters", (category, restriction), self.build_letters, category, restriction)
+
+    def build_letters(self, category, restriction):
+        groups = defaultdict(list)
+        for item in self.categories(restriction).get(category, []):
+            groups[item_letter(item)].append(item)
+        return dict(groups)
+
+    def category_counts(self, field, restriction):
+        """限制条件下field各取值的可见书籍数量 {name: count}，没有可见书籍的取值不返回"""
+        return self.cached("visible_counts", (field, restriction), self.build_counts, field, restriction)
+
+    def build_counts(self, field, restriction):
+        ids = self.visibility(restriction).ids()
+        counter = Counter()
+        for val in self.db.new_api.all_field_for(field, ids).values():
+            if isinstance(val, (list, tuple, set, frozenset)):
+                counter.update(val)
+            elif val:
+                counter[val] += 1
+        return dict(counter)
+
+    def facet_snapshot(self):
+        """返回(columns, inverted, postings)
+
+        columns: field => {book_id: (values)}
+        inverted: field => {value: set(book_ids)}
+        postings: field => (values, book_ids数组, 取值编号数组)，没有numpy时为None
+        """
+        return self.cached("snapshots", "facets", self.build_facets)
+
+    def build_facets(self):
+        logging.info("build facet snapshot")
+        cache = self.db.new_api
+        book_ids = cache.all_book_ids()
+        columns, inverted = {}, {}
+        for field in FACET_FIELDS:
+            column = {}
+            index = defaultdict(set)
+            for book_id, val in cache.all_field_for(field, book_ids).items():
+                column[book_id] = values = facet_values(field, val)
+                for v in values:
+                    index[v].add(book_id)
+            columns[field] = column
+            inverted[field] = dict(index)
+        postings = None
+        if numpy is not None:
+            postings = dict((field, facet_postings(inverted[field])) for field in FACET_FIELDS)
+        return columns, inverted, postings
+
+    def facet_filter(self, ids, facets):
+        """按[(field, value)]筛选书籍，返回集合"""
+        __, inverted, __ = self.facet_snapshot()
+        ids = set(ids)
+        for field, value in facets:
+            ids &= inverted.get(field, {}).get(value, set())
+        return ids
+
+    def facet_counts(self, ids, field, limit=0):
+        """统计书籍集合中field各取值的书籍数量，按数量降序返回[(value, count)]"""
+        __, inverted, postings = self.facet_snapshot()
+        if postings is not None:
+            counts = self.array_facet_counts(ids, *postings[field])
+        else:
+            if not isinstance(ids, (set, frozenset)):
+                ids = set(ids)
+            counts = [(value, len(ids & book_ids)) for value, book_ids in inverted[field].items()]
+        counts = sorted((c for c in counts if c[1]), key=lambda c: (-c[1], c[0]))
+        return counts[:limit] if limit else counts
+
+    def array_facet_counts(self, ids, values, book_ids, codes):
+        if not len(book_ids):
+            return []
+        if not isinstance(ids, numpy.ndarray):
+            ids = numpy.fromiter(ids, dtype=numpy.int64)
+        mask = numpy.zeros(int(book_ids.max()) + 1, dtype=bool)
+        mask[ids[(ids >= 0) & (ids < len(mask))]] = True
+        counts = numpy.bincount(codes[mask[book_ids]], minlength=len(values))
+        return [(values[n], int(counts[n])) for n in numpy.nonzero(counts)[0]]
+
+    def visibility(self, restriction):
+        """返回限制条件下可见书籍的位图"""
+        return self.cached("bitmaps", restriction, self.build_bitmap, restriction)
+
+    def build_bitmap(self, restriction):
+        logging.info("build visibility bitmap: %s", restriction)
+        return Bitmap(self.db.new_api.search(restriction))
+
+    def search(self, query, restriction=""):
+        """返回搜索结果的id元组（只读）"""
+        version = self.check_version()
+        # 只规范化缓存的key，传给calibre的仍是原始查询；引号和正则中的空白是有意义的，只去掉首尾空白
+        query = query or ""
+        key = (query.strip(), restriction or "", version)
+        ids = self.searches.get(key)
+        if ids is not None:
+            return ids
+        if restriction:
+            return self.single_flight(key, self.restricted_search, query, restriction)
+        return self.single_flight(key, self.library_search, query)
+
+    def library_search(self, query):
+        return tuple(self.db.new_api.search(query))
+
+    def restricted_search(self, query, restriction):
+        return (Bitmap(self.search(query)) & self.visibility(restriction)).ids()
+
+    def single_flight(self, key, compute, *args):
+        """同一key并发未命中时只计算一次，结果放入搜索缓存"""
+        with self.lock:
+            flight = self.inflight.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = [threading.Event(), None, None]
+        if not leader:
+            flight[0].wait()
+            if flight[2] is not None:
+                raise flight[2]
+            return flight[1]
+
+        try:
+            ids = compute(*args)
+            self.searches.put(key, ids)
+            flight[1] = ids
+            return ids
+        except Exception as err:
+            flight[2] = err
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            flight[0].set()
+
+
+class Bitmap:
+    """书籍id的位图，第n位表示id为n的书籍"""
+
+    __slots__ = ("bits",)
+
+    def __init__(self, ids=(), bits=None):
+        if bits is None:
+            ids = list(ids)
+            bits = bytearray((max(ids) >> 3) + 1 if ids else 0)
+            for book_id in ids:
+                bits[book_id >> 3] |= 1 << (book_id & 7)
+        self.bits = bytes(bits)
+
+    def __contains__(self, book_id):
+        n = book_id >> 3
+        return n < len(self.bits) and bool(self.bits[n] >> (book_id & 7) & 1)
+
+    def __and__(self, other):
+        size = min(len(self.bits), len(other.bits))
+        a = int.from_bytes(self.bits[:size], "little")
+        b = int.from_bytes(other.bits[:size], "little")
+        return Bitmap(bits=(a & b).to_bytes(size, "little"))
+
+    def __len__(self):
+        return bin(int.from_bytes(self.bits, "little")).count("1")
+
+    def ids(self):
+        """返回位图中的id元组（升序）"""
+        ans = []
+        for n, byte in enumerate(self.bits):
+            if byte:
+                ans.extend((n << 3) + i for i in range(8) if byte >> i & 1)
+        return tuple(ans)
+
+    def filter(self, ids):
+        """保留ids中在位图里的id，保持原有顺序"""
+        return [book_id for book_id in ids if book_id in self]
+
+
+def facet_values(field, val):
+    if not val:
+        return ()
+    if field == "rating":
+        return (str(int(val)),)
+    if isinstance(val, (list, tuple, set, frozenset)):
+        return tuple(str(v) for v in val)
+    return (str(val),)
+
+
+def facet_postings(index):
+    """把倒排索引 {value: set(book_ids)} 展开为 (values, book_ids数组, 取值编号数组)"""
+    values = tuple(index.keys())
+    book_ids, codes = [], []
+    for code, value in enumerate(values):
+        book_ids.extend(index[value])
+        codes.extend([code] * len(index[value]))
+    return values, numpy.array(book_ids, dtype=numpy.int64), numpy.array(codes, dtype=numpy.int64)
+
+
+def numeric_value(val):
+    if val is None:
+        return float("-inf")
+    if hasattr(val, "timestamp"):
+        try:
+            return val.timestamp()
+        except (OverflowError, ValueError, OSError):
+            return float("-inf")
+    return float(val)
+
+
+def item_letter(item):
+    return group_letter(getattr(item, "sort", item.name) or "A")
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from webserver import loader
+
+CONF = loader.get_settings()
+
+# 接口中阻塞的calibre和SQLAlchemy调用放到线程池中执行，避免阻塞IOLoop
+READER = "reader"  # 读取书库（搜索、列表、详情），多线程并发
+WRITER = "writer"  # 修改书库（编辑、上传、删除），单线程依次执行
+USERDB = "userdb"  # 只操作用户数据库的接口（登录、消息、设置等）
+
+_pools = {}
+_lock = threading.Lock()
+
+
+def pool_size(name):
+    if name == WRITER:
+        return 1
+    try:
+        return max(1, int(CONF[name + "_threads"]))
+    except:
+        return 4
+
+
+def get_executor(name):
+    """返回指定用途的线程池，首次使用时创建"""
+    with _lock:
+        if name not in _pools:
+            _pools[name] = ThreadPoolExecutor(max_workers=pool_size(name), thread_name_prefix=name)
+        return _pools[name]
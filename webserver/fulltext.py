@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import html
+import logging
+import os
+import posixpath
+import queue
+import re
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import traceback
+import urllib.request
+import zipfile
+from xml.etree import ElementTree
+
+from webserver import loader
+from webserver.book_hash import file_sha256
+
+CONF = loader.get_settings()
+
+# 按优先级选取一个格式抽取正文
+FULLTEXT_FORMATS = ("txt", "epub", "azw3", "mobi")
+MAX_CHARS = 10 * 1024 * 1024  # 单本书最多索引的字符数
+SYNC_INTERVAL = 60  # 检查书库变化的间隔（秒）
+
+# 中日韩文字没有空格分词，按相邻两字（bigram）切分后交给FTS5的unicode61分词器
+CJK_RUN = re.compile("([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+)")
+HTML_DROP = re.compile(r"<(script|style|head)\b.*?</\1\s*>", re.I | re.S)
+HTML_TAG = re.compile(r"<[^>]+>")
+SPACES = re.compile(r"\s+")
+
+# snippet中标记命中位置的字符，输出前替换为<b></b>
+MARK_BEGIN = "\ue000"
+MARK_END = "\ue001"
+
+# token之间的分隔符（不可见字符，unicode61视为分隔符），还原文本时直接去掉
+SEP = "\u2063"
+
+
+def bigrams(run):
+    if len(run) == 1:
+        return [run]
+    return [run[i : i + 2] for i in range(len(run) - 1)]
+
+
+def tokenize(text):
+    """把中日韩文字转为以SEP分隔的bigram，其他文本保持原样"""
+    parts = []
+    for n, part in enumerate(CJK_RUN.split(text)):
+        if n % 2:
+            parts += bigrams(part)
+        elif part:
+            parts.append(part)
+    return SEP.join(parts)
+
+
+def untokenize(text):
+    """把tokenize()后的文本（可能带有命中标记）还原为原文"""
+    words = []
+    prev = ""
+    for tok in text.split(SEP):
+        bare = tok.replace(MARK_BEGIN, "").replace(MARK_END, "")
+        if len(bare) == 2 and CJK_RUN.fullmatch(bare) and CJK_RUN.fullmatch(prev) and prev[-1] == bare[0]:
+            # 相邻的bigram有一个字重叠，只追加后一个字
+            i = tok.index(bare[0])
+            last = words[-1]
+            if MARK_BEGIN in tok[:i]:
+                if last.endswith(MARK_END):
+                    last = last[: -len(MARK_END)]  # 相邻的两段高亮合并为一段
+                else:
+                    last = last[:-1] + MARK_BEGIN + last[-1]
+            words[-1] = last + tok[i + 1 :]
+        else:
+            words.append(tok)
+        prev = bare
+    return "".join(words)
+
+
+def match_query(query):
+    """把用户输入转换为FTS5查询：各关键字之间为AND，中文词语转为bigram短语"""
+    terms = []
+    for word in query.split():
+        text = tokenize(word)
+        if not text:
+            continue
+        phrase = '"%s"' % text.replace('"', '""')
+        if len(word) == 1 and CJK_RUN.fullmatch(word):
+            # 单个汉字只能按前缀匹配bigram
+            phrase += "*"
+        terms.append(phrase)
+    return " ".join(terms)
+
+
+def html_to_text(data):
+    text = HTML_DROP.sub(" ", data)
+    text = HTML_TAG.sub(" ", text)
+    return SPACES.sub(" ", html.unescape(text))
+
+
+def decode_text(data):
+    for encoding in ("utf-8", "gb18030"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    return data.decode("utf-8", errors="ignore")
+
+
+def epub_documents(z):
+    """按spine顺序返回epub中的正文文件名"""
+    try:
+        container = ElementTree.fromstring(z.read("META-INF/container.xml"))
+        opf_path = next(e.get("full-path") for e in container.iter() if e.tag.endswith("rootfile"))
+        opf = ElementTree.fromstring(z.read(opf_path))
+        base = posixpath.dirname(opf_path)
+        manifest = {e.get("id"): e.get("href") for e in opf.iter() if e.tag.endswith("}item")}
+        spine = [e.get("idref") for e in opf.iter() if e.tag.endswith("itemref")]
+        return [posixpath.join(base, manifest[i]) for i in spine if i in manifest]
+    except Exception:
+        return sorted(n for n in z.namelist() if n.lower().endswith((".html", ".xhtml", ".htm")))
+
+
+def extract_epub(fpath):
+    parts = []
+    size = 0
+    with zipfile.ZipFile(fpath) as z:
+        names = set(z.namelist())
+        for name in epub_documents(z):
+            if name not in names:
+                continue
+            text = html_to_text(decode_text(z.read(name)))
+            parts.append(text)
+            size += len(text)
+            if size >= MAX_CHARS:
+                break
+    return "\n".join(parts)
+
+
+def extract_with_calibre(fpath):
+    """其他格式用ebook-convert转换为txt"""
+    timeout = 300
+    try:
+        timeout = int(CONF["convert_timeout"])
+    except:
+        pass
+    with tempfile.TemporaryDirectory() as tmpdir:
+        out = os.path.join(tmpdir, "book.txt")
+        args = ["ebook-convert", fpath, out]
+        try:
+            subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logging.info("ebook-convert timeout: %s" % fpath)
+            return ""
+        if not os.path.exists(out):
+            return ""
+        with open(out, "rb") as f:
+            return decode_text(f.read(MAX_CHARS * 4))
+
+
+def extract_text(fpath, fmt):
+    if fmt == "txt":
+        with open(fpath, "rb") as f:
+            return decode_text(f.read(MAX_CHARS * 4))
+    if fmt == "epub":
+        return extract_epub(fpath)
+    return extract_with_calibre(fpath)
+
+
+class FulltextIndex:
+    """书籍正文的全文索引，保存在独立的SQLite FTS5数据库中
+
+    每本书按 FULLTEXT_FORMATS 的优先级选取一个格式抽取正文，记录所用文件的哈希；
+    启动时全量比对一次书库，之后只根据书籍ID的增减、以及notify()通知的书籍更新索引。
+    """
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, book_id INTEGER UNIQUE, fmt TEXT, hash TEXT)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS fulltext USING fts5(body, tokenize='unicode61 remove_diacritics 2')",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    ]
+
+    def __init__(self, calibre_db, path, hash_index=None):
+        self.db = calibre_db
+        self.path = path
+        self.hash_index = hash_index
+        self.local = threading.local()
+        self.queue = queue.Queue()
+        self.version = None
+        self.synced = False
+        self.book_ids = set()  # 上次同步时书库中的书籍ID
+        self.readonly = False
+
+    @property
+    def ready(self):
+        """首次同步完成后才可以查询；读进程每次查询时读取写进程记录的同步状态"""
+        if not self.readonly:
+            return self.synced
+        try:
+            row = self.connect().execute("SELECT value FROM meta WHERE key = 'synced'").fetchone()
+        except sqlite3.Error:
+            return False
+        return row is not None
+
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            if self.readonly:
+                # 只读打开，不执行建表等写操作；写进程尚未建立索引文件时会失败
+                uri = "file:%s?mode=ro" % urllib.request.pathname2url(os.path.abspath(self.path))
+                conn = sqlite3.connect(uri, uri=True, timeout=30)
+            else:
+                conn = sqlite3.connect(self.path, timeout=30)
+                conn.execute("PRAGMA journal_mode=WAL")
+                for sql in self.SCHEMA:
+                    conn.execute(sql)
+                conn.commit()
+            self.local.conn = conn
+        return conn
+
+    def start(self):
+        t = threading.Thread(name="build_fulltext_index", target=self.run)
+        t.setDaemon(True)
+        t.start()
+
+    def attach(self):
+        """多进程模式下的读进程只查询写进程建立的索引，不在本进程中建立"""
+        self.readonly = True
+
+    def run(self):
+        try:
+            dirpath = os.path.dirname(self.path)
+            if dirpath:
+                os.makedirs(dirpath, exist_ok=True)
+            # 上次运行留下的同步标记作废，本次同步完成前读进程不能查询
+            with self.connect() as conn:
+                conn.execute("DELETE FROM meta WHERE key = 'synced'")
+        except:
+            logging.error("Failed to open fulltext index %s:", self.path)
+            logging.error(traceback.format_exc())
+            return
+
+        while True:
+            try:
+                version = self.db.last_modified()
+                if not self.synced:
+                    self.sync()
+                    self.version = version
+                    self.mark_synced()
+                elif version != self.version:
+                    self.sync_changes()
+                    self.version = version
+                book_id = self.queue.get(timeout=SYNC_INTERVAL)
+                self.update_book(book_id)
+            except queue.Empty:
+                pass
+            except:
+                logging.error(traceback.format_exc())
+
+    def mark_synced(self):
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('synced', ?)", (str(self.version),))
+        self.synced = True
+
+    def notify(self, book_id):
+        """书籍的格式文件变化后调用，在后台重建该书的索引"""
+        self.queue.put(book_id)
+
+    def indexed(self):
+        rows = self.connect().execute("SELECT book_id, hash FROM docs").fetchall()
+        return dict(rows)
+
+    def sync(self):
+        cache = self.db.new_api
+        all_ids = set(cache.all_book_ids())
+        indexed = self.indexed()
+        for book_id in set(indexed) - all_ids:
+            self.delete_book(book_id)
+
+        logging.info("========== start to sync fulltext index (%d books) ============", len(all_ids))
+        count = 0
+        for book_id in sorted(all_ids):
+            fmt, fpath, hash_value = self.pick_format(book_id)
+            if indexed.get(book_id, None) == hash_value:
+                continue
+            self.index_book(book_id, fmt, fpath, hash_value)
+            count += 1
+        self.book_ids = all_ids
+        logging.info("========== fulltext index is ready (%d books updated) ============", count)
+
+    def sync_changes(self):
+        """只处理新增和删除的书籍，格式文件的变化由notify()通知"""
+        all_ids = set(self.db.new_api.all_book_ids())
+        for book_id in self.book_ids - all_ids:
+            self.delete_book(book_id)
+        for book_id in sorted(all_ids - self.book_ids):
+            self.update_book(book_id)
+        self.book_ids = all_ids
+
+    def pick_format(self, book_id):
+        """返回(格式, 文件路径, 文件哈希)，没有可索引的格式时全部为None"""
+        cache = self.db.new_api
+        formats = [f.lower() for f in cache.formats(book_id) or []]
+        for fmt in FULLTEXT_FORMATS:
+            if fmt not in formats:
+                continue
+            fpath = cache.format_abspath(book_id, fmt)
+            if not fpath or not os.path.isfile(fpath):
+                continue
+            hash_value = None
+            if self.hash_index:
+                hash_value = self.hash_index.books.get(book_id, {}).get(fmt, None)
+            return fmt, fpath, hash_value or file_sha256(fpath)
+        return None, None, None
+
+    def update_book(self, book_id):
+        fmt, fpath, hash_value = self.pick_format(book_id)
+        row = self.connect().execute("SELECT hash FROM docs WHERE book_id = ?", (book_id,)).fetchone()
+        if row and row[0] == hash_value:
+            return
+        self.index_book(book_id, fmt, fpath, hash_value)
+
+    def index_book(self, book_id, fmt, fpath, hash_value):
+        if fmt is None:
+            self.delete_book(book_id)
+            return
+        try:
+            text = extract_text(fpath, fmt)[:MAX_CHARS]
+        except:
+            logging.error("Failed to extract text from %s:", fpath)
+            logging.error(traceback.format_exc())
+            text = ""
+
+        conn = self.connect()
+        with conn:
+            self.delete_rows(conn, book_id)
+            cur = conn.execute("INSERT INTO docs (book_id, fmt, hash) VALUES (?, ?, ?)", (book_id, fmt, hash_value))
+            # 抽取失败的书也记录哈希，文件不变就不再重试
+            if text:
+                conn.execute("INSERT INTO fulltext (rowid, body) VALUES (?, ?)", (cur.lastrowid, tokenize(text)))
+
+    def delete_book(self, book_id):
+        conn = self.connect()
+        with conn:
+            self.delete_rows(conn, book_id)
+
+    def delete_rows(self, conn, book_id):
+        conn.execute("DELETE FROM fulltext WHERE rowid IN (SELECT id FROM docs WHERE book_id = ?)", (book_id,))
+        conn.execute("DELETE FROM docs WHERE book_id = ?", (book_id,))
+
+    def search(self, query, limit=100, snippet_size=32, visible=None):
+        """返回按相关度排序的[(book_id, snippet)]，snippet中命中的词用<b></b>标出
+
+        visible为可见书籍的位图（None表示不受限制），在查询中过滤，受限用户也能拿到limit条结果。
+        """
+        expr = match_query(query)
+        if not expr:
+            return []
+        conn = self.connect()
+        where = "fulltext MATCH ?"
+        if visible is not None:
+            # 连接按线程区分，每次查询重新注册当前用户的过滤函数
+            conn.create_function("book_visible", 1, lambda book_id: book_id in visible)
+            where += " AND book_visible(docs.book_id)"
+        sql = """SELECT docs.book_id, snippet(fulltext, 0, ?, ?, '...', ?)
+        FROM fulltext JOIN docs ON docs.id = fulltext.rowid
+        WHERE %s ORDER BY rank LIMIT ?""" % where
+        rows = conn.execute(sql, (MARK_BEGIN, MARK_END, snippet_size, expr, limit)).fetchall()
+        return [(book_id, format_snippet(snippet)) for book_id, snippet in rows]
+
+
+def format_snippet(snippet):
+    text = html.escape(untokenize(snippet))
+    return text.replace(MARK_BEGIN, "<b>").replace(MARK_END, "</b>")
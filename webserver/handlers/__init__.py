@@ -8,15 +8,19 @@ def routes():
     from . import meta
     from . import files
     from . import opds
+    from . import opds2
     from . import admin
     from . import scan
+    from . import batch
 
     routes = []
     routes += admin.routes()
     routes += scan.routes()
     routes += opds.routes()
+    routes += opds2.routes()
     routes += book.routes()
     routes += user.routes()
     routes += meta.routes()
     routes += files.routes()
+    routes += batch.routes()
     return routes
@@ -72,7 +72,8 @@ class AdminUsers(BaseHandler):
                 if attr.startswith("can_"):
                     d[attr] = getattr(user, attr)()
             items.append(d)
-        return {"err": "ok", "users": {"items": items, "total": total}}
+        libraries = sorted(self.virtual_libraries().keys())
+        return {"err": "ok", "users": {"items": items, "total": total}, "libraries": libraries}
 
     @js
     @auth
@@ -111,6 +112,17 @@ class AdminUsers(BaseHandler):
             return {"err": "params.permission.invalid", "msg": _(u"权限参数不对")}
         if p:
             user.set_permission(p)
+
+        # 限制用户只能看到某个虚拟书库，或者符合搜索条件的书籍
+        for key in ("virtual_library", "library_query"):
+            if key not in data:
+                continue
+            val = data[key]
+            if not isinstance(val, str):
+                return {"err": "params.invalid", "msg": _(u"虚拟书库参数错误")}
+            if key == "virtual_library" and val and val not in self.virtual_libraries():
+                return {"err": "params.invalid", "msg": _(u"虚拟书库不存在")}
+            user.extra[key] = val
         user.save()
         return {"err": "ok"}
 
@@ -259,11 +271,16 @@ class AdminSettings(BaseHandler):
             "settings_path",
             "avatar_service",
             "google_analytics_id",
+            "virtual_libraries",
         ]
 
         args = loader.SettingsLoader()
         args.clear()
 
+        libraries = data.get("virtual_libraries", {})
+        if not isinstance(libraries, dict) or not all(isinstance(v, str) for v in libraries.values()):
+            return {"err": "params.invalid", "msg": _(u"虚拟书库参数错误")}
+
         for key, val in data.items():
             if key.startswith("SOCIAL_AUTH"):
                 if key.endswith("_KEY") or key.endswith("_SECRET"):
@@ -450,20 +467,17 @@ class AdminBookList(BaseHandler):
         search = self.get_argument("search", "")
         logging.debug("num=%d, page=%d, sort=%s, desc=%s" % (num, page, sort, desc))
 
-        self.db.sort(field=sort, ascending=(not desc))
-        start = page * num
-        end = start + num
-        all_ids = list(self.cache.search(search))
-        total = len(all_ids)
-
-        # sort by id
-        if sort == "id":
-            all_ids.sort(reverse=desc)
+        all_ids = self.catalog.search(search)
+        try:
+            total, page_ids = self.catalog.sort_page(all_ids, sort, not desc, page * num, num)
+        except KeyError:
+            return {"err": "params.invalid", "msg": _(u"不支持按该字段排序")}
 
         books = []
-        page_ids = all_ids[start:end]
         if page_ids:
-            books = [SimpleBookFormatter(b, self.cdn_url).format() for b in self.get_books(ids=page_ids)]
+            fields = self.get_argument_fields()
+            books = self.get_page_books(page_ids, fields)
+            books = [SimpleBookFormatter(b, self.cdn_url).format(fields) for b in books]
 
         return {"err": "ok", "items": books, "total": total}
 
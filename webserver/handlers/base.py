@@ -3,8 +3,11 @@
 
 
 import base64
+import contextlib
 import datetime
+import functools
 import hashlib
+import inspect
 import logging
 import os
 import time
@@ -13,15 +16,16 @@ from gettext import gettext as _
 
 from jinja2 import Environment, FileSystemLoader
 from sqlalchemy import func as sql_func
-from tornado import web
+from tornado import ioloop, web
 
-from webserver import loader, utils
+from webserver import executors, loader, prefork, utils
 
 # import social_tornado.handlers
 from webserver.models import Item, Message, Reader
 
 messages = defaultdict(list)
 CONF = loader.get_settings()
+NO_BOOKS = "id:<0"  # 不匹配任何书籍的搜索条件
 
 
 def day_format(value, format="%Y-%m-%d"):
@@ -46,9 +50,15 @@ def website_format(value):
 
 
 def js(func):
-    def do(self, *args, **kwargs):
+    """返回JSON的接口：普通函数在线程池中执行（见BaseHandler.run_blocking），async函数在IOLoop中执行"""
+
+    @functools.wraps(func)
+    async def do(self, *args, **kwargs):
         try:
-            rsp = func(self, *args, **kwargs)
+            if inspect.iscoroutinefunction(func):
+                rsp = await func(self, *args, **kwargs)
+            else:
+                rsp = await self.run_blocking(func, self, *args, **kwargs)
             rsp["msg"] = rsp.get("msg", "")
         except Exception as e:
             import traceback
@@ -94,6 +104,13 @@ def is_admin(func):
 class BaseHandler(web.RequestHandler):
     _path_to_env = {}
 
+    # 执行POST等非GET接口的线程池，见executors；GET请求总是用READER，默认为USERDB，修改书库的接口应设为WRITER
+    executor = None
+
+    # 多进程模式下只能在写进程中处理的接口（会修改书库、或依赖写进程中的任务状态），
+    # executor为WRITER的POST等请求也总是转发给写进程
+    writer_process = False
+
     def get_secure_cookie(self, key):
         if not self.cookies_cache.get(key, ""):
             self.cookies_cache[key] = super(BaseHandler, self).get_secure_cookie(key)
@@ -139,6 +156,17 @@ class BaseHandler(web.RequestHandler):
         self.set_status(200)
         raise web.Finish()
 
+    def can_download(self):
+        """检查下载权限；访客需要登录时返回False，由调用方决定跳转或要求认证"""
+        if not CONF["ALLOW_GUEST_DOWNLOAD"] and not self.current_user:
+            return False
+        if self.current_user:
+            if not self.current_user.can_save():
+                raise web.HTTPError(403, reason=_(u"无权操作"))
+            if not self.current_user.is_active():
+                raise web.HTTPError(403, reason=_(u"无权操作，请先登录注册邮箱激活账号。"))
+        return True
+
     def should_be_invited(self):
         if self.need_invited():
             if not self.invited_code_is_ok():
@@ -164,7 +192,22 @@ class BaseHandler(web.RequestHandler):
             self.api_url = self.request.protocol + "://" + host
             self.cdn_url = self.request.protocol + "://" + CONF["static_host"]
 
-    def prepare(self):
+    def should_forward_to_writer(self):
+        """多进程模式下，是否需要转发给写进程处理"""
+        worker = self.settings["worker"]
+        if worker is None or worker.is_writer:
+            return False
+        if self.writer_process:
+            return True
+        return self.executor == executors.WRITER and self.request.method not in ("GET", "HEAD")
+
+    async def prepare(self):
+        if self.should_forward_to_writer():
+            await prefork.proxy_to_writer(self, self.settings["worker"])
+            return
+        if self.settings["library_watcher"]:
+            self.settings["library_watcher"].check()
+
         self.set_hosts()
         self.set_i18n()
         self.process_auth_header()
@@ -187,6 +230,10 @@ class BaseHandler(web.RequestHandler):
         self.session = ScopedSession()  # new sql session
         self.db = self.settings["legacy"]
         self.cache = self.db.new_api
+        self.hash_index = self.settings["hash_index"]
+        self.catalog = self.settings["catalog"]
+        self.fulltext = self.settings["fulltext"]
+        self.suggest = self.settings["suggest"]
         self.build_time = self.settings["build_time"]
         self.default_cover = self.settings["default_cover"]
         self.admin_user = None
@@ -196,6 +243,36 @@ class BaseHandler(web.RequestHandler):
         ScopedSession = self.settings["ScopedSession"]
         ScopedSession.remove()
 
+    async def run_blocking(self, func, *args, **kwargs):
+        """在线程池中执行阻塞的函数
+
+        ScopedSession按线程区分，任务中的self.session和当前用户都改为所在线程的session，
+        任务结束后释放，避免并发的请求共用同一个session。
+        """
+        name = executors.READER
+        if self.request.method not in ("GET", "HEAD"):
+            name = self.executor or executors.USERDB
+        ScopedSession = self.settings["ScopedSession"]
+        session = self.session
+        watcher = self.settings["library_watcher"]
+
+        def run():
+            self.session = ScopedSession()
+            # 当前用户可能已在IOLoop线程的session中读取过，在本线程重新读取
+            self.__dict__.pop("_current_user", None)
+            self.admin_user = None
+            try:
+                # 读进程重新加载书库期间等待，不查询加载了一半的calibre缓存
+                with watcher.reading() if watcher else contextlib.nullcontext():
+                    return func(*args, **kwargs)
+            finally:
+                ScopedSession.remove()
+
+        try:
+            return await ioloop.IOLoop.current().run_in_executor(executors.get_executor(name), run)
+        finally:
+            self.session = session
+
     def static_url(self, path, **kwargs):
         if path.endswith("/"):
             prefix = self.settings.get("static_url_prefix", "/static/")
@@ -377,7 +454,7 @@ class BaseHandler(web.RequestHandler):
         self.write(self.render_string(template, **vals))
 
     def get_book(self, book_id):
-        books = self.get_books(ids=[int(book_id)])
+        books = self.get_books(ids=[int(book_id)]) if self.is_visible(book_id) else []
         if not books:
             self.write({"err": "not_found", "msg": _(u"抱歉，这本书不存在")})
             self.set_status(200)
@@ -385,14 +462,45 @@ class BaseHandler(web.RequestHandler):
         return books[0]
 
     def is_book_owner(self, book_id, user_id):
+        return int(book_id) in self.owned_books([int(book_id)], user_id)
+
+    def owned_books(self, book_ids, user_id):
+        """一次查询返回book_ids中由user_id上传的书籍"""
+        book_ids = list(book_ids)
         auto = int(CONF.get("auto_login", 0))
         if auto:
-            return True
+            return set(book_ids)
+        if not book_ids:
+            return set()
 
-        query = self.session.query(Item)
-        query = query.filter(Item.book_id == book_id)
+        query = self.session.query(Item.book_id)
+        query = query.filter(Item.book_id.in_(book_ids))
         query = query.filter(Item.collector_id == user_id)
-        return query.count() > 0
+        return {book_id for (book_id,) in query}
+
+    def format_sizes(self, books):
+        """一次读取多本书各格式文件的大小 book_id => {fmt: size}"""
+        cache = self.cache
+        sizes = {}
+        for book in books:
+            book_sizes = sizes[book["id"]] = {}
+            for fmt in book.get("available_formats", None) or []:
+                try:
+                    book_sizes[fmt] = cache.format_metadata(book["id"], fmt).get("size", None)
+                except:
+                    continue
+        return sizes
+
+    def format_books(self, books, with_files=False, with_perms=False, fields=None):
+        """格式化多本书，文件大小和上传者权限统一预先读取"""
+        sizes = self.format_sizes(books) if with_files else None
+        owned = None
+        if with_perms and not self.is_admin():
+            owned = self.owned_books([b["id"] for b in books], self.user_id())
+        return [
+            utils.BookFormatter(self, b, sizes=sizes, owned=owned).format(with_files, with_perms, fields)
+            for b in books
+        ]
 
     def get_books(self, *args, **kwargs):
         _ts = time.time()
@@ -400,7 +508,14 @@ class BaseHandler(web.RequestHandler):
         logging.debug(
             "[%5d ms] select books from library  (count = %d)" % (int(1000 * (time.time() - _ts)), len(books))
         )
+        self.fill_items(books)
+        logging.debug(
+            "[%5d ms] select books from database (count = %d)" % (int(1000 * (time.time() - _ts)), len(books))
+        )
+        return books
 
+    def fill_items(self, books):
+        """填充访问、下载计数和上传者等数据"""
         item = Item()
         empty_item = item.to_dict()
         empty_item["collector"] = self.session.query(Reader).order_by(Reader.id).first()
@@ -414,11 +529,50 @@ class BaseHandler(web.RequestHandler):
             maps[b.book_id] = d
         for book in books:
             book.update(maps.get(book["id"], empty_item))
+
+    def get_books_fields(self, ids, fields):
+        """只读取输出fields所需的字段，按ids的顺序返回书籍
+
+        get_data_as_dict会遍历整个书库，并为每本书读取全部字段和格式文件路径；
+        列表页只需要少数几个字段时，直接按字段批量读取要快得多。
+        """
+        from calibre.utils.date import as_local_time
+
+        _ts = time.time()
+        cache = self.cache
+        ids = [book_id for book_id in ids if cache.has_id(book_id)]
+        books = [{"id": book_id} for book_id in ids]
+        sources = utils.field_sources(fields)
+        for field in sorted(sources - {"item"}):
+            values = cache.all_field_for(field, ids)
+            for book in books:
+                val = values[book["id"]]
+                if val and field in ("timestamp", "pubdate"):
+                    val = as_local_time(val)
+                if field == "identifiers":
+                    book["isbn"] = (val or {}).get("isbn", "")
+                else:
+                    book[field] = val
+        if "item" in sources:
+            self.fill_items(books)
         logging.debug(
-            "[%5d ms] select books from database (count = %d)" % (int(1000 * (time.time() - _ts)), len(books))
+            "[%5d ms] select book fields %s (count = %d)" % (int(1000 * (time.time() - _ts)), sorted(sources), len(books))
         )
         return books
 
+    def get_page_books(self, ids, fields=None):
+        """按ids的顺序返回书籍（get_books按书库视图的顺序返回）"""
+        if fields is not None:
+            return self.get_books_fields(ids, fields)
+        pos = {book_id: n for n, book_id in enumerate(ids)}
+        books = self.get_books(ids=ids)
+        books.sort(key=lambda b: pos[b["id"]])
+        return books
+
+    def get_argument_fields(self):
+        """列表接口的fields=参数，只返回指定的字段"""
+        return utils.parse_fields(self.get_argument("fields", ""))
+
     def count_increase(self, book_id, **kwargs):
         try:
             item = self.session.query(Item).filter(Item.book_id == book_id).one()
@@ -431,20 +585,58 @@ class BaseHandler(web.RequestHandler):
         item.count_download += kwargs.get("count_download", 0)
         item.save()
 
+    def virtual_libraries(self):
+        """虚拟书库 名称 => 搜索条件：calibre书库中定义的虚拟书库，以及配置中的virtual_libraries"""
+        libraries = dict(self.db.prefs.get("virtual_libraries", None) or {})
+        libraries.update(CONF.get("virtual_libraries", None) or {})
+        return libraries
+
+    def library_restriction(self):
+        """当前用户能看到的书籍范围（搜索条件），为空表示整个书库
+
+        用户可以指定一个虚拟书库（多个用户共用），或者单独设置搜索条件；管理员不受限制。
+        """
+        user = self.current_user
+        if not user or self.is_admin():
+            return ""
+        extra = user.extra or {}
+        name = extra.get("virtual_library", "")
+        if name:
+            # 虚拟书库被删除时，不显示任何书籍
+            return self.virtual_libraries().get(name, NO_BOOKS)
+        return extra.get("library_query", "")
+
+    def visible_books(self):
+        """当前用户可见书籍的位图，不受限制时返回None"""
+        restriction = self.library_restriction()
+        return self.catalog.visibility(restriction) if restriction else None
+
+    def filter_visible(self, ids):
+        """保留ids中当前用户可见的书籍，保持原有顺序"""
+        bitmap = self.visible_books()
+        return list(ids) if bitmap is None else bitmap.filter(ids)
+
+    def filter_visible_books(self, books):
+        bitmap = self.visible_books()
+        return books if bitmap is None else [b for b in books if b["id"] in bitmap]
+
+    def is_visible(self, book_id):
+        bitmap = self.visible_books()
+        return bitmap is None or int(book_id) in bitmap
+
     def search_for_books(self, query):
-        self.search_restriction = ""
-        return self.db.search_getting_ids(
-            (query or "").strip(),
-            self.search_restriction,
-            sort_results=False,
-            use_virtual_library=False,
-        )
+        self.search_restriction = self.library_restriction()
+        return self.catalog.search(query, self.search_restriction)
 
     def all_tags_with_count(self):
         sql = """SELECT tags.name, count(distinct book) as count
         FROM tags left join books_tags_link on tags.id = books_tags_link.tag
         group by tags.id"""
         tags = dict((i[0], i[1]) for i in self.cache.backend.conn.get(sql))
+        restriction = self.library_restriction()
+        if restriction:
+            # 受限用户只统计可见的书籍，避免通过数量泄露不可见的书籍
+            tags = self.catalog.category_counts("tags", restriction)
         return tags
 
     def get_category_with_count(self, field):
@@ -460,13 +652,13 @@ class BaseHandler(web.RequestHandler):
         logging.debug(sql)
         rows = self.cache.backend.conn.get(sql)
         items = [{"id": a, "name": b, "count": c} for a, b, c in rows]
+        restriction = self.library_restriction()
+        if restriction:
+            # 受限用户只统计可见的书籍，并去掉没有可见书籍的条目
+            counts = self.catalog.category_counts(field + "s" if field in ["tag", "author"] else field, restriction)
+            items = [dict(item, count=counts[item["name"]]) for item in items if counts.get(item["name"], 0)]
         return items
 
-    def books_by_id(self):
-        sql = "SELECT id FROM books order by id desc"
-        ids = [v[0] for v in self.cache.backend.conn.get(sql)]
-        return ids
-
     def get_argument_start(self):
         start = self.get_argument("start", 0)
         try:
@@ -475,6 +667,14 @@ class BaseHandler(web.RequestHandler):
             start = 0
         return max(0, start)
 
+    def get_argument_size(self, default, maximum):
+        """读取size参数，限制在1到maximum之间，非法时使用默认值"""
+        try:
+            size = int(self.get_argument("size", default))
+        except ValueError:
+            size = default
+        return max(1, min(size, maximum))
+
     def get_path_progress(self, book_id):
         return os.path.join(CONF["progress_path"], "progress-%s.log" % book_id)
 
@@ -528,14 +728,6 @@ class BaseHandler(web.RequestHandler):
 
 
 class ListHandler(BaseHandler):
-    def get_item_books(self, category, name):
-        books = []
-        item_id = self.cache.get_item_id(category, name)
-        if item_id:
-            ids = self.db.get_books_for_category(category, item_id)
-            books = self.db.get_data_as_dict(ids=ids)
-        return books
-
     def do_sort(self, items, field, ascending):
         items.sort(key=lambda x: x[field], reverse=not ascending)
 
@@ -554,22 +746,29 @@ class ListHandler(BaseHandler):
             self.do_sort(items, "id", False)
         return None
 
-    @js
-    def render_book_list(self, all_books, ids=None, title=None, sort_by_id=False):
+    def render_book_list(self, all_books, ids=None, title=None, sort_by=None, ascending=False):
         start = self.get_argument_start()
         try:
             size = int(self.get_argument("size"))
         except:
             size = 60
         delta = min(max(size, 60), 100)
+        fields = self.get_argument_fields()
+
+        if ids:
+            ids = self.filter_visible(ids)
+        else:
+            all_books = self.filter_visible_books(all_books)
 
         if ids:
-            ids = list(ids)
-            count = len(ids)
-            books = self.get_books(ids=ids[start : start + delta])
-            if sort_by_id:
-                # 归一化，按照id从大到小排列。
-                self.do_sort(books, "id", False)
+            if sort_by:
+                # 在排序索引上排序分页，只读取当前页的书籍
+                count, page_ids = self.catalog.sort_page(ids, sort_by, ascending, start, delta)
+            else:
+                ids = list(ids)
+                count = len(ids)
+                page_ids = ids[start : start + delta]
+            books = self.get_page_books(page_ids, fields)
         else:
             count = len(all_books)
             books = all_books[start : start + delta]
@@ -577,8 +776,8 @@ class ListHandler(BaseHandler):
             "err": "ok",
             "title": title,
             "total": count,
-            "books": [self.fmt(b) for b in books],
+            "books": [self.fmt(b, fields) for b in books],
         }
 
-    def fmt(self, b):
-        return utils.BookFormatter(self, b).format()
+    def fmt(self, b, fields=None):
+        return utils.BookFormatter(self, b).format(fields=fields)
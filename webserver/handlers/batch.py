@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import logging
+import traceback
+from gettext import gettext as _
+
+import tornado.escape
+from tornado import httputil, web
+
+from webserver import executors
+from webserver.handlers import book, meta, user
+from webserver.handlers.base import BaseHandler, js
+
+MAX_REQUESTS = 20  # 单次最多的子请求数
+MAX_BOOKS = 100  # 单次最多读取的书籍数
+
+# 可以合并执行的接口：只读、用@js返回JSON的同步函数、不需要转发给写进程
+BATCH_HANDLERS = (
+    book.Index,
+    book.BookDetail,
+    book.BookNav,
+    book.RecentBook,
+    book.SearchBook,
+    book.FulltextSearch,
+    book.Suggest,
+    book.HotBook,
+    meta.MetaList,
+    meta.MetaBooks,
+    user.UserInfo,
+    user.UserMessages,
+)
+
+
+class Batch(BaseHandler):
+    """一次请求执行多个只读接口，并批量读取书籍详情，减少前端（尤其是SSR渲染）的往返次数
+
+    GET  /api/batch?req=/api/user/info&req=/api/index&ids=1,2,3
+    POST /api/batch  {"requests": ["/api/user/info", "/api/index"], "ids": [1, 2, 3]}
+
+    子请求只能是BATCH_HANDLERS中的接口，只执行GET方法。子请求不执行prepare()，邀请码等检查
+    已在本请求中完成；所有子请求在本请求的线程池任务中依次执行，共用本请求读取的当前用户和session，
+    整个批量请求只查询一次用户。
+    返回 {"responses": [各子请求的JSON], "books": [书籍详情]}，顺序与请求一致。
+    """
+
+    executor = executors.READER  # POST请求也只读取书库
+
+    def get_batch_args(self):
+        if self.request.method == "POST":
+            data = tornado.escape.json_decode(self.request.body or b"{}")
+            paths, ids = data.get("requests", []), data.get("ids", [])
+        else:
+            paths = self.get_arguments("req")
+            ids = [v for v in self.get_argument("ids", "").split(",") if v.strip()]
+        return paths, [int(v) for v in ids]
+
+    @js
+    def get(self):
+        try:
+            paths, ids = self.get_batch_args()
+        except (ValueError, TypeError, AttributeError):
+            return {"err": "params.invalid", "msg": _(u"参数错误")}
+        if len(paths) > MAX_REQUESTS or len(ids) > MAX_BOOKS:
+            return {"err": "params.invalid", "msg": _(u"请求数量过多")}
+
+        responses = [self.sub_request(path) for path in paths]
+        return {"err": "ok", "responses": responses, "books": self.batch_books(ids)}
+
+    def post(self):
+        return self.get()
+
+    def batch_books(self, ids):
+        """一次读取多本书的详情，不存在或不可见的书籍不返回"""
+        ids = self.filter_visible(ids)
+        if not ids:
+            return []
+        books = self.get_page_books(ids)
+        return self.format_books(books, with_files=True, with_perms=True)
+
+    def find_handler(self, request):
+        for rule in self.application.wildcard_router.rules:
+            match = rule.matcher.match(request)
+            if match is not None:
+                return rule.target, rule.target_kwargs, match.get("path_args", [])
+        return None, None, None
+
+    def sub_request(self, path):
+        if not isinstance(path, str) or not path.startswith("/api/"):
+            return {"err": "params.invalid", "msg": _(u"不支持的请求：%s") % path}
+
+        request = httputil.HTTPServerRequest(
+            method="GET",
+            uri=path,
+            headers=self.request.headers,
+            host=self.request.host,
+            connection=self.request.connection,
+        )
+        cls, kwargs, path_args = self.find_handler(request)
+        if cls not in BATCH_HANDLERS:
+            return {"err": "params.invalid", "msg": _(u"不支持的请求：%s") % path}
+
+        try:
+            handler = cls(self.application, request, **kwargs)
+        finally:
+            # 子请求的handler会替换连接的关闭回调，需要还原
+            self.request.connection.set_close_callback(self.on_connection_close)
+
+        # 共用本次请求的session、当前用户和站点地址
+        handler.session = self.session
+        handler.cookies_cache = self.cookies_cache
+        handler._current_user = self.current_user
+        handler.admin_user = self.admin_user
+        handler.site_url, handler.api_url, handler.cdn_url = self.site_url, self.api_url, self.cdn_url
+
+        # 截获子请求的输出；直接调用@js包装前的函数，已在本请求的线程池任务中，不再提交到线程池
+        output = []
+        handler.write = output.append
+        handler.finish = lambda *args, **kwargs: None
+        try:
+            rsp = cls.get.__wrapped__(handler, *[handler.decode_argument(arg) for arg in path_args])
+        except web.Finish:
+            # 先输出结果再结束请求的接口，取最后输出的JSON
+            rsp = next((r for r in reversed(output) if isinstance(r, dict)), None)
+        except Exception:
+            logging.error(traceback.format_exc())
+            return {"err": "exception", "msg": _(u"请求失败：%s") % path}
+        if not isinstance(rsp, dict):
+            return {"err": "params.invalid", "msg": _(u"不支持的请求：%s") % path}
+        rsp["msg"] = rsp.get("msg", "")
+        return rsp
+
+
+def routes():
+    return [
+        (r"/api/batch", Batch),
+    ]
@@ -17,7 +17,8 @@ from gettext import gettext as _
 import tornado.escape
 from tornado import web
 
-from webserver import constants, loader, utils
+from webserver import constants, executors, loader, utils
+from webserver.book_hash import data_sha256
 from webserver.handlers.base import BaseHandler, ListHandler, auth, js
 from webserver.models import Item
 from webserver.plugins.meta import baike, douban
@@ -85,7 +86,7 @@ class Index(BaseHandler):
 
         # nav = "index"
         # title = _(u"全部书籍")
-        ids = list(self.cache.search(""))
+        ids = list(self.search_for_books(""))
         if not ids:
             raise web.HTTPError(404, reason=_(u"本书库暂无藏书"))
         random_ids = random.sample(ids, min(cnt_random, len(ids)))
@@ -112,11 +113,13 @@ class BookDetail(BaseHandler):
         return {
             "err": "ok",
             "kindle_sender": CONF["smtp_username"],
-            "book": utils.BookFormatter(self, book).format(with_files=True, with_perms=True),
+            "book": self.format_books([book], with_files=True, with_perms=True)[0],
         }
 
 
 class BookRefer(BaseHandler):
+    executor = executors.WRITER
+
     def has_proper_book(self, books, mi):
         if not books or not mi.isbn or mi.isbn == baike.BAIKE_ISBN:
             return False
@@ -257,10 +260,13 @@ class BookRefer(BaseHandler):
             mi.smart_update(refer_mi, replace_metadata=True)
 
         self.db.set_metadata(book_id, mi)
+        self.suggest.update_book(book_id)
         return {"err": "ok"}
 
 
 class BookEdit(BaseHandler):
+    executor = executors.WRITER
+
     @js
     @auth
     def post(self, bid):
@@ -300,10 +306,13 @@ class BookEdit(BaseHandler):
             self.db.set_tags(bid, [])
 
         self.db.set_metadata(bid, mi)
+        self.suggest.update_book(bid)
         return {"err": "ok", "msg": _(u"更新成功")}
 
 
 class BookDelete(BaseHandler):
+    executor = executors.WRITER
+
     @js
     @auth
     def post(self, bid):
@@ -320,6 +329,9 @@ class BookDelete(BaseHandler):
             return {"err": "permission", "msg": _(u"无权操作")}
 
         self.db.delete_book(bid)
+        self.hash_index.delete_book(bid)
+        self.fulltext.notify(bid)
+        self.suggest.update_book(bid)
         self.add_msg("success", _(u"删除书籍《%s》") % book["title"])
         return {"err": "ok", "msg": _(u"删除成功")}
 
@@ -332,19 +344,12 @@ class BookDownload(BaseHandler):
 
     def get(self, id, fmt):
         is_opds = self.get_argument("from", "") == "opds"
-        if not CONF["ALLOW_GUEST_DOWNLOAD"] and not self.current_user:
+        if not self.can_download():
             if is_opds:
                 return self.send_error_of_not_invited()
             else:
                 return self.redirect("/login")
 
-        if self.current_user:
-            if self.current_user.can_save():
-                if not self.current_user.is_active():
-                    raise web.HTTPError(403, reason=_(u"无权操作，请先登录注册邮箱激活账号。"))
-            else:
-                raise web.HTTPError(403, reason=_(u"无权操作"))
-
         fmt = fmt.lower()
         logging.debug("download %s.%s" % (id, fmt))
         book = self.get_book(id)
@@ -379,24 +384,52 @@ class BookNav(ListHandler):
 
 
 class RecentBook(ListHandler):
+    @js
     def get(self):
         title = _(u"新书推荐")
-        ids = self.books_by_id()
-        return self.render_book_list([], ids=ids, title=title, sort_by_id=True)
+        ids = self.search_for_books("")
+        return self.render_book_list([], ids=ids, title=title, sort_by="id")
 
 
 class SearchBook(ListHandler):
+    @js
     def get(self):
         name = self.get_argument("name", "")
         if not name.strip():
-            return self.write({"err": "params.invalid", "msg": _(u"请输入搜索关键字")})
+            return {"err": "params.invalid", "msg": _(u"请输入搜索关键字")}
 
         title = _(u"搜索：%(name)s") % {"name": name}
-        ids = self.cache.search(name)
+        ids = self.search_for_books(name)
         return self.render_book_list([], ids=ids, title=title)
 
 
+class FulltextSearch(BaseHandler):
+    @js
+    def get(self):
+        query = self.get_argument("q", "")
+        if not query.strip():
+            return {"err": "params.invalid", "msg": _(u"请输入搜索关键字")}
+        if not self.fulltext.ready:
+            return {"err": "fulltext.not_ready", "msg": _(u"全文索引正在建立中，请稍后再试")}
+
+        limit = self.get_argument_size(50, 200)
+        results = [
+            {"id": book_id, "snippet": snippet}
+            for book_id, snippet in self.fulltext.search(query, limit, visible=self.visible_books())
+        ]
+        return {"err": "ok", "total": len(results), "results": results}
+
+
+class Suggest(BaseHandler):
+    @js
+    def get(self):
+        query = self.get_argument("q", "")
+        limit = self.get_argument_size(10, 50)
+        return {"err": "ok", "suggestions": self.suggest.suggest(query, limit, self.visible_books())}
+
+
 class HotBook(ListHandler):
+    @js
     def get(self):
         title = _(u"热度榜单")
         db_items = self.session.query(Item).filter(Item.count_visit > 1).order_by(Item.count_download.desc())
@@ -417,6 +450,8 @@ class HotBook(ListHandler):
 
 
 class BookUpload(BaseHandler):
+    executor = executors.WRITER
+
     @classmethod
     def convert(cls, s):
         try:
@@ -459,17 +494,24 @@ class BookUpload(BaseHandler):
             mi.title = name.replace(".txt", "")
             mi.authors = [_(u"佚名")]
         logging.info("upload mi.title = " + repr(mi.title))
-        books = self.db.books_with_same_title(mi)
-        if books:
-            book_id = books.pop()
+        if self.hash_index.ready:
+            book_id = self.hash_index.lookup(data_sha256(data))
+        else:
+            # 哈希索引尚未建立完成时，退回到calibre按书名查重
+            books = self.db.books_with_same_title(mi)
+            book_id = books.pop() if books else None
+        if book_id:
             return {
                 "err": "samebook",
-                "msg": _(u"已存在同名书籍《%s》") % mi.title,
+                "msg": _(u"已存在相同的书籍《%s》") % mi.title,
                 "book_id": book_id,
             }
 
         fpaths = [fpath]
         book_id = self.db.import_book(mi, fpaths)
+        self.hash_index.add_book(book_id)
+        self.fulltext.notify(book_id)
+        self.suggest.update_book(book_id)
         self.user_history("upload_history", {"id": book_id, "title": mi.title})
         self.add_msg("success", _(u"导入书籍成功！"))
         item = Item()
@@ -480,6 +522,8 @@ class BookUpload(BaseHandler):
 
 
 class BookRead(BaseHandler):
+    writer_process = True  # 阅读前可能需要转换格式并添加到书库
+
     def get(self, id):
         if not CONF["ALLOW_GUEST_READ"] and not self.current_user:
             return self.redirect("/login")
@@ -557,6 +601,8 @@ class BookRead(BaseHandler):
             with open(new_path, "rb") as f:
                 self.db.add_format(book["id"], new_fmt, f, index_is_id=True)
                 logging.info("add new book: %s", new_path)
+            self.hash_index.add_format(book["id"], new_fmt)
+            self.fulltext.notify(book["id"])
             fpath = new_path
 
         # extract to dir
@@ -802,6 +848,9 @@ class BookTxtInit(BaseHandler):
 
 
 class BookPush(BaseHandler):
+    executor = executors.WRITER  # 推送前可能需要转换格式并添加到书库
+    writer_process = True
+
     @js
     def post(self, id):
         if not CONF["ALLOW_GUEST_PUSH"]:
@@ -877,6 +926,8 @@ class BookPush(BaseHandler):
             return None
         with open(new_path, "rb") as f:
             self.db.add_format(book["id"], new_fmt, f, index_is_id=True)
+        self.hash_index.add_format(book["id"], new_fmt)
+        self.fulltext.notify(book["id"])
         return new_path
 
     def do_send_mail(self, book, mail_to, fmt, fpath):
@@ -931,6 +982,8 @@ def routes():
     return [
         (r"/api/index", Index),
         (r"/api/search", SearchBook),
+        (r"/api/search/fulltext", FulltextSearch),
+        (r"/api/suggest", Suggest),
         (r"/api/recent", RecentBook),
         (r"/api/hot", HotBook),
         (r"/api/book/nav", BookNav),
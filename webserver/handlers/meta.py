@@ -2,10 +2,8 @@
 # -*- coding: UTF-8 -*-
 import math
 import sys
-from functools import cmp_to_key
 from gettext import gettext as _
 
-from webserver import utils
 from webserver.handlers.base import ListHandler, js
 
 
@@ -26,7 +24,7 @@ class PubBooksUpdate(ListHandler):
         if publisher_id:
             ids = self.db.get_books_for_category(category, publisher_id)
         else:
-            ids = self.cache.search_for_books("")
+            ids = self.catalog.search("")
             books = self.db.get_data_as_dict(ids=ids)
             ids = [b["id"] for b in books if not b["publisher"]]
         for book_id in list(ids)[:40]:
@@ -62,6 +60,7 @@ class MetaList(ListHandler):
 
 
 class MetaBooks(ListHandler):
+    @js
     def get(self, meta, name):
         titles = {
             "tag": _(u'含有"%(name)s"标签的书籍'),
@@ -74,9 +73,10 @@ class MetaBooks(ListHandler):
         category = meta + "s" if meta in ["tag", "author"] else meta
         if meta in ["rating"]:
             name = int(name)
-        books = self.get_item_books(category, name)
-        books.sort(key=cmp_to_key(utils.compare_books_by_rating_or_id), reverse=True)
-        return self.render_book_list(books, title=title)
+        item_id = self.cache.get_item_id(category, name)
+        ids = self.db.get_books_for_category(category, item_id) if item_id else []
+        # 按评分从高到低，评分相同时按id从大到小
+        return self.render_book_list([], ids=ids, title=title, sort_by="rating")
 
 
 def routes():
@@ -6,9 +6,17 @@ __copyright__ = "2010, Kovid Goyal <kovid@kovidgoyal.net>"
 __docformat__ = "restructuredtext en"
 
 import binascii
+import copy
+import datetime
+import email.utils
 import hashlib
+import io
+import logging
+import os
+import re
 import sys
-from collections import defaultdict
+import urllib.parse
+import zlib
 from functools import partial
 from gettext import gettext as _
 from itertools import repeat
@@ -19,13 +27,19 @@ from calibre.ebooks.metadata import fmt_sidx
 from calibre.library.comments import comments_to_html
 from calibre.utils.config import tweaks
 from calibre.utils.date import as_utc
-from calibre.utils.filenames import ascii_text
 from calibre.utils.icu import sort_key
 from lxml import etree, html
 from lxml.builder import ElementMaker
 from tornado import web
-from webserver import loader
+from webserver import archive, loader
+from webserver.catalog import FACET_FIELDS
 from webserver.handlers.base import BaseHandler
+from webserver.lru import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 CONF = loader.get_settings()
 
@@ -49,6 +63,8 @@ class Offsets(object):
             offset = 0
         if offset >= total:
             raise web.HTTPError(404, reason="Invalid offset: %r" % offset)
+        self.total = total
+        self.delta = delta
         last_allowed_index = total - 1
         last_current_index = offset + delta - 1
         self.slice_upper_bound = offset + delta
@@ -91,16 +107,6 @@ def url_for(name, **kwargs):
     return urls[name] % kwargs
 
 
-def first_char(item):
-    val = getattr(item, "sort", item.name)
-    if not val:
-        val = "A"
-    for c in ascii_text(val):
-        if c.isalnum():
-            return c
-    return "A"
-
-
 def hexlify(x):
     return binascii.hexlify(x.encode("utf-8")).decode("ascii")
 
@@ -115,6 +121,8 @@ E = ElementMaker(
         None: "http://www.w3.org/2005/Atom",
         "dc": "http://purl.org/dc/terms/",
         "opds": "http://opds-spec.org/2010/catalog",
+        "thr": "http://purl.org/syndication/thread/1.0",
+        "pse": "http://vaemendis.net/opds-pse/ns",
     },
 )
 
@@ -133,6 +141,44 @@ FIRST_LINK = partial(NAVLINK, rel="first")
 LAST_LINK = partial(NAVLINK, rel="last")
 NEXT_LINK = partial(NAVLINK, rel="next", title="Next")
 PREVIOUS_LINK = partial(NAVLINK, rel="previous")
+NAV_LINKS = {
+    "up": UP_LINK,
+    "first": FIRST_LINK,
+    "last": LAST_LINK,
+    "next": NEXT_LINK,
+    "previous": PREVIOUS_LINK,
+}
+
+
+def page_link(page_url, offset):
+    sep = "&" if "?" in page_url else "?"
+    return page_url + sep + "offset=%d" % offset
+
+
+def facet_url(page_url, facets):
+    if not facets:
+        return page_url
+    query = urllib.parse.urlencode([("facet", "%s:%s" % f) for f in facets])
+    return page_url + "?" + query
+
+
+def FACET_LINK(href, title, group, count, active=False):
+    link = NAVLINK(href=href, title=title, rel="http://opds-spec.org/facet")
+    link.set("{http://opds-spec.org/2010/catalog}facetGroup", group)
+    link.set("{http://purl.org/syndication/thread/1.0}count", str(count))
+    if active:
+        link.set("{http://opds-spec.org/2010/catalog}activeFacet", "true")
+    return link
+
+
+def facet_title(field, value):
+    if field == "rating":
+        return u"\u2605" * int(int(value) / 2)
+    if field == "languages":
+        from calibre.utils.localization import calibre_langcode_to_name
+
+        return calibre_langcode_to_name(value)
+    return value
 
 
 def UPDATED(dt, *args, **kwargs):
@@ -189,22 +235,43 @@ def html_to_lxml(raw):
             return _html4_parse(raw)
 
 
-def CATALOG_ENTRY(item, item_kind, base_href, updated, ignore_count=False, add_kind=False):
-    id_ = "calibre:category:" + item.name
+COMMENTS_CACHE = LRUCache(max_items=20000)
+
+
+def comments_to_lxml(book_id, comments):
+    """把书籍简介转换为XHTML节点；按书籍缓存解析结果，生成feed时只需复制节点"""
+    key = (book_id, hashlib.sha1(comments.encode("utf-8")).hexdigest())
+    root = COMMENTS_CACHE.get(key)
+    if root is None:
+        root = html_to_lxml(comments_to_html(comments))
+        COMMENTS_CACHE.put(key, root)
+    return copy.deepcopy(root)
+
+
+def category_item_href(item, item_kind, base_href):
     iid = "N" + item.name
     if item.id is not None:
         iid = "I" + str(item.id)
         iid += ":" + item_kind
-    link = NAVLINK(href=base_href + "/" + hexlify(iid))
-    count = (_("%d books") if item.count > 1 else _("%d book")) % item.count
-    if ignore_count:
-        count = ""
+    return base_href + "/" + hexlify(iid)
+
+
+def category_item_name(item, item_kind, add_kind=False):
     if item.use_sort_as_name:
         name = item.sort
     else:
         name = item.name
+    return name + ("" if not add_kind else " (%s)" % item_kind)
+
+
+def CATALOG_ENTRY(item, item_kind, base_href, updated, ignore_count=False, add_kind=False):
+    id_ = "calibre:category:" + item.name
+    link = NAVLINK(href=category_item_href(item, item_kind, base_href))
+    count = (_("%d books") if item.count > 1 else _("%d book")) % item.count
+    if ignore_count:
+        count = ""
     return E.entry(
-        TITLE(name + ("" if not add_kind else " (%s)" % item_kind)),
+        TITLE(category_item_name(item, item_kind, add_kind)),
         ID(id_),
         UPDATED(updated),
         E.content(count, type="text"),
@@ -225,7 +292,101 @@ def CATALOG_GROUP_ENTRY(item, category, base_href, updated):
     )
 
 
-def ACQUISITION_ENTRY(item, db, updated, CFM, CKEYS, prefix):
+def custom_fields_for_books(db, book_ids, CKEYS):
+    """按字段批量读取一批书籍的自定义字段，返回 book_id => 只含自定义字段的Metadata"""
+    from calibre.ebooks.metadata.book.base import Metadata
+
+    cache = db.new_api
+    CFM = db.field_metadata
+    values = {}
+    extras = {}
+    for key in CKEYS:
+        values[key] = cache.all_field_for(key, book_ids)
+        if CFM[key]["datatype"] == "series":
+            extras[key] = cache.all_field_for(key + "_index", book_ids)
+
+    ans = {}
+    for book_id in book_ids:
+        mi = Metadata(_("Unknown"))
+        for key in CKEYS:
+            meta = dict(CFM[key])
+            meta["#value#"] = values[key][book_id]
+            meta["#extra#"] = extras[key][book_id] if key in extras else None
+            mi.set_user_metadata(key, meta)
+        ans[book_id] = mi
+    return ans
+
+
+# OPDS-PSE：漫画格式按页流式阅读
+COMIC_FORMATS = {"cbz": "zip", "cbr": "rar"}
+IMAGE_EXT = ["jpg", "jpeg", "png", "gif", "webp", "bmp"]
+PAGES_CACHE = LRUCache(max_items=2000)
+PAGE_CACHE = LRUCache(max_bytes=CONF["opds_page_cache_size"], sizeof=lambda page: len(page[0]))
+
+
+def natural_key(name):
+    return [int(x) if x.isdigit() else x.lower() for x in re.split(r"(\d+)", name)]
+
+
+def comic_pages(fpath, fmt):
+    """返回漫画压缩包中按自然顺序排列的图片列表，按文件修改时间缓存"""
+    key = (fpath, os.path.getmtime(fpath))
+    pages = PAGES_CACHE.get(key)
+    if pages is None:
+        members = archive.list_members(fpath, IMAGE_EXT, COMIC_FORMATS[fmt])
+        pages = sorted((name for name, __ in members), key=natural_key)
+        PAGES_CACHE.put(key, pages)
+    return pages
+
+
+def comic_page_counts(db, book_ids):
+    """统计一批书籍中漫画格式的页数，返回 book_id => {fmt: count}"""
+    ans = {}
+    cache = db.new_api
+    for book_id in book_ids:
+        for fmt in cache.formats(book_id) or []:
+            fmt = fmt.lower()
+            if fmt not in COMIC_FORMATS or COMIC_FORMATS[fmt] not in archive.archive_openers():
+                continue
+            try:
+                pages = comic_pages(cache.format_abspath(book_id, fmt), fmt)
+            except Exception as err:
+                logging.error("bad comic book: %s.%s, %s", book_id, fmt, err)
+                continue
+            if pages:
+                ans.setdefault(book_id, {})[fmt] = len(pages)
+    return ans
+
+
+def scale_image(data, width):
+    """按宽度等比缩小图片，返回(data, content_type)；无需缩放或无法处理时返回(data, None)"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return data, None
+    img = Image.open(io.BytesIO(data))
+    if img.width <= width:
+        return data, None
+    height = max(1, int(img.height * width / img.width))
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    img = img.resize((width, height), Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=85)
+    return out.getvalue(), "image/jpeg"
+
+
+def PSE_LINK(prefix, book_id, fmt, count):
+    link = E.link(
+        type="image/jpeg",
+        href=prefix + "/opds/pse/%s/%s/{pageNumber}?width={maxWidth}" % (book_id, fmt),
+        rel="http://vaemendis.net/opds-pse/stream",
+    )
+    link.set("{http://vaemendis.net/opds-pse/ns}count", str(count))
+    return link
+
+
+def ACQUISITION_ENTRY(item, db, updated, CFM, CKEYS, prefix, custom, pse):
     FM = db.FIELD_MAP
     title = item[FM["title"]]
     if not title:
@@ -249,7 +410,7 @@ def ACQUISITION_ENTRY(item, db, updated, CFM, CKEYS, prefix):
             % dict(series=xml(series), sidx=fmt_sidx(float(item[FM["series_index"]])))
         )
     for key in CKEYS:
-        mi = db.get_metadata(item[CFM["id"]["rec_index"]], index_is_id=True)
+        mi = custom[item[FM["id"]]]
         name, val = mi.format_field(key)
         if val:
             datatype = CFM[key]["datatype"]
@@ -275,16 +436,18 @@ def ACQUISITION_ENTRY(item, db, updated, CFM, CKEYS, prefix):
                 extra.append("%s: %s<br />" % (xml(name), comments_to_html(val)))
             else:
                 extra.append("%s: %s<br />" % (xml(name), xml(val)))
+    extra = html_to_lxml("\n".join(extra)) if extra else None
     comments = item[FM["comments"]]
     if comments:
-        comments = comments_to_html(comments)
-        extra.append(comments)
-    if extra:
-        extra = html_to_lxml("\n".join(extra))
+        comments = comments_to_lxml(item[FM["id"]], comments)
+        if extra is None:
+            extra = comments
+        else:
+            extra.append(comments)
     idm = "uuid"
     id_ = "urn:%s:%s" % (idm, item[FM["uuid"]])
     ans = E.entry(TITLE(title), E.author(E.name(authors)), ID(id_), UPDATED(updated))
-    if len(extra):
+    if extra is not None:
         ans.append(E.content(extra, type="xhtml"))
     formats = item[FM["formats"]]
     if formats:
@@ -296,6 +459,8 @@ def ACQUISITION_ENTRY(item, db, updated, CFM, CKEYS, prefix):
                 link = E.link(type=mt, href=href)
                 link.set("rel", "http://opds-spec.org/acquisition")
                 ans.append(link)
+    for fmt, count in pse.get(item[FM["id"]], {}).items():
+        ans.append(PSE_LINK(prefix, item[FM["id"]], fmt, count))
     ans.append(
         E.link(
             type="image/jpeg",
@@ -318,6 +483,8 @@ default_feed_title = CONF['site_title'] + " " + _("Library")
 
 
 class Feed(object):
+    """feed的页面数据；Atom XML在序列化时才生成，OPDS 2.0 JSON直接使用这些数据"""
+
     def __init__(
         self,
         id_,
@@ -331,31 +498,65 @@ class Feed(object):
         previous_link=None,
     ):
         self.base_href = url_for("opds")
+        self.id_ = id_
+        self.updated = updated
+        self.title = title or default_feed_title
+        self.subtitle = subtitle
+        links = [
+            ("up", up_link),
+            ("first", first_link),
+            ("last", last_link),
+            ("next", next_link),
+            ("previous", previous_link),
+        ]
+        self.links = [(rel, href) for rel, href in links if href]
 
-        self.root = FEED(
-            TITLE(title or default_feed_title),
+    def build_root(self):
+        root = FEED(
+            TITLE(self.title),
             AUTHOR(CONF['site_title'], uri="http://calibre-ebook.com"),
-            ID(id_),
+            ID(self.id_),
             ICON("/favicon.png"),
-            UPDATED(updated),
+            UPDATED(self.updated),
             SEARCH_LINK(self.base_href),
             START_LINK(href=self.base_href),
         )
-        if up_link:
-            self.root.append(UP_LINK(href=up_link))
-        if first_link:
-            self.root.append(FIRST_LINK(href=first_link))
-        if last_link:
-            self.root.append(LAST_LINK(href=last_link))
-        if next_link:
-            self.root.append(NEXT_LINK(href=next_link))
-        if previous_link:
-            self.root.append(PREVIOUS_LINK(href=previous_link))
-        if subtitle:
-            self.root.insert(1, SUBTITLE(subtitle))
+        for rel, href in self.links:
+            root.append(NAV_LINKS[rel](href=href))
+        if self.subtitle:
+            root.insert(1, SUBTITLE(self.subtitle))
+        return root
+
+    def navigation(self):
+        """导航条目列表 [(title, description, href)]"""
+        return []
+
+    def iter_entries(self):
+        return iter(())
+
+    def iter_bytes(self):
+        """逐个条目生成并序列化，不在内存中构建完整的XML树"""
+        sink = io.BytesIO()
+
+        def drain():
+            data = sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+            return data
+
+        root = self.build_root()
+        with etree.xmlfile(sink, encoding="utf-8", buffered=False) as xf:
+            xf.write_declaration()
+            with xf.element(root.tag, nsmap=root.nsmap):
+                for child in root:
+                    xf.write(child)
+                for entry in self.iter_entries():
+                    xf.write(entry)
+                    yield drain()
+        yield drain()
 
     def __bytes__(self):
-        return etree.tostring(self.root, pretty_print=True, encoding="utf-8", xml_declaration=True)
+        return b"".join(self.iter_bytes())
 
 
 class TopLevel(Feed):
@@ -367,64 +568,155 @@ class TopLevel(Feed):
         subtitle=_("Books in your library"),
     ):
         Feed.__init__(self, id_, updated, subtitle=subtitle)
-
-        subc = partial(NAVCATALOG_ENTRY, self.base_href, updated)
-        subcatalogs = [
-            subc(_(u"By {0}").format(title), _("Books sorted by {0}").format(desc), q) for title, desc, q in categories
+        self.categories = categories
+
+    def navigation(self):
+        return [
+            (
+                _(u"By {0}").format(title),
+                _("Books sorted by {0}").format(desc),
+                self.base_href + "/nav/" + hexlify(q),
+            )
+            for title, desc, q in self.categories
         ]
-        for x in subcatalogs:
-            self.root.append(x)
+
+    def iter_entries(self):
+        subc = partial(NAVCATALOG_ENTRY, self.base_href, self.updated)
+        for title, desc, q in self.categories:
+            yield subc(_(u"By {0}").format(title), _("Books sorted by {0}").format(desc), q)
 
 
 class NavFeed(Feed):
     def __init__(self, id_, updated, offsets, page_url, up_url, title=None):
         kwargs = {"up_link": up_url}
         kwargs["first_link"] = page_url
-        kwargs["last_link"] = page_url + "?offset=%d" % offsets.last_offset
+        kwargs["last_link"] = page_link(page_url, offsets.last_offset)
         if offsets.offset > 0:
-            kwargs["previous_link"] = page_url + "?offset=%d" % offsets.previous_offset
+            kwargs["previous_link"] = page_link(page_url, offsets.previous_offset)
         if offsets.next_offset > -1:
-            kwargs["next_link"] = page_url + "?offset=%d" % offsets.next_offset
+            kwargs["next_link"] = page_link(page_url, offsets.next_offset)
         if title:
             kwargs["title"] = title
         Feed.__init__(self, id_, updated, **kwargs)
+        self.offsets = offsets
 
 
 class AcquisitionFeed(NavFeed):
-    def __init__(self, updated, id_, items, offsets, page_url, up_url, db, prefix, title=None):
+    def __init__(self, updated, id_, items, offsets, page_url, up_url, db, prefix, title=None, facets=None):
         NavFeed.__init__(self, id_, updated, offsets, page_url, up_url, title=title)
+        # 条目在序列化时才逐个生成
+        self.items = items
+        self.db = db
+        self.prefix = prefix
+        self.facets = facets or []  # [(href, title, group, count, active)]
+
+    def build_root(self):
+        root = NavFeed.build_root(self)
+        for href, title, group, count, active in self.facets:
+            root.append(FACET_LINK(href, title, group, count, active=active))
+        return root
+
+    def iter_entries(self):
+        db = self.db
         CFM = db.field_metadata
         CKEYS = [key for key in sorted(custom_fields_to_display(db), key=lambda x: sort_key(CFM[x]["name"]))]
-        for item in items:
-            self.root.append(ACQUISITION_ENTRY(item, db, updated, CFM, CKEYS, prefix))
+        FM = db.FIELD_MAP
+        book_ids = [item[FM["id"]] for item in self.items]
+        custom = custom_fields_for_books(db, book_ids, CKEYS) if CKEYS else {}
+        pse = comic_page_counts(db, book_ids)
+        for item in self.items:
+            yield ACQUISITION_ENTRY(item, db, self.updated, CFM, CKEYS, self.prefix, custom, pse)
 
 
 class CategoryFeed(NavFeed):
     def __init__(self, items, which, id_, updated, offsets, page_url, up_url, db, title=None):
         NavFeed.__init__(self, id_, updated, offsets, page_url, up_url, title=title)
-        base_href = self.base_href + "/category/" + hexlify(which)
-        ignore_count = False
-        if which == "search":
-            ignore_count = True
-        for item in items:
-            self.root.append(
-                CATALOG_ENTRY(
-                    item,
-                    item.category,
-                    base_href,
-                    updated,
-                    ignore_count=ignore_count,
-                    add_kind=which != item.category,
+        self.items = items
+        self.which = which
+        self.item_base_href = self.base_href + "/category/" + hexlify(which)
+        self.ignore_count = which == "search"
+
+    def navigation(self):
+        ans = []
+        for item in self.items:
+            count = "" if self.ignore_count else (_("%d books") if item.count > 1 else _("%d book")) % item.count
+            ans.append(
+                (
+                    category_item_name(item, item.category, self.which != item.category),
+                    count,
+                    category_item_href(item, item.category, self.item_base_href),
                 )
             )
+        return ans
+
+    def iter_entries(self):
+        for item in self.items:
+            yield CATALOG_ENTRY(
+                item,
+                item.category,
+                self.item_base_href,
+                self.updated,
+                ignore_count=self.ignore_count,
+                add_kind=self.which != item.category,
+            )
 
 
 class CategoryGroupFeed(NavFeed):
     def __init__(self, items, which, id_, updated, offsets, page_url, up_url, title=None):
         NavFeed.__init__(self, id_, updated, offsets, page_url, up_url, title=title)
-        base_href = self.base_href + "/categorygroup/" + hexlify(which)
-        for item in items:
-            self.root.append(CATALOG_GROUP_ENTRY(item, which, base_href, updated))
+        self.items = items
+        self.which = which
+        self.item_base_href = self.base_href + "/categorygroup/" + hexlify(which)
+
+    def navigation(self):
+        return [
+            (item.text, _("%d items") % item.count, self.item_base_href + "/" + hexlify(item.text))
+            for item in self.items
+        ]
+
+    def iter_entries(self):
+        for item in self.items:
+            yield CATALOG_GROUP_ENTRY(item, self.which, self.item_base_href, self.updated)
+
+
+class CachedFeed:
+    """渲染好的feed，边生成边压缩，同时保存gzip和brotli压缩后的内容"""
+
+    def __init__(self, content_type):
+        self.content_type = content_type
+        self.encoders = {"gzip": zlib.compressobj(6, zlib.DEFLATED, 31)}
+        if brotli:
+            self.encoders["br"] = brotli.Compressor(quality=5)
+        self.parts = {"identity": [], "gzip": [], "br": []}
+        self.bodies = {}
+
+    def append(self, chunk):
+        """追加一段内容，返回各编码方式下新产生的数据"""
+        out = {"identity": chunk}
+        for encoding, encoder in self.encoders.items():
+            out[encoding] = encoder.compress(chunk) if encoding == "gzip" else encoder.process(chunk)
+        for encoding, data in out.items():
+            self.parts[encoding].append(data)
+        return out
+
+    def finish(self):
+        out = {"identity": b""}
+        for encoding, encoder in self.encoders.items():
+            out[encoding] = encoder.flush() if encoding == "gzip" else encoder.finish()
+        for encoding, data in out.items():
+            self.parts[encoding].append(data)
+        self.bodies = {encoding: b"".join(self.parts.pop(encoding)) for encoding in out}
+        self.parts = None
+        self.encoders = None
+        return out
+
+    def size(self):
+        return sum(len(body) for body in self.bodies.values())
+
+
+FEED_FLUSH_SIZE = 16 * 1024
+FACET_MAX_VALUES = 10
+FEED_CACHE = LRUCache(max_bytes=CONF["opds_cache_size"], sizeof=lambda feed: feed.size())
 
 
 class OpdsHandler(BaseHandler):
@@ -433,6 +725,102 @@ class OpdsHandler(BaseHandler):
         self.set_status(401)
         raise web.Finish()
 
+    def serialize_feed(self, feed):
+        """返回(Content-Type, 内容分块)"""
+        return self._headers.get("Content-Type"), feed.iter_bytes()
+
+    def cache_scope(self):
+        """feed内容的可见范围：可见书籍范围相同的用户共用缓存"""
+        return self.library_restriction() or "all"
+
+    def accept_encoding(self):
+        accept = self.request.headers.get("Accept-Encoding", "")
+        encodings = [v.split(";")[0].strip() for v in accept.split(",")]
+        for encoding in ("br", "gzip"):
+            if encoding in encodings and (encoding != "br" or brotli):
+                return encoding
+        return "identity"
+
+    def not_modified_since(self, updated):
+        since = self.request.headers.get("If-Modified-Since", None)
+        if not since or self.request.headers.get("If-None-Match", None):
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(since)
+        except (TypeError, ValueError):
+            return False
+        if updated.tzinfo is None:
+            updated = updated.replace(tzinfo=datetime.timezone.utc)
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        return int(updated.timestamp()) <= int(since.timestamp())
+
+    def write_feed(self, build, *args, **kwargs):
+        """输出feed：书库未变化时返回304，否则优先使用缓存中已压缩的内容"""
+        updated = self.db.last_modified()
+        opds_conf = sorted((k, str(v)) for k, v in CONF.items() if k.startswith("opds_"))
+        args = sorted((k, v) for k, vals in self.request.query_arguments.items() for v in vals)
+        key = (self.request.path, str(args), str(updated), self.cache_scope(), str(opds_conf))
+        encoding = self.accept_encoding()
+        etag = hashlib.sha1(repr((key, encoding)).encode("utf-8")).hexdigest()
+        self.set_header("Etag", '"%s"' % etag)
+        self.set_header("Last-Modified", self.last_modified(updated))
+        self.set_header("Vary", "Accept-Encoding")
+        if self.check_etag_header() or self.not_modified_since(updated):
+            self.set_status(304)
+            return
+
+        if encoding != "identity":
+            self.set_header("Content-Encoding", encoding)
+        cached = FEED_CACHE.get(key)
+        if cached is not None:
+            self.set_header("Content-Type", cached.content_type)
+            self.write(cached.bodies[encoding])
+            return
+
+        # 未命中缓存时，每生成一批条目就发送给客户端，同时保存到缓存
+        feed = build(*args, **kwargs)
+        content_type, chunks = self.serialize_feed(feed)
+        self.set_header("Content-Type", content_type)
+        cached = CachedFeed(content_type)
+        pending = 0
+        for chunk in chunks:
+            data = cached.append(chunk)[encoding]
+            self.write(data)
+            pending += len(data)
+            if pending >= FEED_FLUSH_SIZE:
+                self.flush()
+                pending = 0
+        self.write(cached.finish()[encoding])
+        FEED_CACHE.put(key, cached)
+
+    def get_facets(self):
+        """解析请求中的分面筛选参数 facet=field:value"""
+        facets = []
+        for arg in self.get_arguments("facet"):
+            field, __, value = arg.partition(":")
+            if field not in FACET_FIELDS or not value:
+                raise web.HTTPError(400, reason="Invalid facet: %r" % arg)
+            facets.append((field, value))
+        return facets
+
+    def facet_links(self, ids, page_url, facets):
+        groups = {
+            "formats": _("Format"),
+            "languages": _("Language"),
+            "rating": _("Rating"),
+            "tags": _("Tags"),
+        }
+        links = []
+        for field in FACET_FIELDS:
+            for value, count in self.catalog.facet_counts(ids, field, FACET_MAX_VALUES):
+                active = (field, value) in facets
+                # 已选中的分面，链接为取消该筛选
+                others = [f for f in facets if f != (field, value)]
+                selected = others if active else others + [(field, value)]
+                links.append((facet_url(page_url, selected), facet_title(field, value), groups[field], count, active))
+        return links
+
     def get_opds_acquisition_feed(
         self,
         ids,
@@ -444,29 +832,41 @@ class OpdsHandler(BaseHandler):
         ascending=True,
         feed_title=None,
     ):
-        idx = self.db.FIELD_MAP["id"]
+        ids = self.filter_visible(ids or [])
         if not ids:
             raise web.HTTPError(404, reason="No books found")
-        items = [x for x in self.db.data.iterall() if x[idx] in ids]
-        self.sort(items, sort_by, ascending)
+
+        # 分面筛选：在列式快照上完成筛选和计数
+        facets = self.get_facets()
+        if facets:
+            ids = self.catalog.facet_filter(ids, facets)
+            if not ids:
+                raise web.HTTPError(404, reason="No books found")
+        facet_links = self.facet_links(ids, page_url, facets)
+        page_url = facet_url(page_url, facets)
+
+        # 先对id排序分页，只读取当前页书籍的数据
         max_items = CONF["opds_max_items"]
-        offsets = Offsets(offset, max_items, len(items))
-        items = items[offsets.offset : offsets.offset + max_items]
+        try:
+            total, page_ids = self.catalog.sort_page(ids, sort_by, ascending, max(0, offset), max_items)
+        except KeyError:
+            raise web.HTTPError(400, "%s is not a valid sort field" % sort_by)
+        offsets = Offsets(offset, max_items, total)
+        items = [self.db.data.tablerow_for_id(book_id) for book_id in page_ids]
         updated = self.db.last_modified()
         self.set_header("Last-Modified", self.last_modified(updated))
         self.set_header("Content-Type", "application/atom+xml; profile=opds-catalog; charset=UTF-8")
-        return bytes(
-            AcquisitionFeed(
-                updated,
-                id_,
-                items,
-                offsets,
-                page_url,
-                up_url,
-                self.db,
-                CONF["opds_url_prefix"],
-                title=feed_title,
-            )
+        return AcquisitionFeed(
+            updated,
+            id_,
+            items,
+            offsets,
+            page_url,
+            up_url,
+            self.db,
+            CONF["opds_url_prefix"],
+            title=feed_title,
+            facets=facet_links,
         )
 
     def opds_search(self, query=None, offset=0):
@@ -494,7 +894,7 @@ class OpdsHandler(BaseHandler):
         ascending = which == "title"
         feed_title = {"newest": _("Newest"), "title": _("Title")}.get(which, which)
         feed_title = default_feed_title + " :: " + _("By {0}").format(feed_title)
-        ids = list(self.cache.search(""))
+        ids = self.search_for_books("")
         return self.get_opds_acquisition_feed(
             ids,
             offset,
@@ -515,7 +915,7 @@ class OpdsHandler(BaseHandler):
         if not which or not category:
             raise web.HTTPError(404, reason="Not found")
 
-        categories = self.db.get_categories()
+        categories = self.catalog.categories(self.library_restriction())
         page_url = url_for("opdscategorygroup", category=category, which=which)
 
         category = unhexlify(category)
@@ -528,12 +928,7 @@ class OpdsHandler(BaseHandler):
         feed_title = default_feed_title + " :: " + (_("By {0} :: {1}").format(category_name, which))
         owhich = hexlify("N" + which)
         up_url = url_for("opdsnavcatalog", which=owhich)
-        items = categories[category]
-
-        def belongs(x, which):
-            return first_char(x).lower() == which.lower()
-
-        items = [x for x in items if belongs(x, which)]
+        items = self.catalog.letter_index(category, self.library_restriction()).get(which.upper(), [])
         if not items:
             raise web.HTTPError(404, reason="No items in group %r:%r" % (category, which))
         updated = self.db.last_modified()
@@ -546,18 +941,16 @@ class OpdsHandler(BaseHandler):
         self.set_header("Last-Modified", self.last_modified(updated))
         self.set_header("Content-Type", "application/atom+xml; charset=UTF-8")
 
-        return bytes(
-            CategoryFeed(
-                items,
-                category,
-                id_,
-                updated,
-                offsets,
-                page_url,
-                up_url,
-                self.db,
-                title=feed_title,
-            )
+        return CategoryFeed(
+            items,
+            category,
+            id_,
+            updated,
+            offsets,
+            page_url,
+            up_url,
+            self.db,
+            title=feed_title,
         )
 
     def opds_navcatalog(self, which=None, offset=0):
@@ -581,7 +974,7 @@ class OpdsHandler(BaseHandler):
         raise web.HTTPError(404, reason="Not found")
 
     def get_opds_navcatalog(self, which, page_url, up_url, offset=0):
-        categories = self.db.get_categories()
+        categories = self.catalog.categories(self.library_restriction())
         if which not in categories:
             raise web.HTTPError(404, reason="Category %r not found" % which)
 
@@ -617,14 +1010,10 @@ class OpdsHandler(BaseHandler):
                 def __init__(self, text, count):
                     self.text, self.count = text, count
 
-            groups = defaultdict(int)
-            for x in items:
-                c = first_char(x)
-                groups[c.upper()] += 1
-
+            groups = self.catalog.letter_index(which, self.library_restriction())
             items = []
             for c in sorted(groups.keys(), key=sort_key):
-                items.append(Group(c, groups[c]))
+                items.append(Group(c, len(groups[c])))
 
             max_items = CONF["opds_max_items"]
             offsets = Offsets(offset, max_items, len(items))
@@ -634,7 +1023,7 @@ class OpdsHandler(BaseHandler):
         self.set_header("Last-Modified", self.last_modified(updated))
         self.set_header("Content-Type", "application/atom+xml; charset=UTF-8")
 
-        return bytes(ans)
+        return ans
 
     def opds_category(self, category=None, which=None, offset=0):
         try:
@@ -665,7 +1054,7 @@ class OpdsHandler(BaseHandler):
                 ):
                     raise web.HTTPError(404, reason="Tag %r not found" % which)
 
-        categories = self.db.get_categories()
+        categories = self.catalog.categories(self.library_restriction())
         if category not in categories:
             raise web.HTTPError(404, reason="Category %r not found" % which)
 
@@ -695,7 +1084,7 @@ class OpdsHandler(BaseHandler):
         )
 
     def opds(self):
-        categories = self.db.get_categories()
+        categories = self.catalog.categories(self.library_restriction())
         category_meta = self.db.field_metadata
         cats = [
             (_("Newest"), _("Date"), "Onewest"),
@@ -727,36 +1116,85 @@ class OpdsHandler(BaseHandler):
 
         feed = TopLevel(updated, cats)
 
-        return bytes(feed)
+        return feed
 
 
 class OpdsIndex(OpdsHandler):
     def get(self):
-        self.write(self.opds())
+        self.write_feed(self.opds)
 
 
 class OpdsNav(OpdsHandler):
     def get(self, which):
         offset = self.get_argument("offset", 0)
-        self.write(self.opds_navcatalog(which, offset=offset))
+        self.write_feed(self.opds_navcatalog, which, offset=offset)
 
 
 class OpdsCategory(OpdsHandler):
     def get(self, category, which):
         offset = self.get_argument("offset", 0)
-        self.write(self.opds_category(category, which, offset=offset))
+        self.write_feed(self.opds_category, category, which, offset=offset)
 
 
 class OpdsCategoryGroup(OpdsHandler):
     def get(self, category, which):
         offset = self.get_argument("offset", 0)
-        self.write(self.opds_category_group(category, which, offset=offset))
+        self.write_feed(self.opds_category_group, category, which, offset=offset)
 
 
 class OpdsSearch(OpdsHandler):
     def get(self, which):
         offset = self.get_argument("offset", 0)
-        self.write(self.opds_search(which, offset=offset))
+        self.write_feed(self.opds_search, which, offset=offset)
+
+
+class OpdsPageStream(OpdsHandler):
+    """OPDS-PSE：从漫画压缩包中直接读取单页图片，可按宽度缩小"""
+
+    def get(self, book_id, fmt, page):
+        if not self.can_download():
+            return self.send_error_of_not_invited()
+
+        book_id, page, fmt = int(book_id), int(page), fmt.lower()
+        try:
+            width = int(self.get_argument("width", 0))
+        except ValueError:
+            width = 0
+        if fmt not in COMIC_FORMATS:
+            raise web.HTTPError(404, reason="Not a comic format")
+        if not self.is_visible(book_id):
+            raise web.HTTPError(404, reason="Book not found")
+        fpath = self.cache.format_abspath(book_id, fmt)
+        if not fpath:
+            raise web.HTTPError(404, reason="Book not found")
+
+        key = (fpath, os.path.getmtime(fpath), page, width)
+        self.set_header("Etag", '"%s"' % hashlib.sha1(repr(key).encode("utf-8")).hexdigest())
+        self.set_header("Cache-Control", "max-age=86400")
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        cached = PAGE_CACHE.get(key)
+        if cached is None:
+            cached = self.read_page(fpath, fmt, page, width)
+            PAGE_CACHE.put(key, cached)
+        data, content_type = cached
+        self.set_header("Content-Type", content_type)
+        self.write(data)
+
+    def read_page(self, fpath, fmt, page, width):
+        pages = comic_pages(fpath, fmt)
+        if page < 0 or page >= len(pages):
+            raise web.HTTPError(404, reason="Page not found")
+        name = pages[page]
+        with archive.open_archive(fpath, COMIC_FORMATS[fmt]) as z:
+            data = z.read(name)
+        content_type = guess_type(name)[0] or "application/octet-stream"
+        if width > 0:
+            data, scaled_type = scale_image(data, width)
+            content_type = scaled_type or content_type
+        return data, content_type
 
 
 def routes():
@@ -766,4 +1204,5 @@ def routes():
         (r"/opds/category/(.*)/(.*)", OpdsCategory),
         (r"/opds/categorygroup/(.*)/(.*)", OpdsCategoryGroup),
         (r"/opds/search/(.*)", OpdsSearch),
+        (r"/opds/pse/(\d+)/(\w+)/(\d+)", OpdsPageStream),
     ]
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import json
+import re
+from gettext import gettext as _
+
+from calibre import guess_type
+from calibre.utils.date import as_utc
+from webserver.handlers.opds import (
+    AcquisitionFeed,
+    NavFeed,
+    OpdsCategory,
+    OpdsCategoryGroup,
+    OpdsIndex,
+    OpdsNav,
+    OpdsSearch,
+)
+
+OPDS2_TYPE = "application/opds+json"
+
+
+def opds2_href(href):
+    """把OPDS 1.x的链接转换为对应的/opds2/链接"""
+    return re.sub(r"^/opds(?=/|\?|$)", "/opds2", href)
+
+
+def iso_time(dt):
+    return as_utc(dt).strftime("%Y-%m-%dT%H:%M:%SZ") if dt else None
+
+
+def nav_link(rel, href, **kwargs):
+    link = {"rel": rel, "href": opds2_href(href), "type": OPDS2_TYPE}
+    link.update(kwargs)
+    return link
+
+
+def split_field(val, sep=","):
+    return [v.strip() for v in (val or "").split(sep) if v.strip()]
+
+
+def PUBLICATION(item, FM, prefix):
+    book_id = item[FM["id"]]
+    metadata = {
+        "@type": "http://schema.org/Book",
+        "identifier": "urn:uuid:%s" % item[FM["uuid"]],
+        "title": item[FM["title"]] or _("Unknown"),
+        "author": [{"name": a.replace("|", ",")} for a in split_field(item[FM["authors"]])] or [{"name": _("Unknown")}],
+        "modified": iso_time(item[FM["last_modified"]]),
+        "published": iso_time(item[FM["pubdate"]]),
+    }
+    if item[FM["publisher"]]:
+        metadata["publisher"] = item[FM["publisher"]]
+    languages = split_field(item[FM["languages"]])
+    if languages:
+        metadata["language"] = languages
+    tags = split_field(item[FM["tags"]])
+    if tags:
+        metadata["subject"] = tags
+    if item[FM["series"]]:
+        metadata["belongsTo"] = {"series": {"name": item[FM["series"]], "position": item[FM["series_index"]]}}
+    if item[FM["comments"]]:
+        metadata["description"] = item[FM["comments"]]
+
+    links = []
+    for fmt in split_field(item[FM["formats"]]):
+        fmt = fmt.lower()
+        mt = guess_type("a." + fmt)[0]
+        if mt:
+            href = prefix + "/api/book/%s.%s?from=opds" % (book_id, fmt)
+            links.append({"rel": "http://opds-spec.org/acquisition", "href": href, "type": mt})
+    cover = prefix + "/get/cover/%s.jpg" % book_id
+    return {"metadata": metadata, "links": links, "images": [{"href": cover, "type": "image/jpeg"}]}
+
+
+def feed_to_opds2(feed, self_href):
+    """直接用feed的页面数据生成OPDS 2.0的JSON，不构建XML；self_href为当前请求的链接"""
+    metadata = {"title": feed.title, "modified": iso_time(feed.updated)}
+    if feed.subtitle:
+        metadata["subtitle"] = feed.subtitle
+    if isinstance(feed, NavFeed):
+        offsets = feed.offsets
+        metadata["numberOfItems"] = offsets.total
+        metadata["itemsPerPage"] = offsets.delta
+        metadata["currentPage"] = offsets.offset // offsets.delta + 1
+
+    links = [
+        nav_link("self", self_href),
+        nav_link("start", feed.base_href),
+        nav_link("search", feed.base_href + "/search/{searchTerms}", templated=True),
+    ]
+    links += [nav_link(rel, href) for rel, href in feed.links]
+    ans = {"metadata": metadata, "links": links}
+
+    navigation = [{"href": opds2_href(href), "title": title, "type": OPDS2_TYPE} for title, __, href in feed.navigation()]
+    if navigation or not isinstance(feed, AcquisitionFeed):
+        ans["navigation"] = navigation
+
+    if isinstance(feed, AcquisitionFeed):
+        FM = feed.db.FIELD_MAP
+        ans["publications"] = [PUBLICATION(item, FM, feed.prefix) for item in feed.items]
+        groups = {}
+        for href, title, group, count, active in feed.facets:
+            link = {"href": opds2_href(href), "title": title, "type": OPDS2_TYPE, "properties": {"numberOfItems": count}}
+            if active:
+                link["rel"] = "self"
+            groups.setdefault(group, []).append(link)
+        if groups:
+            ans["facets"] = [{"metadata": {"title": group}, "links": items} for group, items in groups.items()]
+    return ans
+
+
+class Opds2Mixin:
+    def serialize_feed(self, feed):
+        data = json.dumps(feed_to_opds2(feed, self.request.uri), ensure_ascii=False).encode("UTF-8")
+        return OPDS2_TYPE, [data]
+
+
+class Opds2Index(Opds2Mixin, OpdsIndex):
+    pass
+
+
+class Opds2Nav(Opds2Mixin, OpdsNav):
+    pass
+
+
+class Opds2Category(Opds2Mixin, OpdsCategory):
+    pass
+
+
+class Opds2CategoryGroup(Opds2Mixin, OpdsCategoryGroup):
+    pass
+
+
+class Opds2Search(Opds2Mixin, OpdsSearch):
+    pass
+
+
+def routes():
+    return [
+        (r"/opds2/?", Opds2Index),
+        (r"/opds2/nav/(.*)", Opds2Nav),
+        (r"/opds2/category/(.*)/(.*)", Opds2Category),
+        (r"/opds2/categorygroup/(.*)/(.*)", Opds2CategoryGroup),
+        (r"/opds2/search/(.*)", Opds2Search),
+    ]
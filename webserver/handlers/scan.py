@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+import concurrent.futures
+import datetime
 import hashlib
 import logging
+import multiprocessing
 import os
+import queue
+import signal
 import threading
 import time
 import traceback
@@ -12,19 +17,187 @@ from gettext import gettext as _
 import sqlalchemy
 import tornado
 
-from webserver import loader
+from webserver import archive, loader
+from webserver.book_hash import stream_sha256
 from webserver.handlers.base import BaseHandler, auth, js, is_admin
-from webserver.models import Item, ScanFile
+from webserver.metadata_cache import MetadataCache, metadata_from_dict, metadata_to_dict
+from webserver.models import Item, ScanFile, ScanTask
 
 CONF = loader.get_settings()
 SCAN_EXT = ["azw", "azw3", "epub", "mobi", "pdf", "txt"]
 SCAN_DIR_PREFIX = "/data/"  # 限定扫描必须在/data/目录下，以防黑客扫描到其他系统目录
+SCAN_BATCH_SIZE = 100
+RESUMED = -1  # 上次的任务尚未完成，已继续执行该任务，本次提交的参数没有执行
+
+
+def read_metadata(fpath, fmt):
+    """在子进程中运行，返回可pickle的解析结果"""
+    from calibre.ebooks.metadata.meta import get_metadata
+
+    with archive.open_seekable(fpath) as stream:
+        mi = get_metadata(stream, stream_type=fmt, use_libprs_metadata=True)
+    return metadata_to_dict(mi)
+
+
+def report_pid(pids):
+    """进程池子进程的初始化函数，上报自己的pid，超时时由主进程结束"""
+    pids.put(os.getpid())
+
+
+def reflink_file(src, dst):
+    import fcntl
+
+    FICLONE = 0x40049409
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def link_file(src, dst, mode):
+    """按reflink、硬链接的顺序尝试放置文件，成功返回True"""
+    if mode in ("auto", "reflink"):
+        try:
+            reflink_file(src, dst)
+            return True
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+    if mode in ("auto", "hardlink"):
+        try:
+            os.link(src, dst)
+            return True
+        except OSError:
+            pass
+    return False
+
+
+def library_format_path(cache, book_id, fmt):
+    """计算calibre保存该格式文件时使用的路径（与calibre backend.add_format的规则一致）"""
+    title = cache.field_for("title", book_id, default_value=_("Unknown"))
+    authors = cache.field_for("authors", book_id, default_value=(_("Unknown"),))
+    author = authors[0] if authors else _("Unknown")
+    path = cache.field_for("path", book_id).replace("/", os.sep)
+    ext = "." + fmt.lower()
+    fname = cache.backend.construct_file_name(book_id, title, author, len(ext))
+    return os.path.join(cache.backend.library_path, path, fname + ext)
+
+
+def place_format(cache, book_id, fmt, fpath, mode):
+    """将文件以链接的方式放入书库，并登记为书籍的格式
+
+    calibre在目标文件与输入流是同一个文件时不会再复制数据，
+    因此先把文件链接到目标位置，再以该文件作为输入流调用add_format。
+    """
+    try:
+        dest = library_format_path(cache, book_id, fmt)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.exists(dest) or not link_file(fpath, dest, mode):
+            return False
+    except:
+        logging.error(traceback.format_exc())
+        return False
+
+    try:
+        with open(dest, "rb") as stream:
+            cache.add_format(book_id, fmt, stream, run_hooks=False)
+    finally:
+        if cache.format_abspath(book_id, fmt) != dest and os.path.exists(dest):
+            os.remove(dest)
+    return True
+
+
+class MetadataPool:
+    """多进程解析书籍元数据
+
+    calibre的格式解析是CPU密集型的，放在进程池中并行处理；
+    单个文件解析超时后会重建进程池，避免损坏的文件卡住整个扫描。
+    """
+
+    reader = staticmethod(read_metadata)
+
+    def __init__(self, workers=0, timeout=120):
+        self.workers = int(workers) or os.cpu_count() or 1
+        self.timeout = int(timeout)
+        self.pids = None  # 当前进程池的子进程通过初始化函数上报的pid
+
+    def new_executor(self):
+        ctx = multiprocessing.get_context()
+        self.pids = ctx.Queue()
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=ctx, initializer=report_pid, initargs=(self.pids,)
+        )
+
+    def worker_pids(self):
+        pids = []
+        while True:
+            try:
+                pids.append(self.pids.get_nowait())
+            except queue.Empty:
+                return pids
+
+    def kill_executor(self, executor):
+        """结束进程池的全部子进程（包括卡住的），返回结束的pid"""
+        pids = self.worker_pids()
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        executor.shutdown(wait=False, cancel_futures=True)
+        return pids
+
+    def run(self, tasks):
+        """tasks为(key, fpath, fmt)列表，按完成顺序返回(key, data, cover)，失败时data为None"""
+        pending = list(reversed(tasks))
+        running = {}
+        executor = self.new_executor()
+        try:
+            while pending or running:
+                while pending and len(running) < self.workers:
+                    task = pending.pop()
+                    future = executor.submit(self.reader, task[1], task[2])
+                    running[future] = (task, time.time())
+
+                done, __ = concurrent.futures.wait(
+                    list(running.keys()), timeout=1, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    task, __ = running.pop(future)
+                    try:
+                        data, cover = future.result()
+                    except Exception as err:
+                        logging.error("parse metadata error: %s, %s", task[1], err)
+                        data, cover = None, None
+                    yield task[0], data, cover
+
+                now = time.time()
+                expired = [f for f, (task, start) in running.items() if now - start > self.timeout]
+                if not expired:
+                    continue
+
+                # 超时的任务直接放弃，其余未完成的任务重新排队
+                for future in expired:
+                    task, __ = running.pop(future)
+                    logging.error("parse metadata timeout: %s", task[1])
+                    yield task[0], None, None
+                for task, __ in running.values():
+                    pending.append(task)
+                running = {}
+                self.kill_executor(executor)
+                executor = self.new_executor()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
 
 class Scanner:
-    def __init__(self, calibre_db, ScopedSession, user_id=None):
+    # 当前进程中正在执行的任务类型
+    lock = threading.Lock()
+    running = set()
+
+    def __init__(self, calibre_db, ScopedSession, user_id=None, hash_index=None):
         self.db = calibre_db
         self.user_id = user_id
+        self.hash_index = hash_index
+        self.meta_cache = MetadataCache()
         self.func_new_session = ScopedSession
         self.curret_thread = threading.get_ident()
         self.bind_new_session()
@@ -37,13 +210,86 @@ class Scanner:
         """for unittest control"""
         return True
 
+    def run_in_background(self, kind, func, *args):
+        Scanner.running.add(kind)
+
+        def run():
+            try:
+                return func(*args)
+            finally:
+                Scanner.running.discard(kind)
+
+        if not self.allow_backgrounds():
+            return run()
+        logging.info("run into background thread")
+        t = threading.Thread(name="do_" + kind, target=run)
+        t.setDaemon(True)
+        t.start()
+
+    def new_task(self, kind, run_id, data):
+        task = ScanTask(kind, run_id, data)
+        self.session.add(task)
+        self.session.commit()
+        return task
+
+    def save_checkpoint(self, task, phase=None, last_row_id=None, **counts):
+        if phase is not None:
+            task.phase = phase
+        if last_row_id is not None:
+            task.last_row_id = last_row_id
+        for k, v in counts.items():
+            task.count[k] = v
+        task.update_time = datetime.datetime.now()
+        try:
+            self.session.add(task)
+            self.session.commit()
+        except:
+            logging.error(traceback.format_exc())
+            self.session.rollback()
+
+    def finish_task(self, task):
+        task.status = ScanTask.DONE
+        self.save_checkpoint(task)
+
+    def get_unfinished_task(self, kind):
+        return (
+            self.session.query(ScanTask)
+            .filter(ScanTask.kind == kind, ScanTask.status == ScanTask.RUNNING)
+            .order_by(ScanTask.id.desc())
+            .first()
+        )
+
     def resume_last_scan(self):
-        # TODO
-        return False
+        with Scanner.lock:
+            if ScanTask.SCAN in Scanner.running:
+                logging.info("scan task is running")
+                return True
+            task = self.get_unfinished_task(ScanTask.SCAN)
+            if not task:
+                return False
+            Scanner.running.add(ScanTask.SCAN)
+        logging.info("resume scan task: run_id=%s, phase=%s", task.run_id, task.phase)
+        self.run_in_background(ScanTask.SCAN, self.do_resume_scan, task.id)
+        return True
+
+    def resume_last_import(self):
+        with Scanner.lock:
+            if ScanTask.IMPORT in Scanner.running:
+                logging.info("import task is running")
+                return True
+            task = self.get_unfinished_task(ScanTask.IMPORT)
+            if not task:
+                return False
+            Scanner.running.add(ScanTask.IMPORT)
+        logging.info("resume import task: run_id=%s, last_row_id=%s", task.run_id, task.last_row_id)
+        self.run_in_background(ScanTask.IMPORT, self.do_resume_import, task.id)
+        return True
 
-    def save_or_rollback(self, row):
+    def save_or_rollback(self, row, item=None):
         try:
-            row.save()
+            if item is not None:
+                self.session.merge(item)
+            self.session.add(row)
             self.session.commit()
             bid = "[ book-id=%s ]" % row.book_id
             logging.error("update: status=%-5s, path=%s %s", row.status, row.path, bid if row.book_id > 0 else "")
@@ -54,25 +300,49 @@ class Scanner:
             logging.warn("save error: %s", err)
             return False
 
+    def find_same_book(self, hash_value, mi):
+        if self.hash_index and self.hash_index.ready:
+            return self.hash_index.lookup(hash_value)
+
+        # 哈希索引尚未建立完成时，退回到calibre按书名查重
+        books = self.db.books_with_same_title(mi)
+        return books.pop() if books else None
+
     def run_scan(self, path_dir):
         if self.resume_last_scan():
-            return 1
+            return RESUMED
 
-        if not self.allow_backgrounds():
-            self.do_scan(path_dir)
-        else:
-            logging.error("run into background thread")
-            t = threading.Thread(name="do_scan", target=self.do_scan, args=(path_dir,))
-            t.setDaemon(True)
-            t.start()
+        self.run_in_background(ScanTask.SCAN, self.do_scan, path_dir)
         return 1
 
     def do_scan(self, path_dir):
-        from calibre.ebooks.metadata.meta import get_metadata
+        if threading.get_ident() != self.curret_thread:
+            self.bind_new_session()
 
+        # 生成任务ID
+        scan_id = int(time.time())
+        task = self.new_task(ScanTask.SCAN, scan_id, {"path": path_dir})
+        return self.run_scan_task(task)
+
+    def do_resume_scan(self, task_id):
         if threading.get_ident() != self.curret_thread:
             self.bind_new_session()
+        task = self.session.query(ScanTask).get(task_id)
+        return self.run_scan_task(task)
+
+    def run_scan_task(self, task):
+        if task.phase == ScanTask.LIST:
+            self.scan_files(task.data["path"], task.run_id)
+            self.save_checkpoint(task, phase=ScanTask.HASH)
+        if task.phase == ScanTask.HASH:
+            self.hash_rows(task)
+            self.save_checkpoint(task, phase=ScanTask.META)
+        if task.phase == ScanTask.META:
+            self.parse_rows(task)
+        self.finish_task(task)
+        return True
 
+    def scan_files(self, path_dir, scan_id):
         # 生成任务（粗略扫描），前端可以调用API查询进展
         tasks = []
         for dirpath, __, filenames in os.walk(path_dir):
@@ -81,85 +351,164 @@ class Scanner:
                 if not os.path.isfile(fpath):
                     continue
 
+                if archive.is_archive(fpath):
+                    tasks.extend(self.scan_archive(fpath))
+                    continue
+
                 fmt = fpath.split(".")[-1].lower()
                 if fmt not in SCAN_EXT:
                     # logging.debug("bad format: [%s] %s", fmt, fpath)
                     continue
-                tasks.append((fname, fpath, fmt))
+                tasks.append((fname, fpath, os.stat(fpath).st_size))
 
-        # 生成任务ID
-        scan_id = int(time.time())
         logging.info("========== start to check files size & name ============")
-
-        rows = []
         inserted_hash = set()
-        for fname, fpath, fmt in tasks:
+        for fname, fpath, size in tasks:
             # logging.info("Scan: %s", fpath)
-            samefiles = self.session.query(ScanFile).filter(ScanFile.path == fpath)
-            if samefiles.count() > 0:
-                # 如果已经有相同的文件记录，则跳过
-                row = samefiles.first()
+            row = self.session.query(ScanFile).filter(ScanFile.path == fpath).first()
+            if row:
+                # 如果已经有相同的文件记录，则跳过；未处理完的记录归入本次任务
                 if row.status == ScanFile.NEW:
-                    rows.append( row )
-                else:
-                    continue
+                    row.scan_id = scan_id
+                    self.save_or_rollback(row)
+                continue
 
-            stat = os.stat(fpath)
             md5 = hashlib.md5(fname.encode("UTF-8")).hexdigest()
-            hash = "fstat:%s/%s" % (stat.st_size, md5)
+            hash = "fstat:%s/%s" % (size, md5)
             if hash in inserted_hash:
                 logging.warn("maybe have same book, skip: %s", fpath)
                 continue
 
             inserted_hash.add(hash)
             row = ScanFile(fpath, hash, scan_id)
-            if not self.save_or_rollback(row):
-                continue
-            rows.append(row)
-        # self.session.bulk_save_objects(rows)
-
-        logging.info("========== start to check files hash & meta ============")
-        # 检查文件哈希值，检查DB重复情况
-        for row in rows:
-            fpath = row.path
+            self.save_or_rollback(row)
 
-            # 读取文件，计算哈希值
-            sha256 = hashlib.sha256()
-            with open(fpath, "rb") as f:
-                # Read and update hash string value in blocks of 4K
-                for byte_block in iter(lambda: f.read(4096), b""):
-                    sha256.update(byte_block)
+    def scan_archive(self, fpath):
+        # 只读取压缩包的目录，压缩包内的书籍以虚拟路径登记
+        try:
+            members = archive.list_members(fpath, SCAN_EXT)
+        except Exception as err:
+            logging.error("bad archive: %s, %s", fpath, err)
+            return []
+        return [(os.path.basename(name), archive.member_path(fpath, name), size) for name, size in members]
 
-            hash = "sha256:" + sha256.hexdigest()
-            if self.session.query(ScanFile).filter(ScanFile.hash == hash).count() > 0 or hash in inserted_hash:
+    def hash_rows(self, task):
+        logging.info("========== start to check files hash ============")
+        # 检查文件哈希值，检查DB重复情况
+        query = self.session.query(ScanFile).filter(
+            ScanFile.scan_id == task.run_id,
+            ScanFile.status == ScanFile.NEW,
+            ScanFile.id > task.last_row_id,
+        )
+        total = query.count()
+        done = 0
+        for row in query.order_by(ScanFile.id).all():
+            hash = self.read_hash(row)
+            if hash is None:
+                # 无法读取的文件标记为丢弃，否则任务每次恢复都会在这里中断
+                row.status = ScanFile.DROP
+            elif self.session.query(ScanFile).filter(ScanFile.hash == hash, ScanFile.id != row.id).count() > 0:
                 # 如果已经有相同的哈希值，则删掉本任务
                 row.status = ScanFile.DROP
             else:
                 # 或者，更新为真实的哈希值
                 row.hash = hash
-            inserted_hash.add(hash)
-            if not self.save_or_rollback(row):
-                continue
+            self.save_or_rollback(row)
 
-            # 尝试解析metadata
-            fmt = fpath.split(".")[-1].lower()
-            with open(fpath, "rb") as stream:
-                mi = get_metadata(stream, stream_type=fmt, use_libprs_metadata=True)
+            done += 1
+            if done % SCAN_BATCH_SIZE == 0 or done == total:
+                self.save_checkpoint(task, last_row_id=row.id, hash_total=total, hash_done=done)
 
-            row.title = mi.title
-            row.author = mi.author_sort
-            row.publisher = mi.publisher
-            row.tags = ", ".join(mi.tags)
-            row.status = ScanFile.READY  # 设置为可处理
-
-            # TODO calibre提供的书籍重复接口只有对比title；应当提前对整个书库的文件做哈希，才能准确去重
-            books = self.db.books_with_same_title(mi)
-            if books:
-                row.book_id = books.pop()
-                row.status = ScanFile.EXIST
-            if not self.save_or_rollback(row):
-                continue
-        return True
+    def read_hash(self, row):
+        """读取文件，计算哈希值；压缩包内的文件直接流式读取，不解压到磁盘"""
+        try:
+            with archive.open_source(row.path) as stream:
+                return stream_sha256(stream)
+        except Exception as err:
+            logging.error("read file error: %s, %s", row.path, err)
+            row.data = dict(row.data or {}, reason=str(err))
+            return None
+
+    def parse_rows(self, task):
+        logging.info("========== start to parse files meta ============")
+        # 已算出真实哈希、但尚未解析的记录
+        rows = (
+            self.session.query(ScanFile)
+            .filter(
+                ScanFile.scan_id == task.run_id,
+                ScanFile.status == ScanFile.NEW,
+                ScanFile.hash.like("sha256:%"),
+            )
+            .order_by(ScanFile.id)
+            .all()
+        )
+
+        # 多进程解析metadata，结果按批写入DB
+        pool = MetadataPool(CONF["scan_workers"], CONF["scan_timeout"])
+        tasks = [(row, row.path, row.path.split(".")[-1].lower()) for row in rows]
+        batch = []
+        done = 0
+        for row, data, cover in pool.run(tasks):
+            batch.append(row)
+            if data is None:
+                row.status = ScanFile.DROP
+            else:
+                self.update_row_meta(row, data, cover)
+            if len(batch) >= SCAN_BATCH_SIZE:
+                self.save_batch_or_rollback(batch)
+                done += len(batch)
+                batch = []
+                self.save_checkpoint(task, meta_total=len(rows), meta_done=done)
+        self.save_batch_or_rollback(batch)
+        self.save_checkpoint(task, meta_total=len(rows), meta_done=len(rows))
+
+    def update_row_meta(self, row, data, cover):
+        # 保存完整的解析结果（含封面），导入时直接复用
+        self.meta_cache.save_raw(row.hash, dict(data), cover)
+        mi = metadata_from_dict(data, cover)
+
+        row.title = mi.title
+        row.author = mi.author_sort
+        row.publisher = mi.publisher
+        row.tags = ", ".join(mi.tags)
+        row.status = ScanFile.READY  # 设置为可处理
+
+        # 通过书库文件的哈希索引查重
+        book_id = self.find_same_book(row.hash, mi)
+        if book_id:
+            row.book_id = book_id
+            row.status = ScanFile.EXIST
+
+    def save_batch_or_rollback(self, rows, items=None):
+        """一个事务保存一批记录，items为与记录一起保存的关联表 {row.id: Item}"""
+        if not rows:
+            return True
+        items = items or {}
+        now = datetime.datetime.now()
+        for row in rows:
+            row.update_time = now
+        # 回滚会丢弃记录上尚未提交的修改，先记下来，逐条重试时重新设置
+        with self.session.no_autoflush:
+            values = [dict((c.name, getattr(row, c.name)) for c in row.__table__.columns) for row in rows]
+        try:
+            for row in rows:
+                self.session.add(row)
+            for item in items.values():
+                self.session.merge(item)
+            self.session.commit()
+            logging.info("update: %d rows saved", len(rows))
+            return True
+        except Exception as err:
+            logging.error(traceback.format_exc())
+            self.session.rollback()
+            logging.warn("save batch error: %s, retry one by one", err)
+
+        ok = True
+        for row, value in zip(rows, values):
+            for name, v in value.items():
+                setattr(row, name, v)
+            ok = self.save_or_rollback(row, items.get(row.id, None)) and ok
+        return ok
 
     def delete(self, hashlist):
         query = self.session.query(ScanFile)
@@ -167,14 +516,12 @@ class Scanner:
             query = query.filter(ScanFile.hash.in_(hashlist))
         elif isinstance(hashlist, str):
             query = query.filter(ScanFile.hash == hashlist)
+        for (hash_value,) in query.with_entities(ScanFile.hash).all():
+            self.meta_cache.delete(hash_value)
         count = query.delete()
         self.session.commit()
         return count
 
-    def resume_last_import(self):
-        # TODO
-        return False
-
     def build_query(self, hashlist):
         query = self.session.query(ScanFile).filter(
             ScanFile.status == ScanFile.READY
@@ -187,22 +534,13 @@ class Scanner:
 
     def run_import(self, hashlist):
         if self.resume_last_import():
-            return 1
+            return RESUMED
 
         total = self.build_query(hashlist).count()
-
-        if not self.allow_backgrounds():
-            self.do_import(hashlist)
-        else:
-            logging.info("run into background thread")
-            t = threading.Thread(name="do_import", target=self.do_import, args=(hashlist,))
-            t.setDaemon(True)
-            t.start()
+        self.run_in_background(ScanTask.IMPORT, self.do_import, hashlist)
         return total
 
     def do_import(self, hashlist):
-        from calibre.ebooks.metadata.meta import get_metadata
-
         if threading.get_ident() != self.curret_thread:
             self.bind_new_session()
 
@@ -213,69 +551,148 @@ class Scanner:
         query.update({ScanFile.import_id: import_id}, synchronize_session=False)
         self.session.commit()
 
-        # 逐个处理
-        for row in query.all():
-            fpath = row.path
-            fmt = fpath.split(".")[-1].lower()
-            with open(fpath, "rb") as stream:
-                mi = get_metadata(stream, stream_type=fmt, use_libprs_metadata=True)
+        task = self.new_task(ScanTask.IMPORT, import_id, {"user_id": self.user_id})
+        return self.run_import_task(task)
 
-            # 再次检查是否有重复书籍
-            books = self.db.books_with_same_title(mi)
-            if books:
-                row.status = ScanFile.EXIST
-                row.book_id = books.pop()
-                self.save_or_rollback(row)
-                continue
+    def do_resume_import(self, task_id):
+        if threading.get_ident() != self.curret_thread:
+            self.bind_new_session()
+        task = self.session.query(ScanTask).get(task_id)
+        self.user_id = task.data.get("user_id", None)
+        return self.run_import_task(task)
 
-            logging.info("import [%s] from %s", mi.title, fpath)
-            row.book_id = self.db.import_book(mi, [fpath])
-            row.status = ScanFile.IMPORTED
-            self.save_or_rollback(row)
+    def run_import_task(self, task):
+        query = self.session.query(ScanFile).filter(
+            ScanFile.import_id == task.run_id,
+            ScanFile.status == ScanFile.READY,
+            ScanFile.id > task.last_row_id,
+        )
+        rows = query.order_by(ScanFile.id).all()
+        done = task.count.get("done", 0)
+        total = done + len(rows)
+
+        # 分批处理，每批一个事务，处理完后记录检查点
+        for i in range(0, len(rows), SCAN_BATCH_SIZE):
+            batch = rows[i : i + SCAN_BATCH_SIZE]
+            self.import_batch(batch)
+            done += len(batch)
+            self.save_checkpoint(task, last_row_id=batch[-1].id, total=total, done=done)
+        self.finish_task(task)
+        return True
 
-            # 添加关联表
-            item = Item()
-            item.book_id = row.book_id
-            item.collector_id = self.user_id
+    def import_batch(self, rows):
+        imported = []
+        items = {}
+        for row in rows:
             try:
-                item.save()
-            except Exception as err:
-                self.session.rollback()
-                logging.error("save link error: %s", err)
-        return True
+                item = self.import_row(row)
+                if item:
+                    imported.append(row)
+                    items[row.id] = item
+            except:
+                logging.error("import error: %s", row.path)
+                logging.error(traceback.format_exc())
+        self.save_batch_or_rollback(rows, items)
+
+        for row in imported:
+            self.meta_cache.delete(row.hash)
+            if self.hash_index:
+                self.hash_index.add_book(row.book_id)
+
+    def import_row(self, row):
+        """导入一条记录，成功时返回需要与记录一起保存的关联表Item"""
+        from calibre.ebooks.metadata.meta import get_metadata
+
+        fmt = row.path.split(".")[-1].lower()
+        mi = self.meta_cache.load(row.hash)
+        if mi is None:
+            with archive.open_seekable(row.path) as stream:
+                mi = get_metadata(stream, stream_type=fmt, use_libprs_metadata=True)
+
+        # 再次检查是否有重复书籍
+        book_id = self.find_same_book(row.hash, mi)
+        if book_id:
+            row.status = ScanFile.EXIST
+            row.book_id = book_id
+            return None
+
+        # 压缩包内的文件只在导入时解压这一个，放入书库后删除临时文件
+        with archive.extract_member(row.path, os.path.join(self.meta_cache.path, "tmp")) as fpath:
+            book_id = self.import_file(mi, fmt, fpath)
+        row.book_id = book_id
+        row.status = ScanFile.IMPORTED
+
+        # 添加关联表
+        item = Item()
+        item.book_id = row.book_id
+        item.collector_id = self.user_id
+        return item
+
+    def import_file(self, mi, fmt, fpath):
+        logging.info("import [%s] from %s", mi.title, fpath)
+        if self.can_link_file(fpath):
+            # 同一文件系统下，先建立空书籍，再通过硬链接/reflink放置文件，避免复制数据
+            book_id = self.db.import_book(mi, [])
+            try:
+                if not place_format(self.db.new_api, book_id, fmt, fpath, CONF["import_link_mode"]):
+                    self.db.add_format(book_id, fmt, fpath, index_is_id=True)
+            except:
+                # 放置文件失败时删除空书籍，否则下次导入会再建一本
+                self.db.delete_book(book_id)
+                raise
+        else:
+            book_id = self.db.import_book(mi, [fpath])
+        return book_id
+
+    def can_link_file(self, fpath):
+        if CONF["import_link_mode"] == "copy":
+            return False
+        try:
+            library_path = self.db.new_api.backend.library_path
+            return os.stat(fpath).st_dev == os.stat(library_path).st_dev
+        except:
+            return False
 
     def import_status(self):
         import_id = self.session.query(sqlalchemy.func.max(ScanFile.import_id)).scalar()
         if import_id is None:
             return (0, {})
-        query = self.session.query(ScanFile.status).filter(ScanFile.import_id == import_id)
-        return (import_id, self.count(query))
+        return (import_id, self.count(ScanFile.import_id == import_id))
 
     def scan_status(self):
         scan_id = self.session.query(sqlalchemy.func.max(ScanFile.scan_id)).scalar()
         if scan_id is None:
             return (0, {})
-        query = self.session.query(ScanFile.status).filter(ScanFile.scan_id == scan_id)
-        return (scan_id, self.count(query))
+        return (scan_id, self.count(ScanFile.scan_id == scan_id))
 
-    def count(self, query):
-        rows = query.all()
+    def count(self, condition):
+        """在数据库中按状态分组计数，避免把全部记录加载到内存"""
         count = {
-            "total": len(rows),
+            "total": 0,
             ScanFile.NEW: 0,
             ScanFile.DROP: 0,
             ScanFile.EXIST: 0,
             ScanFile.READY: 0,
             ScanFile.IMPORTED: 0,
         }
-        for row in rows:
-            if row.status not in count:
-                count[row.status] = 0
-            count[row.status] += 1
+        query = (
+            self.session.query(ScanFile.status, sqlalchemy.func.count(ScanFile.id))
+            .filter(condition)
+            .group_by(ScanFile.status)
+        )
+        for status, num in query.all():
+            count[status] = num
+            count["total"] += num
         return count
 
 
-class ScanList(BaseHandler):
+class ScanHandler(BaseHandler):
+    """扫描、导入相关的接口；任务在处理请求的进程中运行，多进程模式下都转发给写进程"""
+
+    writer_process = True
+
+
+class ScanList(ScanHandler):
     @js
     @auth
     def get(self):
@@ -313,6 +730,7 @@ class ScanList(BaseHandler):
                 "tags": s.tags,
                 "status": s.status,
                 "book_id": s.book_id,
+                "reason": (s.data or {}).get("reason", ""),
                 "create_time": s.create_time.strftime("%Y-%m-%d %H:%M:%S") if s.create_time else "N/A",
                 "update_time": s.update_time.strftime("%Y-%m-%d %H:%M:%S") if s.update_time else "N/A",
             }
@@ -320,28 +738,30 @@ class ScanList(BaseHandler):
         return {"err": "ok", "items": response, "total": total, "scan_dir": CONF["scan_upload_path"]}
 
 
-class ScanMark(BaseHandler):
+class ScanMark(ScanHandler):
     @js
     @is_admin
     def post(self):
         return {"err": "ok", "msg": _(u"发送成功")}
 
 
-class ScanRun(BaseHandler):
+class ScanRun(ScanHandler):
     @js
     @is_admin
     def post(self):
         path = CONF["scan_upload_path"]
         if not path.startswith(SCAN_DIR_PREFIX):
             return {"err": "params.error", "msg": _(u"书籍导入目录必须是%s的子目录") % SCAN_DIR_PREFIX}
-        m = Scanner(self.db, self.settings["ScopedSession"])
+        m = Scanner(self.db, self.settings["ScopedSession"], hash_index=self.hash_index)
         total = m.run_scan(path)
+        if total == RESUMED:
+            return {"err": "scan.running", "msg": _(u"上次的扫描任务尚未完成，正在继续执行，请等待完成后再重新扫描")}
         if total == 0:
             return {"err": "empty", "msg": _("目录中没有找到符合要求的书籍文件！")}
         return {"err": "ok", "msg": _(u"开始扫描了"), "total": total}
 
 
-class ScanDelete(BaseHandler):
+class ScanDelete(ScanHandler):
     @js
     @is_admin
     def post(self):
@@ -357,7 +777,7 @@ class ScanDelete(BaseHandler):
         return {"err": "ok", "msg": _(u"删除成功"), "count": count}
 
 
-class ScanStatus(BaseHandler):
+class ScanStatus(ScanHandler):
     @js
     @is_admin
     def get(self):
@@ -366,7 +786,7 @@ class ScanStatus(BaseHandler):
         return {"err": "ok", "msg": _(u"成功"), "status": status}
 
 
-class ImportRun(BaseHandler):
+class ImportRun(ScanHandler):
     @js
     @is_admin
     def post(self):
@@ -377,14 +797,16 @@ class ImportRun(BaseHandler):
         if hashlist == "all":
             hashlist = None
 
-        m = Scanner(self.db, self.settings["ScopedSession"], self.user_id())
+        m = Scanner(self.db, self.settings["ScopedSession"], self.user_id(), hash_index=self.hash_index)
         total = m.run_import(hashlist)
+        if total == RESUMED:
+            return {"err": "import.running", "msg": _(u"上次的导入任务尚未完成，正在继续执行，请等待完成后再导入所选书籍")}
         if total == 0:
             return {"err": "empty", "msg": _("没有等待导入书库的书籍！")}
         return {"err": "ok", "msg": _(u"扫描成功")}
 
 
-class ImportStatus(BaseHandler):
+class ImportStatus(ScanHandler):
     @js
     @is_admin
     def get(self):
@@ -393,6 +815,54 @@ class ImportStatus(BaseHandler):
         return {"err": "ok", "msg": _(u"成功"), "status": status}
 
 
+class ScanEvents(ScanHandler):
+    """通过Server-Sent Events推送扫描/导入进度，前端无需轮询"""
+
+    INTERVAL = 1
+    KEEPALIVE = 15
+    MAX_SECONDS = 3600
+
+    async def get(self, kind):
+        if not self.is_admin():
+            raise tornado.web.HTTPError(403)
+
+        self.set_header("Content-Type", "text/event-stream; charset=UTF-8")
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("X-Accel-Buffering", "no")
+        self.closed = False
+
+        last, idle, start = None, 0, time.time()
+        while not self.closed and time.time() - start < self.MAX_SECONDS:
+            running = kind in Scanner.running
+            status = await self.run_blocking(self.read_status, kind)
+            msg = {"err": "ok", "msg": _(u"成功"), "status": status, "running": running}
+            if msg != last:
+                self.write("data: %s\n\n" % tornado.escape.json_encode(msg))
+                last, idle = msg, 0
+            elif idle >= self.KEEPALIVE:
+                self.write(": keepalive\n\n")
+                idle = 0
+            try:
+                await self.flush()
+            except tornado.iostream.StreamClosedError:
+                break
+            if not running:
+                # 任务已结束，发送最终状态后关闭；前端收到后会主动关闭连接
+                break
+            await tornado.gen.sleep(self.INTERVAL)
+            idle += self.INTERVAL
+
+    def read_status(self, kind):
+        # 在线程池中查询，每次使用线程各自的session并在结束后释放，下一轮才能读到后台线程写入的最新状态；
+        # 不能关闭IOLoop线程的session，其他请求的协程也在使用
+        m = Scanner(self.db, self.settings["ScopedSession"])
+        get_status = m.scan_status if kind == ScanTask.SCAN else m.import_status
+        return get_status()[1]
+
+    def on_connection_close(self):
+        self.closed = True
+
+
 def routes():
     return [
         (r"/api/admin/scan/list", ScanList),
@@ -402,4 +872,5 @@ def routes():
         (r"/api/admin/scan/mark", ScanMark),
         (r"/api/admin/import/run", ImportRun),
         (r"/api/admin/import/status", ImportStatus),
+        (r"/api/admin/(scan|import)/events", ScanEvents),
     ]
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """线程安全的LRU缓存，按条目数和/或占用字节数淘汰
+
+    sizeof用于计算单个条目占用的字节数，max_bytes为0时只按条目数淘汰。
+    """
+
+    def __init__(self, max_items=0, max_bytes=0, sizeof=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.lock = threading.Lock()
+        self.data = OrderedDict()  # key => (value, size)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key][0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.data:
+                self.nbytes -= self.data.pop(key)[1]
+            if self.max_bytes and size > self.max_bytes:
+                return False
+            self.data[key] = (value, size)
+            self.nbytes += size
+            self.evict()
+        return True
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            value, size = self.data.pop(key)
+            self.nbytes -= size
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.nbytes = 0
+
+    def is_full(self):
+        if self.max_items and len(self.data) > self.max_items:
+            return True
+        return bool(self.max_bytes and self.nbytes > self.max_bytes)
+
+    def evict(self):
+        while self.data and self.is_full():
+            __, (__, size) = self.data.popitem(last=False)
+            self.nbytes -= size
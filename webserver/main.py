@@ -9,6 +9,8 @@ from gettext import gettext as _
 
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 from social_tornado.models import init_social
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
@@ -16,6 +18,11 @@ from tornado import web
 from tornado.options import define, options
 
 from webserver import loader, models, social_routes, handlers
+from webserver.book_hash import BookHashIndex
+from webserver.catalog import Catalog
+from webserver.fulltext import FulltextIndex
+from webserver.prefork import LibraryWatcher, Worker
+from webserver.suggest import SuggestIndex
 
 CONF = loader.get_settings()
 define("host", default="", type=str, help=_("The host address on which to listen"))
@@ -27,6 +34,7 @@ define("path-bin", default="/usr/bin", type=str, help=_("Path to calibre binary
 define("with-library", default=CONF["with_library"], type=str, help=_("Path to the library folder"))
 define("syncdb", default=False, type=bool, help=_("Create all tables"))
 define("update-config", default=False, type=bool, help=_("update config when system upgrade"))
+define("processes", default=1, type=int, help=_("Number of worker processes, 0 for one per CPU core"))
 
 
 def init_calibre():
@@ -121,7 +129,20 @@ def bind_topdir_book_names(cache):
     return
 
 
-def make_app():
+def resume_scan_tasks(book_db, ScopedSession, hash_index):
+    from webserver.handlers.scan import Scanner
+
+    try:
+        Scanner(book_db, ScopedSession, hash_index=hash_index).resume_last_scan()
+        Scanner(book_db, ScopedSession, hash_index=hash_index).resume_last_import()
+    except:
+        import traceback
+
+        logging.error(traceback.format_exc())
+
+
+def make_app(worker=None):
+    """worker为多进程模式下当前进程的信息，单进程模式为None"""
     auth_db_path = CONF["user_database"]
     logging.info("Init library with [%s]" % options.with_library)
     logging.info("Init AuthDB  with [%s]" % auth_db_path)
@@ -154,7 +175,9 @@ def make_app():
     from calibre.db.legacy import LibraryDatabase
     from calibre.utils.date import fromtimestamp
 
-    book_db = LibraryDatabase(os.path.expanduser(options.with_library))
+    # 多进程模式下只有写进程修改书库，读进程只读打开
+    is_writer = worker is None or worker.is_writer
+    book_db = LibraryDatabase(os.path.expanduser(options.with_library), read_only=not is_writer)
     cache = book_db.new_api
 
     # hook 1: 按字母作为第一级目录，解决书库子目录太多的问题
@@ -176,6 +199,25 @@ def make_app():
 
     gui2.must_use_qt = new_must_use_qt
 
+    # 多进程模式下，读进程发现写进程修改了书库时重新加载
+    library_watcher = None if is_writer else LibraryWatcher(book_db)
+
+    # 后台建立书库文件的哈希索引，用于精确查重
+    hash_index = BookHashIndex(book_db, ScopedSession)
+    if is_writer:
+        hash_index.start()
+
+    # 后台建立书籍正文的全文索引
+    fulltext = FulltextIndex(book_db, CONF["fulltext_database"], hash_index)
+    if is_writer:
+        fulltext.start()
+    else:
+        fulltext.attach()
+
+    # 后台建立搜索框输入建议的前缀索引
+    suggest = SuggestIndex(book_db)
+    suggest.start()
+
     path = CONF["resource_path"] + "/calibre/default_cover.jpg"
     with open(path, "rb") as cover_file:
         default_cover = cover_file.read()
@@ -185,11 +227,21 @@ def make_app():
             "legacy": book_db,
             "cache": cache,
             "ScopedSession": ScopedSession,
+            "hash_index": hash_index,
+            "catalog": Catalog(book_db),
+            "fulltext": fulltext,
+            "suggest": suggest,
+            "worker": worker,
+            "library_watcher": library_watcher,
             "build_time": fromtimestamp(os.stat(path).st_mtime),
             "default_cover": default_cover,
         }
     )
 
+    # 继续执行上次被中断的扫描、导入任务
+    if is_writer:
+        resume_scan_tasks(book_db, ScopedSession, hash_index)
+
     logging.info("Now, Running...")
     app = web.Application(social_routes.SOCIAL_AUTH_ROUTES + handlers.routes(), **app_settings)
     app._engine = engine
@@ -212,8 +264,32 @@ def get_upload_size():
     return int(s) * n
 
 
+def start_processes(num_processes):
+    """预先fork多个进程共同监听端口，0号进程为写进程，另外监听一个本机端口接收其他进程转发的请求"""
+    sockets = tornado.netutil.bind_sockets(options.port, options.host)
+    writer_sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    writer_port = writer_sockets[0].getsockname()[1]
+
+    task_id = tornado.process.fork_processes(num_processes)
+    worker = Worker(task_id, writer_port)
+    logging.info("Start process %d%s", task_id, " (writer)" if worker.is_writer else "")
+
+    app = make_app(worker)
+    http_server = tornado.httpserver.HTTPServer(app, xheaders=True, max_buffer_size=get_upload_size())
+    http_server.add_sockets(sockets)
+    if worker.is_writer:
+        http_server.add_sockets(writer_sockets)
+    else:
+        for s in writer_sockets:
+            s.close()
+    tornado.ioloop.IOLoop.current().start()
+
+
 def main():
     tornado.options.parse_command_line()
+    if options.processes != 1 and not (options.syncdb or options.update_config):
+        return start_processes(options.processes)
+
     app = make_app()
     http_server = tornado.httpserver.HTTPServer(app, xheaders=True, max_buffer_size=get_upload_size())
     http_server.listen(options.port, options.host)
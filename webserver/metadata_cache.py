@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import logging
+import os
+import traceback
+
+from webserver import loader
+
+CONF = loader.get_settings()
+
+
+def metadata_to_dict(mi):
+    """将calibre Metadata转换为可JSON序列化的dict（封面单独返回）"""
+    from calibre.ebooks.metadata.book.serialize import metadata_as_dict
+
+    cover = None
+    if mi.cover_data and mi.cover_data[1]:
+        cover = mi.cover_data
+    d = metadata_as_dict(mi, encode_cover_data=False)
+    d.pop("cover_data", None)
+    return d, cover
+
+
+def metadata_from_dict(d, cover=None):
+    from calibre.ebooks.metadata.book.serialize import metadata_from_dict as _from_dict
+
+    mi = _from_dict(d)
+    if cover:
+        mi.cover_data = cover
+    return mi
+
+
+class MetadataCache:
+    """扫描阶段解析出的书籍元数据缓存，以文件内容哈希为key
+
+    扫描时解析的完整Metadata（含封面）保存到磁盘，导入时直接复用，
+    避免对同一个文件调用两次get_metadata。
+    """
+
+    def __init__(self, path=None):
+        self.path = path or CONF["scan_meta_path"]
+
+    def get_path(self, hash_value):
+        name = hash_value.split(":")[-1]
+        return os.path.join(self.path, name[:2], name)
+
+    def save(self, hash_value, mi):
+        try:
+            d, cover = metadata_to_dict(mi)
+            self.save_raw(hash_value, d, cover)
+            return True
+        except:
+            logging.error("save metadata cache error: %s", hash_value)
+            logging.error(traceback.format_exc())
+            return False
+
+    def save_raw(self, hash_value, d, cover=None):
+        from calibre.utils.serialize import json_dumps
+
+        fpath = self.get_path(hash_value)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        if cover:
+            with open(fpath + ".cover", "wb") as f:
+                f.write(cover[1])
+            d["cover_fmt"] = cover[0]
+        with open(fpath + ".json", "wb") as f:
+            f.write(json_dumps(d))
+
+    def load(self, hash_value):
+        from calibre.utils.serialize import json_loads
+
+        fpath = self.get_path(hash_value)
+        if not os.path.isfile(fpath + ".json"):
+            return None
+        try:
+            with open(fpath + ".json", "rb") as f:
+                d = json_loads(f.read())
+            cover = None
+            cover_fmt = d.pop("cover_fmt", None)
+            if cover_fmt and os.path.isfile(fpath + ".cover"):
+                with open(fpath + ".cover", "rb") as f:
+                    cover = (cover_fmt, f.read())
+            return metadata_from_dict(d, cover)
+        except:
+            logging.error("load metadata cache error: %s", hash_value)
+            logging.error(traceback.format_exc())
+            return None
+
+    def delete(self, hash_value):
+        fpath = self.get_path(hash_value)
+        for ext in [".json", ".cover"]:
+            try:
+                os.remove(fpath + ext)
+            except OSError:
+                pass
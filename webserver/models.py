@@ -312,5 +312,65 @@ class ScanFile(Base, SQLAlchemyMixin):
         self.update_time = datetime.datetime.now()
 
 
+class ScanTask(Base, SQLAlchemyMixin):
+    """扫描/导入任务的进度检查点，用于服务重启后继续执行"""
+
+    __tablename__ = "scantasks"
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(24))
+    run_id = Column(Integer, default=0)
+    phase = Column(String(24))
+    status = Column(String(24))
+    last_row_id = Column(Integer, default=0)
+    count = Column(MutableDict.as_mutable(JSONType), default={})
+    data = Column(MutableDict.as_mutable(JSONType), default={})
+    create_time = Column(DateTime)
+    update_time = Column(DateTime)
+
+    # KIND
+    SCAN = "scan"
+    IMPORT = "import"
+
+    # PHASE
+    LIST = "list"
+    HASH = "hash"
+    META = "meta"
+    IMPORTING = "import"
+
+    # STATUS
+    RUNNING = "running"
+    DONE = "done"
+
+    def __init__(self, kind, run_id, data):
+        super(ScanTask, self).__init__()
+        self.kind = kind
+        self.run_id = run_id
+        self.phase = self.LIST if kind == self.SCAN else self.IMPORTING
+        self.status = self.RUNNING
+        self.last_row_id = 0
+        self.count = {}
+        self.data = data
+        self.create_time = datetime.datetime.now()
+        self.update_time = datetime.datetime.now()
+
+
+class BookHash(Base, SQLAlchemyMixin):
+    __tablename__ = "bookhashes"
+    id = Column(Integer, primary_key=True)
+    book_id = Column(Integer, default=0, index=True)
+    fmt = Column(String(24))
+    hash = Column(String(512), index=True)
+    size = Column(Integer, default=0)
+    create_time = Column(DateTime)
+
+    def __init__(self, book_id, fmt, hash_value, size=0):
+        super(BookHash, self).__init__()
+        self.book_id = book_id
+        self.fmt = fmt
+        self.hash = hash_value
+        self.size = size
+        self.create_time = datetime.datetime.now()
+
+
 def user_syncdb(engine):
     Base.metadata.create_all(engine)
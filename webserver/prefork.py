@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import contextlib
+import logging
+import threading
+import time
+import traceback
+
+from tornado import httpclient, httputil
+
+RELOAD_INTERVAL = 2  # 两次重新加载书库的最小间隔（秒）
+PROXY_TIMEOUT = 3600  # 转发请求的超时时间（秒），与扫描进度推送的最长时间一致
+PROXY_SKIP_HEADERS = ("Content-Length", "Transfer-Encoding", "Connection")
+
+
+class Worker:
+    """多进程模式下当前进程的信息
+
+    启动时预先fork多个进程共同监听端口，0号进程为写进程：修改书库的接口都转发给它处理，
+    后台的哈希索引、全文索引、扫描导入任务也只在写进程中运行。
+    """
+
+    def __init__(self, task_id, writer_port):
+        self.task_id = task_id
+        self.writer_port = writer_port
+
+    @property
+    def is_writer(self):
+        return self.task_id == 0
+
+    def writer_url(self, uri):
+        return "http://127.0.0.1:%d%s" % (self.writer_port, uri)
+
+
+class ReadWriteLock:
+    """读写锁：多个读者可以同时持有，写者独占；有写者等待时新的读者也要等待，避免写者一直等不到"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writers = 0  # 持有及等待中的写者
+        self.writing = False
+
+    @contextlib.contextmanager
+    def read(self):
+        with self.cond:
+            while self.writers:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self.cond:
+            self.writers += 1
+            while self.readers or self.writing:
+                self.cond.wait()
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writing = False
+                self.writers -= 1
+                self.cond.notify_all()
+
+
+class LibraryWatcher:
+    """读进程中检测写进程对书库的修改，重新加载calibre的缓存
+
+    重新加载在IOLoop线程中进行，并等待线程池中正在查询书库的任务（见reading()）结束，
+    期间IOLoop和线程池都不会查询书库，不会读到加载了一半的calibre缓存。
+    db.last_modified()改为返回已加载的版本，catalog等按版本缓存的数据
+    在重新加载完成后才会失效，避免用旧的calibre缓存建立新版本的索引。
+    """
+
+    def __init__(self, calibre_db):
+        self.db = calibre_db
+        self.disk_version = calibre_db.last_modified
+        self.version = self.disk_version()
+        self.lock = ReadWriteLock()
+        self.reload_time = 0
+        calibre_db.last_modified = lambda: self.version
+
+    def reading(self):
+        """线程池中的任务查询书库期间持有读锁"""
+        return self.lock.read()
+
+    def check(self):
+        """每个请求开始时在IOLoop线程中调用，书库有变化时重新加载"""
+        if time.time() - self.reload_time < RELOAD_INTERVAL:
+            return
+        version = self.disk_version()
+        if version != self.version:
+            self.reload(version)
+
+    def reload(self, version):
+        try:
+            with self.lock.write():
+                _ts = time.time()
+                self.db.new_api.reload_from_db()
+                self.db.refresh()
+                self.version = version
+            logging.info("[%5d ms] reload library (version = %s)", int(1000 * (time.time() - _ts)), version)
+        except:
+            logging.error("Failed to reload library:")
+            logging.error(traceback.format_exc())
+        finally:
+            self.reload_time = time.time()
+
+
+async def proxy_to_writer(handler, worker):
+    """把请求原样转发给写进程，响应边收边写回客户端（扫描进度等接口是持续推送的）"""
+    request = handler.request
+    headers = request.headers.copy()
+    headers["X-Forwarded-For"] = request.headers.get("X-Forwarded-For", request.remote_ip)
+    headers["X-Forwarded-Host"] = request.headers.get("X-Forwarded-Host", request.host)
+    headers["X-Scheme"] = request.headers.get("X-Scheme", request.protocol)
+
+    start_line = []
+    rsp_headers = httputil.HTTPHeaders()
+
+    def on_header(line):
+        if not start_line:
+            start_line.append(httputil.parse_response_start_line(line.strip()))
+        elif line.strip():
+            rsp_headers.parse_line(line)
+
+    def send_headers():
+        if start_line:
+            handler.set_status(start_line[0].code, start_line[0].reason)
+        for name, value in rsp_headers.get_all():
+            if name in PROXY_SKIP_HEADERS:
+                continue
+            if name == "Set-Cookie":
+                handler.add_header(name, value)
+            else:
+                handler.set_header(name, value)
+        start_line.clear()
+        rsp_headers.clear()
+
+    def on_chunk(chunk):
+        send_headers()
+        handler.write(chunk)
+        handler.flush()
+
+    req = httpclient.HTTPRequest(
+        worker.writer_url(request.uri),
+        method=request.method,
+        headers=headers,
+        body=request.body if request.method in ("POST", "PUT", "PATCH") else None,
+        follow_redirects=False,
+        decompress_response=False,
+        request_timeout=PROXY_TIMEOUT,
+        header_callback=on_header,
+        streaming_callback=on_chunk,
+    )
+    rsp = await httpclient.AsyncHTTPClient().fetch(req, raise_error=False)
+    if rsp.code == 599:
+        logging.error("Failed to proxy %s to writer: %s", request.uri, rsp.error)
+        if not handler._headers_written:
+            handler.clear()
+            handler.set_status(502)
+        handler.finish()
+        return
+    send_headers()
+    handler.finish()
@@ -20,12 +20,17 @@ settings = {
     "convert_path"  : "/data/books/convert/",
     "upload_path"   : "/data/books/upload/",
     "scan_upload_path"   : "/data/books/imports/",
+    "scan_meta_path": "/data/books/cache/scan/",
+    "scan_workers"  : 0,  # 扫描时解析元数据的进程数，0表示CPU核数
+    "scan_timeout"  : 120,  # 单个文件解析元数据的超时时间（秒）
+    "import_link_mode": "auto",  # 导入时放置文件的方式：auto(reflink或硬链接), reflink, hardlink, copy
     "extract_path"  : "/data/books/extract/",
     "with_library"  : "/data/books/library/",
     "cookie_secret" : "cookie_secret",
     "cookie_expire" : 7*86400,
     "login_url"     : "/login",
     "user_database" : 'sqlite:////data/books/calibre-webserver.db',
+    "fulltext_database": "/data/books/fulltext.db",  # 书籍正文的全文索引（SQLite FTS5）
     "site_title"    : u"奇异书屋",
     "ssl_crt_file"  : "/data/books/ssl/ssl.crt",
     "ssl_key_file"  : "/data/books/ssl/ssl.key",
@@ -35,6 +40,10 @@ settings = {
 
     "convert_timeout" : 300,
 
+    # 执行接口的线程池大小：读取书库的线程数、用户数据库操作的线程数；修改书库的操作总是在单个线程中依次执行
+    "reader_threads": 8,
+    "userdb_threads": 4,
+
     # https://analytics.google.com/
     "google_analytics_id" : "G-LLF01B5ZZ8",
 
@@ -44,6 +53,11 @@ settings = {
     "opds_max_items"           : 50,
     "opds_max_ungrouped_items" : 100,
     "opds_url_prefix"          : "",
+    "opds_cache_size"          : 64*1024*1024,  # 已渲染feed的缓存上限（字节）
+    "opds_page_cache_size"     : 128*1024*1024,  # 漫画单页图片的缓存上限（字节）
+
+    # 虚拟书库 名称 => 搜索条件，例如 {"少儿": "tags:=少儿"}；在用户管理中可限制用户只能看到某个虚拟书库
+    "virtual_libraries": {},
 
     "db_engine_args": {
         "echo": False,
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import bisect
+import logging
+import threading
+import traceback
+from collections import defaultdict
+
+from webserver.utils import pinyin_forms
+
+# 提供输入建议的字段
+SUGGEST_FIELDS = ("title", "authors", "series", "tags")
+SCAN_LIMIT = 512  # 单次查询最多检查的前缀匹配项
+
+
+def book_terms(field, val):
+    if not val:
+        return ()
+    if isinstance(val, (list, tuple, set, frozenset)):
+        return tuple((field, v) for v in val if v)
+    return ((field, val),)
+
+
+def term_keys(value):
+    """返回词条用于前缀匹配的key：原文、各单词开头，中文另有全拼和拼音首字母"""
+    text = " ".join(value.lower().split())
+    keys = {text}
+    words = text.split(" ")
+    for i in range(1, len(words)):
+        keys.add(" ".join(words[i:]))
+    forms = pinyin_forms(text)
+    if forms:
+        keys.update(forms)
+    return keys
+
+
+class SuggestIndex:
+    """书名、作者、丛书、标签的前缀索引，用于搜索框的输入建议
+
+    所有key保存在一个有序数组中，前缀查询即二分查找后顺序扫描，
+    比逐字符的字典树节省大量内存；增删词条时用insort/二分删除原地更新。
+    启动时在后台线程用一次批量读取建立索引，之后按书籍增量更新。
+    """
+
+    def __init__(self, calibre_db):
+        self.db = calibre_db
+        self.lock = threading.RLock()
+        self.keys = []  # 有序的 (key, field, value)
+        self.terms = defaultdict(set)  # (field, value) => set(book_ids)
+        self.books = {}  # book_id => set((field, value))
+        self.version = None
+        self.refreshing = False
+
+    def start(self):
+        t = threading.Thread(name="build_suggest_index", target=self.refresh)
+        t.setDaemon(True)
+        t.start()
+
+    def read_terms(self, book_ids):
+        """批量读取书籍的词条，返回 book_id => set((field, value))"""
+        cache = self.db.new_api
+        books = defaultdict(set)
+        for field in SUGGEST_FIELDS:
+            for book_id, val in cache.all_field_for(field, book_ids).items():
+                books[book_id].update(book_terms(field, val))
+        return books
+
+    def refresh(self):
+        """与书库比对，只更新有变化的书籍"""
+        try:
+            version = self.db.last_modified()
+            cache = self.db.new_api
+            books = self.read_terms(cache.all_book_ids())
+            with self.lock:
+                if not self.books:
+                    self.build(books)
+                for book_id in set(self.books) - set(books):
+                    self.set_terms(book_id, set())
+                for book_id, terms in books.items():
+                    self.set_terms(book_id, terms)
+                self.version = version
+            logging.info("suggest index is ready (%d terms)", len(self.terms))
+        except:
+            logging.error("Failed to build suggest index:")
+            logging.error(traceback.format_exc())
+        finally:
+            self.refreshing = False
+
+    def build(self, books):
+        """首次建立索引时整体排序，避免逐个insort"""
+        for book_id, terms in books.items():
+            self.books[book_id] = terms
+            for term in terms:
+                self.terms[term].add(book_id)
+        self.keys = sorted((key,) + term for term in self.terms for key in term_keys(term[1]))
+
+    def check_version(self):
+        """书库有其他途径的修改（如批量导入）时，在后台比对更新"""
+        version = self.db.last_modified()
+        with self.lock:
+            if self.version is None or version == self.version or self.refreshing:
+                return
+            self.refreshing = True
+        t = threading.Thread(name="refresh_suggest_index", target=self.refresh)
+        t.setDaemon(True)
+        t.start()
+
+    def update_book(self, book_id):
+        """书籍元数据修改、新增或删除后调用"""
+        cache = self.db.new_api
+        exists = book_id in cache.all_book_ids()
+        terms = self.read_terms([book_id]).get(book_id, set()) if exists else set()
+        with self.lock:
+            self.set_terms(book_id, terms)
+            self.version = self.db.last_modified()
+
+    def set_terms(self, book_id, terms):
+        old = self.books.get(book_id, set())
+        if old == terms:
+            return
+        for term in old - terms:
+            self.remove_term(term, book_id)
+        for term in terms - old:
+            self.add_term(term, book_id)
+        if terms:
+            self.books[book_id] = terms
+        else:
+            self.books.pop(book_id, None)
+
+    def add_term(self, term, book_id):
+        ids = self.terms[term]
+        if not ids:
+            for key in term_keys(term[1]):
+                bisect.insort(self.keys, (key,) + term)
+        ids.add(book_id)
+
+    def remove_term(self, term, book_id):
+        ids = self.terms.get(term, set())
+        ids.discard(book_id)
+        if ids:
+            return
+        self.terms.pop(term, None)
+        for key in term_keys(term[1]):
+            entry = (key,) + term
+            i = bisect.bisect_left(self.keys, entry)
+            if i < len(self.keys) and self.keys[i] == entry:
+                del self.keys[i]
+
+    def suggest(self, query, limit=10, visible=None):
+        """返回前缀匹配的词条 [{"type", "name", "count"}]，完全匹配优先，其次按书籍数量
+
+        visible为当前用户可见书籍的位图（None表示不受限制），只统计可见的书籍，
+        没有可见书籍的词条不返回，避免受限用户通过输入建议看到其他书籍的书名、作者等。
+        """
+        self.check_version()
+        prefix = " ".join(query.lower().split())
+        if not prefix:
+            return []
+        found = {}
+        with self.lock:
+            i = bisect.bisect_left(self.keys, (prefix,))
+            for key, field, value in self.keys[i : i + SCAN_LIMIT]:
+                if not key.startswith(prefix):
+                    break
+                exact = found.get((field, value), False) or key == prefix
+                found[(field, value)] = exact
+            items = [(term, exact, self.terms[term]) for term, exact in found.items()]
+            if visible is not None:
+                items = [(term, exact, [i for i in ids if i in visible]) for term, exact, ids in items]
+            items = [(term, exact, len(ids), next(iter(ids))) for term, exact, ids in items if ids]
+
+        items.sort(key=lambda x: (not x[1], -x[2], len(x[0][1]), x[0]))
+        ans = []
+        for (field, value), __, count, book_id in items[:limit]:
+            item = {"type": field, "name": value, "count": count}
+            if field == "title" and count == 1:
+                item["book_id"] = book_id
+            ans.append(item)
+        return ans
@@ -6,6 +6,51 @@ import datetime
 from gettext import gettext as _
 
 
+# 列表接口可以用fields=指定的输出字段 => 需要从书库读取的字段
+# 其中"item"表示访问、下载计数等保存在talebook数据库中的数据
+BOOK_FIELDS = {
+    "id": (),
+    "title": ("title",),
+    "rating": ("rating",),
+    "timestamp": ("timestamp",),
+    "pubdate": ("pubdate",),
+    "author": ("authors",),
+    "authors": ("authors",),
+    "author_sort": ("author_sort",),
+    "tag": ("tags",),
+    "tags": ("tags",),
+    "publisher": ("publisher",),
+    "comments": ("comments",),
+    "series": ("series",),
+    "language": (),
+    "isbn": ("identifiers",),
+    "img": ("timestamp",),
+    "thumb": ("timestamp",),
+    "collector": ("item",),
+    "count_visit": ("item",),
+    "count_download": ("item",),
+    "author_url": ("author_sort",),
+    "publisher_url": ("publisher",),
+}
+
+
+def parse_fields(text):
+    """解析fields=参数，返回有效的输出字段列表（总是包含id）；未指定时返回None"""
+    if not text:
+        return None
+    fields = ["id"]
+    for f in text.split(","):
+        f = f.strip()
+        if f in BOOK_FIELDS and f not in fields:
+            fields.append(f)
+    return fields
+
+
+def field_sources(fields):
+    """返回输出fields所需读取的字段集合"""
+    return {src for f in fields for src in BOOK_FIELDS.get(f, ())}
+
+
 class SimpleBookFormatter:
     """格式化calibre book的字段"""
 
@@ -29,75 +74,97 @@ class SimpleBookFormatter:
             return f'{v.year:04}-{v.month:02}-{v.day:02}'
         return v
 
-    def format(self):
+    def cover_url(self, size):
+        b = self.book
+        return self.cdn_url + "/get/%s/%s.jpg?t=%s" % (size, b["id"], b["timestamp"].strftime("%s"))
+
+    def getters(self):
+        """输出字段 => 取值函数，只计算被请求的字段"""
         b = self.book
-        b["ts"] = b["timestamp"].strftime("%s")
         return {
-            "id": b["id"],
-            "title": b["title"],
-            "rating": b["rating"],
-            "timestamp": self.val("timestamp"),
-            "pubdate": self.val("pubdate"),
-            "author": ", ".join(b["authors"]),
-            "authors": b["authors"],
-            "author_sort": self.val("author_sort"),
-            "tag": " / ".join(b["tags"]),
-            "tags": b["tags"],
-            "publisher": self.val("publisher"),
-            "comments": self.val("comments", _(u"暂无简介")),
-            "series": self.val("series", None),
-            "language": self.val("language", None),
-            "isbn": self.val("isbn", None),
-            "img": self.cdn_url + "/get/cover/%(id)s.jpg?t=%(ts)s" % b,
-            "thumb": self.cdn_url + "/get/thumb_60x80/%(id)s.jpg?t=%(ts)s" % b,
+            "id": lambda: b["id"],
+            "title": lambda: b["title"],
+            "rating": lambda: b["rating"],
+            "timestamp": lambda: self.val("timestamp"),
+            "pubdate": lambda: self.val("pubdate"),
+            "author": lambda: ", ".join(b["authors"]),
+            "authors": lambda: b["authors"],
+            "author_sort": lambda: self.val("author_sort"),
+            "tag": lambda: " / ".join(b["tags"]),
+            "tags": lambda: b["tags"],
+            "publisher": lambda: self.val("publisher"),
+            "comments": lambda: self.val("comments", _(u"暂无简介")),
+            "series": lambda: self.val("series", None),
+            "language": lambda: self.val("language", None),
+            "isbn": lambda: self.val("isbn", None),
+            "img": lambda: self.cover_url("cover"),
+            "thumb": lambda: self.cover_url("thumb_60x80"),
             # 额外填充的字段
-            "collector": self.get_collector(),
-            "count_visit": self.val("count_visit", 0),
-            "count_download": self.val("count_download", 0),
+            "collector": self.get_collector,
+            "count_visit": lambda: self.val("count_visit", 0),
+            "count_download": lambda: self.val("count_download", 0),
         }
 
+    def format(self, fields=None):
+        """fields为输出字段的列表，为None时输出全部字段"""
+        getters = self.getters()
+        if fields is None:
+            fields = getters.keys()
+        return {k: getters[k]() for k in fields if k in getters}
+
 
 class BookFormatter:
-    def __init__(self, tornado_handler, calibre_book_item):
+    """sizes和owned为批量预先读取的格式文件大小和当前用户上传的书籍，未提供时按需查询"""
+
+    def __init__(self, tornado_handler, calibre_book_item, sizes=None, owned=None):
         self.db = tornado_handler.db
         self.book = calibre_book_item
         self.cdn_url = tornado_handler.cdn_url
         self.api_url = tornado_handler.api_url
         self.handler = tornado_handler
+        self.sizes = sizes
+        self.owned = owned
 
     def get_files(self):
         files = []
         book_id = self.book["id"]
+        sizes = self.sizes
+        if sizes is None:
+            sizes = self.handler.format_sizes([self.book])
+        sizes = sizes.get(book_id, {})
         for fmt in self.book.get("available_formats", ""):
-            try:
-                filesize = self.db.sizeof_format(book_id, fmt, index_is_id=True)
-            except:
+            if fmt not in sizes:
                 continue
             item = {
                 "format": fmt,
-                "size": filesize,
+                "size": sizes[fmt],
                 "href": self.cdn_url + "/api/book/%s.%s" % (book_id, fmt),
             }
             files.append(item)
         return files
 
-    def get_permissions(self):
+    def is_owner(self):
         h = self.handler
+        if h.is_admin():
+            return True
+        if self.owned is None:
+            return h.is_book_owner(self.book["id"], h.user_id())
+        return self.book["id"] in self.owned
+
+    def get_permissions(self):
         return {
             # 图书权限数据
             "is_public": True,
-            "is_owner": h.is_admin() or h.is_book_owner(self.book["id"], h.user_id()),
+            "is_owner": self.is_owner(),
         }
 
-    def format(self, with_files=False, with_perms=False):
+    def format(self, with_files=False, with_perms=False, fields=None):
         f = SimpleBookFormatter(self.book, self.cdn_url)
-        data = f.format()
-        data.update(
-            {
-                "author_url": self.api_url + "/author/" + f.val("author_sort"),
-                "publisher_url": self.api_url + "/publisher/" + f.val("publisher"),
-            }
-        )
+        data = f.format(fields)
+        if fields is None or "author_url" in fields:
+            data["author_url"] = self.api_url + "/author/" + f.val("author_sort")
+        if fields is None or "publisher_url" in fields:
+            data["publisher_url"] = self.api_url + "/publisher/" + f.val("publisher")
         if with_files:
             data["files"] = self.get_files()
         if with_perms:
@@ -117,3 +184,51 @@ def compare_books_by_rating_or_id(x, y):
         return 1
     else:
         return -1
+
+
+def is_cjk(c):
+    return "\u4e00" <= c <= "\u9fff" or "\u3400" <= c <= "\u4dbf"
+
+
+def pinyin_initial(c):
+    """返回汉字拼音的首字母（大写），未安装pypinyin时返回None"""
+    try:
+        from pypinyin import Style, pinyin
+    except ImportError:
+        return None
+    py = pinyin(c, style=Style.FIRST_LETTER, heteronym=False, errors="ignore")
+    if py and py[0] and py[0][0].isalpha():
+        return py[0][0].upper()
+    return None
+
+
+def pinyin_forms(text):
+    """返回文本的(全拼, 拼音首字母)，均为小写、无空格；不含汉字或未安装pypinyin时返回None"""
+    if not any(is_cjk(c) for c in text):
+        return None
+    try:
+        from pypinyin import lazy_pinyin
+    except ImportError:
+        return None
+    syllables = [s.strip().lower() for s in lazy_pinyin(text) if s.strip()]
+    return "".join(syllables), "".join(s[0] for s in syllables)
+
+
+def group_letter(text):
+    """返回用于按字母分组的首字符（大写）：中文取拼音首字母，其他文字转写为ASCII后取第一个字母或数字"""
+    for c in text or "":
+        if c.isascii():
+            if c.isalnum():
+                return c.upper()
+            continue
+        if is_cjk(c):
+            initial = pinyin_initial(c)
+            if initial:
+                return initial
+
+        from calibre.utils.filenames import ascii_text
+
+        for a in ascii_text(c):
+            if a.isalnum():
+                return a.upper()
+    return "A"